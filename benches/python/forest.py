@@ -0,0 +1,113 @@
+"""
+Timing and peak memory of the tree_reader.Forest entry points, over synthetic forests of
+controlled size. Run with asv from the repository root, see benches/README.md.
+"""
+
+import tempfile
+import shutil
+
+import numpy as np
+
+from rusty_axe.tree_reader import Forest
+
+from .synthetic import write_synthetic_forest
+
+
+class ForestSuite:
+
+    # Forest size is trees x depth x samples x features
+
+    params = ([10, 50], [4, 8], [1000, 5000], [50])
+    param_names = ['trees', 'depth', 'samples', 'features']
+    timeout = 600
+
+    def setup(self, trees, depth, samples, features):
+        self.directory = tempfile.mkdtemp()
+        self.location = self.directory + "/"
+        self.counts = write_synthetic_forest(
+            self.location, trees=trees, depth=depth, samples=samples, features=features)
+        self.forest = self.load()
+        self.nodes = self.forest.nodes()
+        self.leaves = self.forest.leaves()
+
+    def teardown(self, *params):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def load(self):
+        return Forest.load_from_rust(self.location, prefix="tmp", ifh="tmp.ifh", ofh="tmp.ofh",
+                                     clusters="tmp.clusters", input="input.counts", output="output.counts")
+
+    def time_load_from_rust(self, *params):
+        self.load()
+
+    def peakmem_load_from_rust(self, *params):
+        self.load()
+
+    def time_nodes(self, *params):
+        self.forest.nodes()
+
+    def time_node_sample_encoding(self, *params):
+        self.forest.node_sample_encoding(self.nodes)
+
+    def peakmem_node_sample_encoding(self, *params):
+        self.forest.node_sample_encoding(self.nodes)
+
+    def time_mean_matrix(self, *params):
+        self.forest.mean_matrix(self.nodes)
+
+    def peakmem_mean_matrix(self, *params):
+        self.forest.mean_matrix(self.nodes)
+
+    def time_partial_matrix(self, *params):
+        self.forest.partial_matrix(self.nodes)
+
+    def peakmem_partial_matrix(self, *params):
+        self.forest.partial_matrix(self.nodes)
+
+    def time_predict(self, *params):
+        self.forest.predict(self.counts).node_sample_encoding()
+
+    def peakmem_predict(self, *params):
+        self.forest.predict(self.counts).node_sample_encoding()
+
+    def track_nodes(self, *params):
+        return len(self.nodes)
+
+    def track_leaves(self, *params):
+        return len(self.leaves)
+
+
+class InterpretationSuite:
+
+    # Clustering and reporting are much slower, so they get a smaller grid
+
+    params = ([10, 50], [6], [1000, 5000], [50])
+    param_names = ['trees', 'depth', 'samples', 'features']
+    timeout = 1200
+    number = 1
+    repeat = (1, 3, 120.)
+
+    def setup(self, trees, depth, samples, features):
+        self.directory = tempfile.mkdtemp()
+        self.location = self.directory + "/"
+        write_synthetic_forest(self.location, trees=trees,
+                               depth=depth, samples=samples, features=features)
+        self.forest = Forest.load_from_rust(self.location, prefix="tmp", ifh="tmp.ifh", ofh="tmp.ofh",
+                                            clusters="tmp.clusters", input="input.counts", output="output.counts")
+        self.forest.interpret_splits(k=10, pca=10, depth=depth)
+        np.random.seed(0)
+
+    def teardown(self, *params):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def time_interpret_splits(self, *params):
+        self.forest.interpret_splits(k=10, pca=10, depth=params[1])
+
+    def peakmem_interpret_splits(self, *params):
+        self.forest.interpret_splits(k=10, pca=10, depth=params[1])
+
+    def time_html_tree_summary(self, *params):
+        self.forest.html_tree_summary(output=self.location + "html/")
+
+    def peakmem_html_tree_summary(self, *params):
+        self.forest.html_tree_summary(output=self.location + "html/")
@@ -0,0 +1,83 @@
+import json
+
+import numpy as np
+
+from rusty_axe.lumberjack import write_inputs
+from rusty_axe.datasets import Hierarchy
+
+
+def synthetic_counts(samples, features, seed=0):
+
+    # Zero inflated values with nested factor structure, roughly the shape of single cell data
+
+    hierarchy = Hierarchy(features, depth=3, sparsity=.5, seed=seed)
+    values, _ = hierarchy.matrix(samples)
+    return values
+
+
+def synthetic_node(counts, samples, depth, max_depth, leaf_size, rng):
+
+    # Serialized the way rf_5 writes a node: every node carries its samples, split nodes carry
+    # their means and medians, and each child carries the filter that selected it
+
+    node = {
+        "samples": [int(s) for s in samples],
+        "means": None,
+        "medians": None,
+        "filter": None,
+        "depth": depth,
+        "children": [],
+    }
+
+    if depth >= max_depth or len(samples) < 2 * leaf_size:
+        return node
+
+    feature = int(rng.integers(counts.shape[1]))
+    values = counts[samples, feature]
+    split = float(np.median(values))
+    left = samples[values <= split]
+    right = samples[values > split]
+
+    if len(left) < leaf_size or len(right) < leaf_size:
+        return node
+
+    node["means"] = np.mean(counts[samples], axis=0).tolist()
+    node["medians"] = np.median(counts[samples], axis=0).tolist()
+
+    for child_samples, orientation in ((left, False), (right, True)):
+        child = synthetic_node(counts, child_samples, depth + 1, max_depth, leaf_size, rng)
+        child["filter"] = {
+            "reduction": {
+                "features": [{"name": str(feature), "index": feature}],
+                "means": [0.],
+                "scores": [1.],
+            },
+            "split": split,
+            "orientation": orientation,
+        }
+        node["children"].append(child)
+
+    return node
+
+
+def write_synthetic_forest(location, trees=10, depth=6, samples=1000, features=50, leaf_size=5, seed=0):
+    """
+    Writes the output of a fit over synthetic counts into location (which should end in a
+    path separator), in the layout lumberjack.fit leaves behind, so that it can be read with
+    Forest.load_from_rust(location, prefix="tmp", ifh="tmp.ifh", ofh="tmp.ofh").
+
+    Trees split on a random feature at the median of the node, down to the given depth or
+    until nodes reach the leaf size, which gives forests of controlled size without needing
+    the rf_5 binary.
+    """
+
+    counts = synthetic_counts(samples, features, seed=seed)
+    write_inputs(location, counts)
+
+    rng = np.random.default_rng(seed)
+    for i in range(trees):
+        root = synthetic_node(counts, np.arange(samples), 0, depth, leaf_size, rng)
+        with open(location + f"tmp.tree_{i}.compact", 'w') as f:
+            json.dump(root, f)
+
+    return counts
@@ -0,0 +1,189 @@
+// Micro-benchmarks for the split engine: rank vectors, rank matrices, the split search,
+// NIPALS projection and tree serialization, on synthetic matrices of varying size and shape.
+//
+//  cargo bench                                  run everything
+//  cargo bench -- rank_vector                   run one group
+//
+// See benches/README.md for saving and comparing against the committed baselines.
+
+extern crate rf_5;
+
+use criterion::{criterion_group,criterion_main,BatchSize,BenchmarkId,Criterion,black_box};
+use ndarray::prelude::*;
+use rand::prelude::*;
+use rand::rngs::StdRng;
+
+use rf_5::Feature;
+use rf_5::io::{Parameters,DispersionMode};
+use rf_5::rank_vector::{RankVector,Node};
+use rf_5::rank_matrix::RankMatrix;
+use rf_5::random_forest::Prototype;
+use rf_5::node::Tree;
+use rf_5::fast_nipal_vector::project;
+use rf_5::datasets::Hierarchy;
+
+// Inputs come from rf_5::datasets::Hierarchy. Dense values are continuous, sparse values are
+// zero 80% of the time, and tie heavy values are rounded to integers, which leaves only a
+// handful of distinct levels and exercises the stencil and median bookkeeping.
+
+#[derive(Clone,Copy,Debug)]
+enum Shape {
+    Dense,
+    Sparse,
+    Ties,
+}
+
+const SHAPES: [Shape;3] = [Shape::Dense,Shape::Sparse,Shape::Ties];
+
+fn synthetic(samples:usize,features:usize,shape:Shape) -> Array2<f64> {
+    let mut hierarchy = Hierarchy::new(features,3,2,2.,0.5,0.2,0);
+    match shape {
+        Shape::Dense => {},
+        Shape::Sparse => hierarchy.sparsity = 0.8,
+        Shape::Ties => hierarchy.resolution = Some(1.),
+    }
+    hierarchy.matrix(samples,100_000).0
+}
+
+fn parameters(dispersion_mode:DispersionMode) -> Parameters {
+    let mut parameters = Parameters::empty();
+    parameters.dispersion_mode = dispersion_mode;
+    parameters
+}
+
+fn rank_vector(c: &mut Criterion) {
+    let mut group = c.benchmark_group("rank_vector");
+    for &size in [100,1000,10000].iter() {
+        for &shape in SHAPES.iter() {
+            let values = synthetic(size,1,shape).column(0).to_vec();
+            let label = format!("{:?}/{}",shape,size);
+
+            group.bench_with_input(BenchmarkId::new("link",&label),&values,|b,values| {
+                b.iter(|| RankVector::<Vec<Node>>::link(black_box(values)))
+            });
+
+            let vector = RankVector::<Vec<Node>>::link(&values);
+            let draw_order = vector.draw_order();
+
+            group.bench_with_input(BenchmarkId::new("pop",&label),&draw_order,|b,draw_order| {
+                b.iter_batched(|| vector.clone(),|mut v| {
+                    for &i in draw_order.iter() {
+                        black_box(v.pop(i));
+                    }
+                },BatchSize::SmallInput)
+            });
+
+            group.bench_with_input(BenchmarkId::new("mpop",&label),&draw_order,|b,draw_order| {
+                b.iter_batched(|| vector.clone(),|mut v| {
+                    for &i in draw_order.iter() {
+                        black_box(v.mpop(i));
+                    }
+                },BatchSize::SmallInput)
+            });
+        }
+    }
+    group.finish();
+}
+
+fn ordered_dispersions(c: &mut Criterion) {
+    let mut group = c.benchmark_group("ordered_dispersion");
+    let modes = [
+        DispersionMode::Variance,
+        DispersionMode::SSE,
+        DispersionMode::MAD,
+        DispersionMode::SSME,
+        DispersionMode::SME,
+        DispersionMode::Entropy,
+    ];
+    for &size in [1000,10000].iter() {
+        for &shape in SHAPES.iter() {
+            let values = synthetic(size,2,shape);
+            let vector = RankVector::<Vec<Node>>::link_array(values.column(0));
+            let draw_order = RankVector::<Vec<Node>>::link_array(values.column(1)).draw_order();
+            for &mode in modes.iter() {
+                let label = format!("{:?}/{:?}/{}",mode,shape,size);
+                group.bench_with_input(BenchmarkId::from_parameter(label),&draw_order,|b,draw_order| {
+                    b.iter_batched(|| vector.clone(),|mut v| v.ordered_dispersion(draw_order,mode),BatchSize::SmallInput)
+                });
+            }
+        }
+    }
+    group.finish();
+}
+
+fn rank_matrix(c: &mut Criterion) {
+    let mut group = c.benchmark_group("rank_matrix");
+    group.sample_size(20);
+    for &(samples,features) in [(1000,50),(10000,50),(10000,500)].iter() {
+        for &shape in SHAPES.iter() {
+            let label = format!("{:?}/{}x{}",shape,samples,features);
+            let parameters = parameters(DispersionMode::SSME);
+            let matrix = RankMatrix::from_array(&synthetic(samples,features,shape).t().to_owned(),&parameters);
+
+            let mut rng = StdRng::seed_from_u64(1);
+            let subsample: Vec<usize> = (0..samples/2).map(|_| rng.gen_range(0..samples)).collect();
+            let feature_subsample: Vec<usize> = (0..features.min(20)).map(|_| rng.gen_range(0..features)).collect();
+
+            group.bench_function(BenchmarkId::new("derive_specified",&label),|b| {
+                b.iter(|| matrix.derive_specified(black_box(&feature_subsample),black_box(&subsample)))
+            });
+
+            let derived = matrix.derive_specified(&feature_subsample,&subsample);
+            let draw_order = derived.meta_vector[0].draw_order();
+
+            group.bench_function(BenchmarkId::new("order_dispersions",&label),|b| {
+                b.iter(|| derived.order_dispersions(black_box(&draw_order)))
+            });
+
+            group.bench_function(BenchmarkId::new("split_candidates",&label),|b| {
+                b.iter_batched(|| (derived.clone(),derived.clone()),|(input,output)| RankMatrix::split_candidates(input,output),BatchSize::LargeInput)
+            });
+        }
+    }
+    group.finish();
+}
+
+fn projection(c: &mut Criterion) {
+    let mut group = c.benchmark_group("fast_nipal_vector");
+    group.sample_size(20);
+    for &(samples,features) in [(1000,20),(10000,20),(10000,200)].iter() {
+        for &shape in SHAPES.iter() {
+            let label = format!("{:?}/{}x{}",shape,samples,features);
+            let array = synthetic(samples,features,shape);
+            group.bench_function(BenchmarkId::new("project",&label),|b| {
+                let mut rng = StdRng::seed_from_u64(2);
+                b.iter_batched(|| array.clone(),|a| project(a,2,&mut rng),BatchSize::LargeInput)
+            });
+        }
+    }
+    group.finish();
+}
+
+fn serialization(c: &mut Criterion) {
+    let mut group = c.benchmark_group("serial_node");
+    group.sample_size(20);
+    for &samples in [1000,10000].iter() {
+        let array = synthetic(samples,20,Shape::Dense);
+        let mut parameters = parameters(DispersionMode::SSME);
+        parameters.sample_subsample = samples / 2;
+        parameters.input_feature_subsample = 10;
+        parameters.output_feature_subsample = 10;
+        parameters.depth_cutoff = 8;
+        parameters.leaf_size_cutoff = 10;
+        let prototype = Prototype::new(array.clone(),array,&parameters);
+        let features: Vec<Feature> = (0..20).map(|i| Feature::q(&i)).collect();
+        let mut tree = Tree::new(samples,3);
+        tree.grow(&prototype,&parameters);
+        let serial = tree.to_serial(&features);
+        let address = std::env::temp_dir().join(format!("rf_5_bench_{}.compact",std::process::id()));
+        let address = address.to_str().unwrap().to_string();
+        group.bench_function(BenchmarkId::new("dump",samples),|b| {
+            b.iter_batched(|| serial.clone(),|s| s.dump(address.clone()).unwrap(),BatchSize::LargeInput)
+        });
+        let _ = std::fs::remove_file(&address);
+    }
+    group.finish();
+}
+
+criterion_group!(benches,rank_vector,ordered_dispersions,rank_matrix,projection,serialization);
+criterion_main!(benches);
@@ -0,0 +1,206 @@
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+
+def default_budget(fraction):
+    # A fraction of physical memory in bytes, None where sysconf can't tell
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * fraction)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class CacheManager:
+
+    """
+    Holds the values nodes cache (encodings, dispersions, gains, statistics computed from the
+    counts...) for a whole forest, within a memory budget.
+
+    Each quantity ('encoding', 'mean_dispersions', ...) is kept in its own least recently used order.
+    When a value would take the total over the budget (in bytes, None for no limit), the least
+    recently used values are evicted, oldest first across quantities, and quantities can also be
+    given budgets of their own. Evicted arrays are written to the spill directory if there is
+    one (each manager spills to a temporary directory of its own in it) and read back from it on
+    the next request, otherwise they are simply recomputed.
+
+    Values are keyed by node. Statistics rf_5 computed while growing a tree are not caches and
+    stay on the nodes.
+
+    By default (budget='auto') the budget is DEFAULT_FRACTION of physical memory, or no limit
+    where that can't be found out. Pass budget=None to opt out of any limit.
+    """
+
+    DEFAULT_FRACTION = .25
+
+    def __init__(self, budget='auto', budgets=None, spill=None):
+        if budget == 'auto':
+            budget = default_budget(self.DEFAULT_FRACTION)
+        self.budget = budget
+        self.budgets = {} if budgets is None else dict(budgets)
+        self.spill = spill
+        self.clear()
+
+    def clear(self, quantity=None):
+        if quantity is None:
+            self.stores = {}
+            self.sizes = {}
+            self.spilled = {}
+            self.statistics = {}
+            self.clock = 0
+            self.tokens = {}
+            self.next_token = 0
+            if hasattr(self, 'spill_directory'):
+                self.spill_directory.cleanup()
+                del self.spill_directory
+        else:
+            self.stores.pop(quantity, None)
+            self.sizes.pop(quantity, None)
+            for path in self.spilled.pop(quantity, {}).values():
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def total(self):
+        return sum(self.sizes.values())
+
+    def stats(self):
+        """
+        Hits, misses, spill hits, evictions and spills per quantity, with current entries and bytes
+        """
+        statistics = {}
+        for quantity, counts in self.statistics.items():
+            statistics[quantity] = dict(counts)
+            statistics[quantity]['entries'] = len(self.stores.get(quantity, ()))
+            statistics[quantity]['bytes'] = self.sizes.get(quantity, 0)
+        return statistics
+
+    def count(self, quantity, event):
+        counts = self.statistics.setdefault(
+            quantity, {'hits': 0, 'misses': 0, 'spill_hits': 0, 'evictions': 0, 'spills': 0})
+        counts[event] += 1
+
+    def get(self, quantity, key, compute):
+
+        """
+        The cached value of quantity for key, computing it with compute() if it isn't cached
+        """
+
+        store = self.stores.setdefault(quantity, OrderedDict())
+        self.clock += 1
+
+        if key in store:
+            self.count(quantity, 'hits')
+            store.move_to_end(key)
+            value, size, _ = store[key]
+            store[key] = (value, size, self.clock)
+            return value
+
+        spilled = self.spilled.get(quantity, {})
+        if key in spilled:
+            self.count(quantity, 'spill_hits')
+            path = spilled.pop(key)
+            value = np.load(path)
+            os.remove(path)
+        else:
+            self.count(quantity, 'misses')
+            value = compute()
+
+        self.put(quantity, key, value)
+        return value
+
+    def size(self, value):
+        return value.nbytes if isinstance(value, np.ndarray) else sys.getsizeof(value)
+
+    def put(self, quantity, key, value):
+        store = self.stores.setdefault(quantity, OrderedDict())
+        size = self.size(value)
+        if key in store:
+            self.sizes[quantity] -= store.pop(key)[1]
+        stale = self.spilled.get(quantity, {}).pop(key, None)
+        if stale is not None and os.path.exists(stale):
+            os.remove(stale)
+        self.clock += 1
+        store[key] = (value, size, self.clock)
+        self.sizes[quantity] = self.sizes.get(quantity, 0) + size
+        self.evict(quantity)
+
+    def transform(self, quantity, transform):
+
+        """
+        Replaces every value of quantity, held or spilled, by transform(key, value), eg to add or
+        drop columns without recomputing the rest. Recency is left as it was.
+        """
+
+        store = self.stores.get(quantity, {})
+        for key, (value, size, clock) in list(store.items()):
+            value = transform(key, value)
+            store[key] = (value, self.size(value), clock)
+            self.sizes[quantity] += store[key][1] - size
+        for key, path in self.spilled.get(quantity, {}).items():
+            np.save(path, transform(key, np.load(path)))
+        if len(store) > 0:
+            self.evict(quantity)
+
+    def discard(self, key):
+        for quantity, store in self.stores.items():
+            if key in store:
+                self.sizes[quantity] -= store.pop(key)[1]
+        for spilled in self.spilled.values():
+            path = spilled.pop(key, None)
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+        self.tokens.pop(key, None)
+
+    def evict(self, quantity):
+
+        # The quantity's own budget first, then the overall budget, evicting whichever
+        # quantity has the oldest least recently used value
+
+        limit = self.budgets.get(quantity)
+        while limit is not None and self.sizes[quantity] > limit and len(self.stores[quantity]) > 0:
+            self.evict_oldest(quantity)
+
+        while self.budget is not None and self.total() > self.budget:
+            candidates = [(next(iter(store.values()))[2], q)
+                          for q, store in self.stores.items() if len(store) > 0]
+            if len(candidates) < 1:
+                break
+            self.evict_oldest(min(candidates)[1])
+
+    def evict_oldest(self, quantity):
+        key, (value, size, _) = self.stores[quantity].popitem(last=False)
+        self.sizes[quantity] -= size
+        self.count(quantity, 'evictions')
+        if self.spill is not None and isinstance(value, np.ndarray):
+            path = os.path.join(self.spill_location(quantity), f"{self.token(key)}.npy")
+            np.save(path, value)
+            self.spilled.setdefault(quantity, {})[key] = path
+            self.count(quantity, 'spills')
+
+    def token(self, key):
+        if key not in self.tokens:
+            self.tokens[key] = self.next_token
+            self.next_token += 1
+        return self.tokens[key]
+
+    def spill_location(self, quantity):
+
+        # Values are spilled to a temporary directory of this manager's own (in the spill
+        # directory, or the system's for spill=True), removed when the cache is cleared
+
+        if not hasattr(self, 'spill_directory'):
+            self.spill_directory = tempfile.TemporaryDirectory(
+                dir=None if self.spill is True else self.spill)
+        location = os.path.join(self.spill_directory.name, quantity)
+        os.makedirs(location, exist_ok=True)
+        return location
+
+    def __getstate__(self):
+        # Only the configuration is pickled, cached values are recomputed after loading
+        return {'budget': self.budget, 'budgets': self.budgets, 'spill': self.spill}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
@@ -0,0 +1,109 @@
+import numpy as np
+
+
+class Hierarchy:
+    """
+    Synthetic data with a known nested factor structure, for scale and performance testing.
+
+    Samples belong to a leaf of a balanced tree of clusters with the given depth and branching.
+    Every cluster at every level has a factor: a sparse loading over the features, scaled by
+    effect * decay ** level, so that broad distinctions near the root are stronger than fine
+    ones near the leaves. A sample is the sum of the factors of all clusters on the path to
+    its leaf, plus gaussian noise. Values may then be zero inflated (sparsity is the fraction
+    of values dropped to zero) and rounded to a resolution, which produces ties.
+
+    Loadings are fixed by the seed, and samples are drawn in chunks that are each seeded
+    from the seed and the chunk index, so a dataset of any size is reproducible chunk by
+    chunk without ever being held in memory.
+    """
+
+    def __init__(self, features, depth=3, branching=2, effect=2., decay=.5, density=.1, noise=1., sparsity=0., resolution=None, seed=0):
+
+        self.features = features
+        self.depth = depth
+        self.branching = branching
+        self.effect = effect
+        self.decay = decay
+        self.density = density
+        self.noise = noise
+        self.sparsity = sparsity
+        self.resolution = resolution
+        self.seed = seed
+
+        rng = np.random.default_rng([seed, 0])
+
+        # loadings[level] has one row per cluster at that level, branching ** (level + 1) rows
+
+        self.loadings = []
+        for level in range(depth):
+            clusters = branching ** (level + 1)
+            mask = rng.random((clusters, features)) < density
+            scale = effect * (decay ** level)
+            self.loadings.append(
+                mask * rng.standard_normal((clusters, features)) * scale)
+
+    def leaves(self):
+        return self.branching ** self.depth
+
+    def labels(self, leaves, level):
+        """
+        Cluster of each sample at the given level (0 being the first split), from its leaf
+        """
+        return leaves // (self.branching ** (self.depth - level - 1))
+
+    def chunk(self, index, samples):
+        """
+        The index-th chunk of the dataset, with the given number of samples. Returns the
+        sample x feature matrix and the leaf of each sample.
+        """
+
+        rng = np.random.default_rng([self.seed, 1, index])
+
+        leaves = rng.integers(self.leaves(), size=samples)
+
+        values = self.noise * rng.standard_normal((samples, self.features))
+        for level, loadings in enumerate(self.loadings):
+            values += loadings[self.labels(leaves, level)]
+
+        if self.sparsity > 0:
+            values[rng.random(values.shape) < self.sparsity] = 0.
+
+        if self.resolution is not None:
+            values = np.round(values / self.resolution) * self.resolution
+
+        return values, leaves
+
+    def chunks(self, samples, chunk_size=100000):
+        """
+        Yields (values, leaves) in chunks of at most chunk_size samples, samples in total
+        """
+        for index, start in enumerate(range(0, samples, chunk_size)):
+            yield self.chunk(index, min(chunk_size, samples - start))
+
+    def matrix(self, samples, chunk_size=100000):
+        """
+        The whole dataset in memory
+        """
+        values, leaves = zip(*self.chunks(samples, chunk_size=chunk_size))
+        return np.vstack(values), np.concatenate(leaves)
+
+    def write(self, location, samples, chunk_size=100000, fmt='%.6g'):
+        """
+        Streams the dataset to a whitespace delimited text file that rf_5 can read as
+        -ic/-oc, and the leaf of each sample to location + ".leaves".
+        """
+        with open(location, 'w') as counts, open(location + ".leaves", 'w') as leaves_file:
+            for values, leaves in self.chunks(samples, chunk_size=chunk_size):
+                np.savetxt(counts, values, fmt=fmt)
+                np.savetxt(leaves_file, leaves, fmt='%u')
+
+
+def hierarchical(samples, features, **kwargs):
+    """
+    Convenience wrapper: a samples x features matrix with nested factor structure, the
+    leaf of each sample, and the Hierarchy that generated them (which holds the ground
+    truth loadings). Keyword arguments are passed to Hierarchy.
+    """
+    hierarchy = Hierarchy(features, **kwargs)
+    values, leaves = hierarchy.matrix(samples)
+    return values, leaves, hierarchy
@@ -0,0 +1,742 @@
+"""
+Flat array representation of the trees rf_5 writes.
+
+A tree file is one nested json document. Here it becomes a dictionary of numpy arrays with
+one row per node, in the order Tree.nodes() lists them (each node's descendants, left subtree
+first, then its two children, with the root last), so that row i of a tree is the node with
+index offset + i once the tree is in a forest.
+
+    children        (n, 2) row of the left and right child, -1 for leaves
+    level           depth of the node
+    samples_indptr  CSR over samples: the samples of leaf i are
+    samples         samples[samples_indptr[i]:samples_indptr[i + 1]], empty for other nodes
+    has_filter      whether the node has a filter (every node but the root)
+    filter_indptr   CSR over the features of each filter's reduction, with their
+    filter_features scores and means alongside
+    filter_scores
+    filter_means
+    split           split value and orientation of the filter
+    orientation
+    gain            dispersion gain of the node's split, nan where there is none
+    has_means       whether rf_5 gave means and medians for the node
+    means           (n, output features), zero where has_means is False
+    medians
+    ssr             (n, output features) and (n,), only for trees grown with full statistics
+    population
+    oob             out-of-bag samples, only for trees grown with oob
+
+Parsing a file into arrays is self contained, so it runs in worker processes, and the arrays
+are cheap to send back. Node objects are built from them in the main process.
+
+The arrays of many trees concatenate into forest arrays, with tree_indptr giving the rows of
+each tree, the CSR indptrs running over the whole forest, and oob_indptr/has_oob giving each
+tree's out-of-bag samples. Children stay indices within their tree. Forest arrays are stored
+as a directory of .npy files that open memory mapped, and LazyTrees builds Tree objects from
+them only when they are used, so only the trees that are touched get paged in.
+
+Forest.save writes a store: a directory of .npy arrays (the forest arrays under trees/, the
+count matrices, labels and coordinates) and a manifest.json holding the format version, a
+digest of each array, and the forest attributes that aren't arrays. Saving again rewrites only
+arrays whose digest changed.
+"""
+
+import gc
+import hashlib
+import json
+import os
+import shutil
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from rusty_axe.tree import Tree
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def flatten_tree(tree_json):
+
+    order = []
+
+    def descend(node):
+        for child in node['children']:
+            descend(child)
+        order.extend(node['children'])
+
+    descend(tree_json)
+    order.append(tree_json)
+
+    position = {id(node): i for i, node in enumerate(order)}
+    n = len(order)
+
+    children = np.full((n, 2), -1, dtype=np.int64)
+    level = np.zeros(n, dtype=np.int64)
+    samples_indptr = np.zeros(n + 1, dtype=np.int64)
+    has_filter = np.zeros(n, dtype=bool)
+    filter_indptr = np.zeros(n + 1, dtype=np.int64)
+    split = np.ones(n)
+    orientation = np.zeros(n, dtype=bool)
+    gain = np.full(n, np.nan)
+    has_means = np.zeros(n, dtype=bool)
+
+    samples = []
+    filter_features = []
+    filter_scores = []
+    filter_means = []
+    means = {}
+    medians = {}
+
+    full_statistics = 'population' in tree_json
+    if full_statistics:
+        ssr = []
+        population = np.zeros(n, dtype=np.int64)
+
+    for i, node in enumerate(order):
+        level[i] = node.get('depth', 0)
+        if len(node['children']) > 0:
+            children[i] = [position[id(child)] for child in node['children']]
+            samples_indptr[i + 1] = samples_indptr[i]
+        else:
+            samples.extend(node['samples'])
+            samples_indptr[i + 1] = samples_indptr[i] + len(node['samples'])
+
+        node_filter = node.get('filter')
+        if node_filter is not None:
+            has_filter[i] = True
+            reduction = node_filter['reduction']
+            filter_features.extend(f['index'] for f in reduction['features'])
+            filter_scores.extend(reduction['scores'])
+            filter_means.extend(reduction['means'])
+            split[i] = node_filter['split']
+            orientation[i] = node_filter['orientation']
+        filter_indptr[i + 1] = len(filter_features)
+
+        if node.get('gain') is not None:
+            gain[i] = node['gain']
+
+        if node.get('means') is not None:
+            has_means[i] = True
+            means[i] = node['means']
+            medians[i] = node['medians']
+
+        if full_statistics:
+            ssr.append(node['ssr'])
+            population[i] = node['population']
+
+    features = len(next(iter(means.values()))) if len(means) > 0 else 0
+    mean_array = np.zeros((n, features))
+    median_array = np.zeros((n, features))
+    for i in means:
+        mean_array[i] = means[i]
+        median_array[i] = medians[i]
+
+    arrays = {
+        'children': children,
+        'level': level,
+        'samples_indptr': samples_indptr,
+        'samples': np.array(samples, dtype=np.int64),
+        'has_filter': has_filter,
+        'filter_indptr': filter_indptr,
+        'filter_features': np.array(filter_features, dtype=np.int64),
+        'filter_scores': np.array(filter_scores, dtype=float),
+        'filter_means': np.array(filter_means, dtype=float),
+        'split': split,
+        'orientation': orientation,
+        'gain': gain,
+        'has_means': has_means,
+        'means': mean_array,
+        'medians': median_array,
+    }
+
+    if full_statistics:
+        arrays['ssr'] = np.array(ssr, dtype=float).reshape((n, features))
+        arrays['population'] = population
+
+    if tree_json.get('oob') is not None:
+        arrays['oob'] = np.array(tree_json['oob'], dtype=np.int64)
+
+    return arrays
+
+
+def read_tree_file(path):
+    with open(path, 'rb') as f:
+        return flatten_tree(loads(f.read()))
+
+
+def read_tree_files(paths, workers=None):
+    """
+    Parses tree files into arrays, in a pool of worker processes when there are several
+    """
+    if workers is None:
+        workers = min(len(paths), os.cpu_count() or 1)
+    if workers <= 1 or len(paths) < 2:
+        return [read_tree_file(path) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(paths) // (workers * 4))
+        return list(executor.map(read_tree_file, paths, chunksize=chunksize))
+
+
+NODE_KEYS = ['children', 'level', 'has_filter', 'split', 'orientation',
+             'gain', 'has_means', 'means', 'medians', 'ssr', 'population']
+
+# CSR indptrs of the forest arrays and the values they index, with what the indptr runs over
+
+CSR_KEYS = {
+    'samples_indptr': ['samples'],
+    'filter_indptr': ['filter_features', 'filter_scores', 'filter_means'],
+    'oob_indptr': ['oob'],
+}
+
+
+def tree_to_arrays(tree):
+    """
+    The arrays of a Tree object, the inverse of Tree.from_arrays. Statistics come from the
+    node caches, so nodes keep the means and medians rf_5 gave them or that were computed since.
+    """
+    return nodes_to_arrays(tree.nodes(), getattr(tree, 'oob', None))
+
+
+def nodes_to_arrays(nodes, oob=None):
+    """
+    As tree_to_arrays, for nodes listed as Tree.nodes() lists them, eg a node's subtree
+    """
+
+    n = len(nodes)
+    position = {id(node): i for i, node in enumerate(nodes)}
+
+    features = 0
+    for node in nodes:
+        if hasattr(node, 'mean_cache') and hasattr(node, 'median_cache'):
+            features = len(node.mean_cache)
+            break
+
+    children = np.full((n, 2), -1, dtype=np.int64)
+    has_filter = np.zeros(n, dtype=bool)
+    has_means = np.zeros(n, dtype=bool)
+    means = np.zeros((n, features))
+    medians = np.zeros((n, features))
+    samples_indptr = [0]
+    samples = []
+    filter_indptr = [0]
+    filter_features = []
+    filter_scores = []
+    filter_means = []
+
+    for i, node in enumerate(nodes):
+        if len(node.children) > 0:
+            children[i] = [position[id(child)] for child in node.children]
+        else:
+            samples.extend(node.local_samples)
+        samples_indptr.append(len(samples))
+        has_filter[i] = node.parent is not None
+        reduction = node.filter.reduction
+        filter_features.extend(reduction.features)
+        filter_scores.extend(reduction.scores)
+        filter_means.extend(reduction.means)
+        filter_indptr.append(len(filter_features))
+        if hasattr(node, 'mean_cache') and hasattr(node, 'median_cache') and len(node.mean_cache) == features:
+            has_means[i] = True
+            means[i] = node.mean_cache
+            medians[i] = node.median_cache
+
+    gains = [getattr(node, 'gain', None) for node in nodes]
+
+    arrays = {
+        'children': children,
+        'level': np.array([node.level for node in nodes], dtype=np.int64),
+        'samples_indptr': np.array(samples_indptr, dtype=np.int64),
+        'samples': np.array(samples, dtype=np.int64),
+        'has_filter': has_filter,
+        'filter_indptr': np.array(filter_indptr, dtype=np.int64),
+        'filter_features': np.array(filter_features, dtype=np.int64),
+        'filter_scores': np.array(filter_scores, dtype=float),
+        'filter_means': np.array(filter_means, dtype=float),
+        'split': np.array([node.filter.split for node in nodes], dtype=float),
+        'orientation': np.array([node.filter.orientation for node in nodes], dtype=bool),
+        'gain': np.array([np.nan if g is None else g for g in gains], dtype=float),
+        'has_means': has_means,
+        'means': means,
+        'medians': medians,
+    }
+
+    if all(node.full_statistics and len(node.srs_cache) == features for node in nodes):
+        arrays['ssr'] = np.array([node.srs_cache for node in nodes], dtype=float).reshape((n, features))
+        arrays['population'] = np.array([node.pop() for node in nodes], dtype=np.int64)
+
+    if oob is not None:
+        arrays['oob'] = np.array(oob, dtype=np.int64)
+
+    return arrays
+
+
+def concatenate(tree_arrays):
+    """
+    Forest arrays from the arrays of each tree
+    """
+
+    features = max([arrays['means'].shape[1] for arrays in tree_arrays], default=0)
+
+    forest = {
+        'tree_indptr': np.cumsum([0] + [len(arrays['level']) for arrays in tree_arrays]),
+        'has_oob': np.array([('oob' in arrays) for arrays in tree_arrays], dtype=bool),
+    }
+
+    for key in NODE_KEYS:
+        if not all(key in arrays for arrays in tree_arrays):
+            continue
+        values = [arrays[key] for arrays in tree_arrays]
+        if key in ('means', 'medians', 'ssr'):
+            values = [v if v.shape[1] == features else np.zeros((v.shape[0], features)) for v in values]
+        if len(values) > 0:
+            forest[key] = np.concatenate(values)
+
+    for indptr, keys in CSR_KEYS.items():
+        if indptr == 'oob_indptr':
+            parts = [arrays.get('oob', np.zeros(0, dtype=np.int64)) for arrays in tree_arrays]
+            forest['oob'] = np.concatenate(parts) if len(parts) > 0 else np.zeros(0, dtype=np.int64)
+            forest['oob_indptr'] = np.cumsum([0] + [len(part) for part in parts])
+            continue
+        offset = 0
+        pointers = []
+        for arrays in tree_arrays:
+            pointers.append(arrays[indptr][:-1] + offset)
+            offset += arrays[indptr][-1]
+        pointers.append(np.array([offset]))
+        forest[indptr] = np.concatenate(pointers)
+        for key in keys:
+            forest[key] = np.concatenate([arrays[key] for arrays in tree_arrays])
+
+    return forest
+
+
+def tree_view(forest, t):
+    """
+    The arrays of tree t from forest arrays. Node rows are slices, so with memory mapped forest
+    arrays only the pages of this tree are read.
+    """
+
+    start, end = forest['tree_indptr'][t:t + 2]
+
+    arrays = {key: forest[key][start:end] for key in NODE_KEYS if key in forest}
+
+    for indptr, keys in CSR_KEYS.items():
+        if indptr == 'oob_indptr':
+            if forest['has_oob'][t]:
+                oob_start, oob_end = forest['oob_indptr'][t:t + 2]
+                arrays['oob'] = forest['oob'][oob_start:oob_end]
+            continue
+        pointers = np.asarray(forest[indptr][start:end + 1])
+        first, last = pointers[0], pointers[-1]
+        arrays[indptr] = pointers - first
+        for key in keys:
+            arrays[key] = forest[key][first:last]
+
+    return arrays
+
+
+def gather(starts, ends):
+    """
+    Indices of the concatenated ranges [starts[i], ends[i])
+    """
+    lengths = ends - starts
+    offsets = starts - (np.cumsum(lengths) - lengths)
+    return np.repeat(offsets, lengths) + np.arange(lengths.sum())
+
+
+def derive_samples(forest, samples, sample_count, renumber=True):
+
+    """
+    Forest arrays restricted to samples (indices among sample_count samples), which become
+    samples 0..len(samples) in the order given, or keep their indices if renumber is False. Same as Node.derive_samples on every tree:
+    leaves keep the samples that are in the subset, and a split where one side is left without
+    any becomes a leaf holding the subset's samples of its leaves, left to right.
+
+    Works a level at a time over every tree at once. If no split collapses, the arrays
+    describing the structure and the filters are those of forest, not copies. Statistics don't
+    hold for the subset, so they're dropped.
+
+    Returns the arrays and the mask of the rows of forest that remain.
+    """
+
+    samples = np.asarray(samples, dtype=np.int64)
+    member = np.zeros(sample_count, dtype=bool)
+    member[samples] = True
+    remap = np.full(sample_count, -1, dtype=np.int64)
+    remap[samples] = np.arange(len(samples)) if renumber else samples
+
+    tree_indptr = np.asarray(forest['tree_indptr'])
+    trees = len(tree_indptr) - 1
+    n = int(tree_indptr[-1])
+    tree = np.repeat(np.arange(trees), np.diff(tree_indptr))
+
+    children = np.asarray(forest['children'])
+    internal = children[:, 0] >= 0
+    children = np.where(children >= 0, children + tree_indptr[tree][:, None], -1)
+
+    levels = []
+    frontier = tree_indptr[1:] - 1
+    while len(frontier) > 0:
+        levels.append(frontier)
+        frontier = children[frontier[internal[frontier]]].ravel()
+
+    # Samples of the subset in each leaf, then in each subtree, and the leaves of each subtree
+
+    samples_indptr = np.asarray(forest['samples_indptr'])
+    entries = np.asarray(forest['samples'])
+    entry_nodes = np.repeat(np.arange(n), np.diff(samples_indptr))
+    kept = member[entries]
+    entry_nodes = entry_nodes[kept]
+    entries = remap[entries[kept]]
+
+    population = np.bincount(entry_nodes, minlength=n)
+    leaves = (~internal).astype(np.int64)
+    for level in reversed(levels):
+        parents = level[internal[level]]
+        population[parents] += population[children[parents, 0]] + population[children[parents, 1]]
+        leaves[parents] += leaves[children[parents, 0]] + leaves[children[parents, 1]]
+
+    # Left to right rank of the first leaf of each subtree, so that the leaves below any
+    # node are a contiguous range of ranks
+
+    first = np.zeros(n, dtype=np.int64)
+    roots = levels[0] if len(levels) > 0 else np.zeros(0, dtype=np.int64)
+    first[roots] = np.cumsum(leaves[roots]) - leaves[roots]
+    for level in levels:
+        parents = level[internal[level]]
+        first[children[parents, 0]] = first[parents]
+        first[children[parents, 1]] = first[parents] + leaves[children[parents, 0]]
+
+    collapsed = internal & np.any(population[np.maximum(children, 0)] == 0, axis=1)
+
+    retained = np.zeros(n, dtype=bool)
+    retained[roots] = True
+    for level in levels:
+        parents = level[internal[level] & retained[level] & ~collapsed[level]]
+        retained[children[parents].ravel()] = True
+
+    rows = np.flatnonzero(retained)
+    unchanged = len(rows) == n
+    new_leaves = ~internal[rows] | collapsed[rows]
+
+    # Each remaining leaf holds the samples of the leaves it covers, in rank order
+
+    order = np.argsort(first[entry_nodes], kind='stable')
+    ranks = first[entry_nodes][order]
+    entries = entries[order]
+    starts = np.searchsorted(ranks, first[rows])
+    ends = np.searchsorted(ranks, first[rows] + leaves[rows])
+    ends[~new_leaves] = starts[~new_leaves]
+
+    sizes = np.bincount(tree[rows], minlength=trees)
+    derived = {
+        'tree_indptr': tree_indptr if unchanged else np.cumsum(np.concatenate([[0], sizes])),
+        'has_oob': forest['has_oob'],
+        'samples_indptr': np.concatenate([[0], np.cumsum(ends - starts)]),
+        'samples': entries[gather(starts, ends)],
+        'has_means': np.zeros(len(rows), dtype=bool),
+        'means': np.zeros((len(rows), 0)),
+        'medians': np.zeros((len(rows), 0)),
+    }
+
+    if unchanged:
+        derived['children'] = forest['children']
+    else:
+        position = np.cumsum(retained) - 1
+        offsets = np.cumsum(sizes) - sizes
+        derived['children'] = np.where(
+            (internal[rows] & ~collapsed[rows])[:, None],
+            position[np.maximum(children[rows], 0)] - offsets[tree[rows]][:, None], -1)
+
+    for key in ['level', 'has_filter', 'split', 'orientation', 'gain']:
+        derived[key] = forest[key] if unchanged else np.asarray(forest[key])[rows]
+
+    filter_indptr = np.asarray(forest['filter_indptr'])
+    if unchanged:
+        derived['filter_indptr'] = forest['filter_indptr']
+        for key in CSR_KEYS['filter_indptr']:
+            derived[key] = forest[key]
+    else:
+        selection = gather(filter_indptr[rows], filter_indptr[rows + 1])
+        derived['filter_indptr'] = np.concatenate(
+            [[0], np.cumsum(filter_indptr[rows + 1] - filter_indptr[rows])])
+        for key in CSR_KEYS['filter_indptr']:
+            derived[key] = np.asarray(forest[key])[selection]
+
+    oob = np.asarray(forest['oob'])
+    oob_trees = np.repeat(np.arange(trees), np.diff(forest['oob_indptr']))
+    kept = member[oob]
+    derived['oob'] = remap[oob[kept]]
+    derived['oob_indptr'] = np.concatenate(
+        [[0], np.cumsum(np.bincount(oob_trees[kept], minlength=trees))])
+
+    return derived, retained
+
+
+def derive_nodes(nodes, samples, forest, oob=None):
+
+    """
+    Node.derive_samples and Tree.derive_samples: derive_samples on the arrays of nodes (listed as
+    Tree.nodes() lists them, the root last) and their out-of-bag samples, with samples keeping
+    their indices. Returns the derived tree, built for forest, and the nodes that remain, which
+    correspond to its nodes.
+    """
+
+    arrays = nodes_to_arrays(nodes, oob)
+    samples = np.asarray(samples, dtype=np.int64)
+    sample_count = 1 + max(samples.max(initial=-1), arrays['samples'].max(initial=-1),
+                           arrays.get('oob', samples).max(initial=-1))
+
+    derived, retained = derive_samples(
+        concatenate([arrays]), samples, sample_count, renumber=False)
+    tree = build_trees([tree_view(derived, 0)], forest)[0]
+
+    return tree, [node for node, kept in zip(nodes, retained) if kept]
+
+
+def merge_arrays(directory, batches):
+    """
+    Writes the concatenation of batches of forest arrays to directory as .npy files, holding
+    only one batch in memory at a time: each batch is written out as it comes, then copied
+    into memory mapped arrays of the full size.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    staging = os.path.join(directory, "staging")
+    os.makedirs(staging, exist_ok=True)
+
+    indptrs = ['tree_indptr', *CSR_KEYS.keys()]
+    shapes = {}
+    dtypes = {}
+    count = 0
+    for i, batch in enumerate(batches):
+        for key, value in batch.items():
+            np.save(os.path.join(staging, f"{i}.{key}.npy"), value)
+            rows = value.shape[0] - (1 if key in indptrs and key in shapes else 0)
+            shape = shapes.get(key, (0,) + value.shape[1:])
+            shapes[key] = (shape[0] + rows,) + shape[1:]
+            dtypes[key] = value.dtype
+        count += 1
+
+    for key, shape in shapes.items():
+        merged = np.lib.format.open_memmap(
+            os.path.join(directory, key + ".npy"), mode='w+', dtype=dtypes[key], shape=shape)
+        row = 0
+        offset = 0
+        for i in range(count):
+            part = np.load(os.path.join(staging, f"{i}.{key}.npy"))
+            if key in indptrs:
+                if row > 0:
+                    part = part[1:]
+                part = part + offset
+                offset = part[-1]
+            merged[row:row + part.shape[0]] = part
+            row += part.shape[0]
+        merged.flush()
+        del merged
+
+    shutil.rmtree(staging)
+
+
+def convert_tree_files(paths, directory, batch=100, workers=None):
+    """
+    Parses tree files in batches and writes them to directory as forest arrays
+    """
+    merge_arrays(directory, (concatenate(read_tree_files(paths[i:i + batch], workers=workers))
+                             for i in range(0, len(paths), batch)))
+
+
+def write_arrays(directory, arrays):
+    os.makedirs(directory, exist_ok=True)
+    for key, value in arrays.items():
+        np.save(os.path.join(directory, key + ".npy"), value)
+
+
+def read_arrays(directory, mmap_mode='r'):
+    arrays = {}
+    for name in os.listdir(directory):
+        if name.endswith(".npy"):
+            arrays[name[:-len(".npy")]] = np.load(
+                os.path.join(directory, name), mmap_mode=mmap_mode)
+    return arrays
+
+
+FORMAT = "rusty_axe.forest"
+VERSION = 1
+
+
+def digest(array):
+    array = np.ascontiguousarray(array)
+    if array.dtype.hasobject:
+        raise Exception(f"Can't store an object array ({array.dtype})")
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(array.dtype.str.encode())
+    hasher.update(str(array.shape).encode())
+    hasher.update(memoryview(array.reshape(-1).view(np.uint8)))
+    return hasher.hexdigest()
+
+
+def read_manifest(path):
+    with open(os.path.join(path, "manifest.json")) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != FORMAT:
+        raise Exception(f"{path} is not a saved forest")
+    if manifest['version'] > VERSION:
+        raise Exception(
+            f"{path} was saved in format version {manifest['version']}, this version of rusty_axe reads up to {VERSION}")
+    return manifest
+
+
+def write_store(path, arrays, attributes, opened=None):
+    """
+    Writes arrays and attributes to the store at path, rewriting only the arrays that changed
+    since it was last written. An array that is still mapped read only from the file it would
+    be written to, unchanged since it was opened (opened is that manifest), is skipped without
+    even being read. Returns the names of the arrays that were written and the new manifest.
+    """
+
+    os.makedirs(path, exist_ok=True)
+    try:
+        previous = read_manifest(path)['arrays']
+    except FileNotFoundError:
+        previous = {}
+    opened = {} if opened is None else opened['arrays']
+
+    entries = {}
+    written = []
+    for name, array in arrays.items():
+        target = os.path.join(path, name + ".npy")
+        exists = os.path.exists(target)
+
+        if (exists and name in previous and previous[name] == opened.get(name)
+                and isinstance(array, np.memmap) and array.mode == 'r'
+                and array.filename is not None and os.path.samefile(array.filename, target)
+                and list(array.shape) == previous[name]['shape']):
+            entries[name] = previous[name]
+            continue
+
+        entry = {'digest': digest(array), 'shape': list(array.shape), 'dtype': array.dtype.str}
+        if exists and previous.get(name) == entry:
+            entries[name] = entry
+            continue
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        staging = target[:-len(".npy")] + ".staging.npy"
+        np.save(staging, np.asarray(array))
+        os.replace(staging, target)
+        entries[name] = entry
+        written.append(name)
+
+    for name in previous:
+        if name not in entries:
+            target = os.path.join(path, name + ".npy")
+            if os.path.exists(target):
+                os.remove(target)
+
+    manifest = {'format': FORMAT, 'version': VERSION,
+                'arrays': entries, 'attributes': attributes}
+    staging = os.path.join(path, "manifest.staging.json")
+    with open(staging, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(staging, os.path.join(path, "manifest.json"))
+
+    return written, manifest
+
+
+def read_store(path, mmap_mode='r'):
+    manifest = read_manifest(path)
+    arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+              for name in manifest['arrays']}
+    return manifest, arrays
+
+
+class LazyTrees(Sequence):
+    """
+    The trees of a forest, built from forest arrays the first time each is used. Stands in for
+    the list of trees of a forest: it can be indexed, iterated and extended with trees that are
+    already built. Iterating builds every tree, so forest wide methods still work, they just
+    page in the whole forest.
+    """
+
+    def __init__(self, arrays, forest):
+        self.arrays = arrays
+        self.forest = forest
+        self.built = {}
+        self.extra = []
+
+    def stored(self):
+        return len(self.arrays['tree_indptr']) - 1
+
+    def __len__(self):
+        return self.stored() + len(self.extra)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        if index >= self.stored():
+            return self.extra[index - self.stored()]
+        if index not in self.built:
+            tree = build_trees([tree_view(self.arrays, index)], self.forest)[0]
+            offset = int(self.arrays['tree_indptr'][index])
+            for i, node in enumerate(tree.nodes()):
+                node.index = offset + i
+            self.built[index] = tree
+        return self.built[index]
+
+    def append(self, tree):
+        self.extra.append(tree)
+
+    def extend(self, trees):
+        self.extra.extend(trees)
+
+    def release(self):
+        """
+        Forgets the trees built so far, so they can be freed once nothing else refers to them
+        (the forest's node registry refers to them too, so it's dropped as well, and so are
+        their values in the cache manager, which is keyed by node)
+        """
+        caches = self.forest.caches()
+        for tree in self.built.values():
+            for node in tree.nodes():
+                caches.discard(node)
+        self.built = {}
+        self.forest.invalidate_registry()
+
+
+def build_trees(tree_arrays, forest):
+    """
+    Trees for a forest from their arrays. Building nodes allocates a great many objects that
+    are all kept, so the cyclic garbage collector is paused meanwhile rather than repeatedly
+    scanning them, which otherwise takes most of the time.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return [Tree.from_arrays(arrays, forest) for arrays in tree_arrays]
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def unrepresented_samples(tree_arrays, samples):
+    """
+    Samples that aren't in a leaf of any tree, counted with a bincount over leaf samples
+    """
+    if len(tree_arrays) < 1:
+        return np.arange(samples)
+    leaf_samples = np.concatenate([arrays['samples'] for arrays in tree_arrays])
+    coverage = np.bincount(leaf_samples, minlength=samples)
+    return np.arange(samples)[coverage == 0]
@@ -16,7 +16,12 @@ import io
 import argparse
 from time import sleep
 import subprocess as sp
+import json
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import rusty_axe.tree_reader as tr
+import rusty_axe.forest_arrays as forest_arrays
 
 
 bin_path = os.path.join("..","target","release", "rf_5.exe")
@@ -30,8 +35,8 @@ def main(location, input, output=None, ifh=None, ofh=None, **kwargs):
     print("Trying to load")
     print(input)
     print(output)
-    input_counts = np.loadtxt(input)
-    output_counts = np.loadtxt(output)
+    input_counts = read_counts(input)
+    output_counts = input_counts if output == input else read_counts(output)
     if ifh is not None:
         ifh = np.loadtxt(ifh, dtype=str)
     if ofh is not None:
@@ -43,9 +48,102 @@ def main(location, input, output=None, ifh=None, ofh=None, **kwargs):
     print(fit_return)
 
 
-def save_trees(location, input_counts, output_counts=None, ifh=None, ofh=None, header=None, lrg_mem=None, unsupervised = "false", **kwargs):
+def read_counts(location):
+
+    """
+    Reads a whitespace delimited count matrix, as np.loadtxt would, using rf_5's parallel parser
+    (rf_5 -parse_matrix). The parsed matrix comes back as a .npy file, in /dev/shm where there is
+    one. Falls back on np.loadtxt if the binary can't be run.
+    """
+
+    scratch = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    try:
+        with tmp.TemporaryDirectory(dir=scratch) as directory:
+            parsed = os.path.join(directory, "counts.npy")
+            sp.run([RUST_PATH, "-parse_matrix", location, parsed], stdout=sp.DEVNULL, stderr=sp.PIPE,
+                   universal_newlines=True, check=True)
+            return np.load(parsed)
+    except (OSError, sp.CalledProcessError) as error:
+        print(f"Parsing {location} with np.loadtxt ({error})")
+        return np.loadtxt(location)
+
+
+def save_trees(location, input_counts, output_counts=None, ifh=None, ofh=None, header=None, lrg_mem=None, unsupervised = "false", prefix="tmp", shared_memory=False, **kwargs):
 
     # This method saves ascii matrices to pass as inputs to the rust fitting procedure.
+    # With shared_memory the matrices are handed over in shared memory instead, see SharedInputs.
+
+    shared_memory = shared_memory and shared_memory_available()
+
+    if not shared_memory:
+        write_inputs(location, input_counts, output_counts=output_counts, ifh=ifh, ofh=ofh, header=header)
+
+        print("Generating trees")
+
+        return inner_fit(location, ifh=(location + "tmp.ifh"), ofh=(location + "tmp.ofh"), lrg_mem=lrg_mem, unsupervised = unsupervised, prefix=prefix, **kwargs)
+
+    write_inputs(location, input_counts, output_counts=output_counts, ifh=ifh, ofh=ofh, header=header, counts=False)
+
+    with SharedInputs(input_counts, output_counts) as shared:
+
+        print("Generating trees")
+
+        return inner_fit(location, ifh=(location + "tmp.ifh"), ofh=(location + "tmp.ofh"), lrg_mem=lrg_mem, unsupervised = unsupervised, prefix=prefix, shared=shared, **kwargs)
+
+
+def shared_memory_available():
+
+    # rf_5 maps shared memory segments through /dev/shm, which some platforms (macOS) don't have
+
+    if os.path.isdir("/dev/shm"):
+        return True
+    print("Shared memory needs /dev/shm, which this system doesn't have. Writing count files instead")
+    return False
+
+
+class SharedInputs:
+
+    """
+    Places the input and output matrices in POSIX shared memory segments for rf_5, which maps them
+    read only (-input_shm/-output_shm), so nothing is written to disk or parsed. Segments hold the
+    matrices as row major float64 and are unlinked on exit. When there is no output matrix, or
+    it is the input matrix, one segment serves both.
+    """
+
+    def __init__(self, input_counts, output_counts=None):
+        self.input_counts = input_counts
+        self.output_counts = output_counts
+        self.segments = []
+
+    def share(self, matrix):
+        from multiprocessing import shared_memory
+        matrix = np.ascontiguousarray(matrix, dtype=np.float64)
+        segment = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+        np.ndarray(matrix.shape, dtype=np.float64, buffer=segment.buf)[:] = matrix
+        self.segments.append(segment)
+        return (segment.name.lstrip("/"), matrix.shape[0], matrix.shape[1])
+
+    def __enter__(self):
+        self.input = self.share(self.input_counts)
+        if self.output_counts is None or self.output_counts is self.input_counts:
+            self.output = self.input
+        else:
+            self.output = self.share(self.output_counts)
+        return self
+
+    def __exit__(self, *args):
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+        self.segments = []
+
+    def arguments(self):
+        return ["-input_shm", *[str(v) for v in self.input], "-output_shm", *[str(v) for v in self.output]]
+
+
+def write_inputs(location, input_counts, output_counts=None, ifh=None, ofh=None, header=None, counts=True):
+
+    # Writes the count matrices and headers rf_5 reads. With counts=False only the headers
 
     if output_counts is None:
         output_counts = input_counts
@@ -54,8 +152,9 @@ def save_trees(location, input_counts, output_counts=None, ifh=None, ofh=None, h
         ifh = header
         ofh = header
 
-    np.savetxt(location + "input.counts", input_counts)
-    np.savetxt(location + "output.counts", output_counts)
+    if counts:
+        np.savetxt(location + "input.counts", input_counts)
+        np.savetxt(location + "output.counts", output_counts)
 
     if ifh is None:
         np.savetxt(location + "tmp.ifh",
@@ -69,17 +168,13 @@ def save_trees(location, input_counts, output_counts=None, ifh=None, ofh=None, h
     else:
         np.savetxt(location + "tmp.ofh", ofh, fmt="%s")
 
-    print("Generating trees")
-
-    return inner_fit(location, ifh=(location + "tmp.ifh"), ofh=(location + "tmp.ofh"), lrg_mem=lrg_mem, unsupervised = unsupervised, **kwargs)
-
 
 def load(location):
     # Alias to the tree reader load
     return tr.Forest.load(location)
 
 
-def fit(input_counts, cache=True, output_counts=None, ifh=None, ofh=None, header=None, backtrace=False, lrg_mem=None, location=None, **kwargs):
+def fit(input_counts, cache=True, output_counts=None, ifh=None, ofh=None, header=None, backtrace=False, lrg_mem=None, location=None, pipeline=True, workers=None, shared_memory=False, **kwargs):
 
     """
     Fit a random forest. Start with this function if you are fitting a forest via the API in another python script or notebook.
@@ -88,6 +183,24 @@ def fit(input_counts, cache=True, output_counts=None, ifh=None, ofh=None, header
 
     Input_counts: NxM numpy array, rows are samples columns are features.
     output_counts: Optional second matrix
+    location: Optional directory to fit in. Trees are kept there instead of in a temporary directory.
+    pipeline: Parse each tree as soon as rf_5 reports it finished, in a pool of worker processes,
+    while the rest of the forest is still being fit.
+    shared_memory: Hand the matrices to rf_5 in POSIX shared memory (/dev/shm) instead of writing
+    them to text files, so that nothing but the trees and headers touches the disk. Where there is
+    no /dev/shm (macOS) the matrices are written to count files as usual.
+    on_event: Optional callback receiving every progress event rf_5 reports, see EventReader.
+    profile: If True, rf_5 times each phase of growing trees, per tree and per depth, and counts
+    allocations. The report is stored as forest.profile.
+    oob: If True, each tree picks its splits from a bootstrap of the samples and records the rest
+    as out-of-bag, which gives forest.oob_score() without a separate validation fit.
+    full_statistics: If True, rf_5 computes the means, medians, sums of squared residuals and
+    population of every node, leaves included, over all of its samples. The forest is loaded
+    with them in place, so nothing has to be recomputed from the counts in python.
+
+    Passing seed=<int> makes the fit reproducible. To pick up a fit that was interrupted, call fit
+    again with the same arguments, the same location and resume=True: trees that were already
+    written are kept and only the missing ones are grown.
     """
 
     if output_counts is None:
@@ -96,6 +209,8 @@ def fit(input_counts, cache=True, output_counts=None, ifh=None, ofh=None, header
     else:
         unsupervised = False
 
+    shared_memory = shared_memory and shared_memory_available()
+
     tmp_dir = None
     
     if location is None:
@@ -106,36 +221,73 @@ def fit(input_counts, cache=True, output_counts=None, ifh=None, ofh=None, header
         tmp_dir = tmp.TemporaryDirectory()
         location = tmp_dir.name + "/"
 
-    arguments = save_trees(location + "/", input_counts=input_counts, output_counts=output_counts,
-                           ifh=ifh, ofh=ofh, header=header, lrg_mem=lrg_mem, unsupervised = unsupervised, **kwargs)
-
-    forest = tr.Forest.load_from_rust(location, prefix="tmp", ifh="tmp.ifh", ofh="tmp.ofh",
-                                      clusters="tmp.clusters", input="input.counts", output="output.counts")
+    loader = None
+    if pipeline:
+        loader = TreeLoader(empty_forest(input_counts, output_counts, ifh=ifh, ofh=ofh, header=header), workers=workers)
+        kwargs['on_tree'] = loader.submit
+
+    try:
+        arguments = save_trees(location + "/", input_counts=input_counts, output_counts=output_counts,
+                               ifh=ifh, ofh=ofh, header=header, lrg_mem=lrg_mem, unsupervised = unsupervised, shared_memory=shared_memory, **kwargs)
+    except Exception:
+        if loader is not None:
+            loader.executor.shutdown(cancel_futures=True)
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+        raise
+
+    # A binary that doesn't report finished trees leaves the loader empty, then we load as before
+
+    if loader is not None and len(loader.futures) > 0:
+        forest = loader.finish()
+    elif shared_memory:
+        # There are no count files to read back, the matrices are still in memory here
+        forest = empty_forest(input_counts, output_counts, ifh=ifh, ofh=ofh, header=header)
+        tree_files = sorted(glob.glob(location + "/tmp*.compact"), key=tr.tree_file_order)
+        forest.add_trees(forest_arrays.build_trees(forest_arrays.read_tree_files(tree_files), forest))
+    else:
+        forest = tr.Forest.load_from_rust(location, prefix="tmp", ifh="tmp.ifh", ofh="tmp.ofh",
+                                          clusters="tmp.clusters", input="input.counts", output="output.counts")
 
     forest.set_cache(cache)
 
     forest.arguments = arguments
 
+    # With profile=True rf_5 leaves a timing and memory report next to the trees
+
+    profile_report = location + "/tmp.profile.json"
+    if os.path.exists(profile_report):
+        with open(profile_report) as f:
+            forest.profile = json.load(f)
+
     if tmp_dir is not None:
         tmp_dir.cleanup()
 
     if '-reduce_output' in forest.arguments:
         ro_i = forest.arguments.index('-reduce_output')
         reduced = bool(forest.arguments[ro_i+1])
-        if reduced:
+        # Bootstrap statistics of a reduced output describe its components, full statistics don't
+        if reduced and not kwargs.get('full_statistics', False):
             forest.reset_cache()
 
     return forest
 
 
-def inner_fit(location, backtrace=False, unsupervised = False, lrg_mem = False, **kwargs):
+def inner_fit(location, backtrace=False, unsupervised = False, lrg_mem = False, prefix="tmp", on_tree=None, on_event=None, shared=None, **kwargs):
 
     """
     This method calls out to rust via cli using files written to disk
 
     The argument calls for the location of input.counts and output.counts,
     optionally the backtrace, which determines whether or not Rust backtraces
-    errors.
+    errors. Trees are written to files starting with location + prefix.
+
+    lrg_mem grows one tree at a time to keep a single working set in memory. To
+    fit as many trees at once as a memory budget allows instead, pass eg mem_limit="200G".
+
+    on_tree is called with the index and path of each tree as rf_5 reports it finished.
+    on_event is called with every event rf_5 reports (see EventReader) instead of printing progress.
+    shared is a SharedInputs holding the matrices in shared memory, in place of the count files.
 
     The remainder of keyword arguments should be rust keywords. For further details see io.rs in src
 
@@ -143,41 +295,324 @@ def inner_fit(location, backtrace=False, unsupervised = False, lrg_mem = False,
 
     print("Running " + RUST_PATH)
 
-    arg_list = []
+    arg_list = rust_arguments(location, unsupervised=unsupervised, lrg_mem=lrg_mem, prefix=prefix, shared=shared, **kwargs)
+
+    print("Command: " + " ".join(arg_list))
+
+    with sp.Popen(arg_list, stdin=sp.DEVNULL, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True) as cp:
+        for event in EventReader(cp):
+            if event["event"] == "tree" and on_tree is not None:
+                on_tree(event["index"], event["path"])
+            if on_event is not None:
+                on_event(event)
+            else:
+                describe_event(event)
+
+    # Trees reported before a crash shouldn't pass for a finished forest
+
+    if cp.wait() != 0:
+        raise Exception(f"rf_5 exited with status {cp.returncode}")
+
+    return arg_list
+
+
+def read_event(line):
+
+    # rf_5 reports events as single line JSON objects, anything else is free text
+
+    if not line.startswith("{"):
+        return None
+    try:
+        event = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(event, dict) or "event" not in event:
+        return None
+    return event
+
+
+class EventReader:
+
+    """
+    Reads the progress of a running rf_5 process without ever blocking it.
+
+    rf_5 reports progress as one JSON object per line on stdout (see events.rs). Both stdout and
+    stderr are drained by background threads, so neither pipe can fill up and stall the process.
+    Every line becomes an event dictionary with an "event" key. Lines that aren't JSON become
+    {"event": "log", "stream": "stdout" or "stderr", "line": ...}.
+
+    Iterating over the reader yields events as they arrive until the process closes both streams.
+    poll() returns whatever has arrived so far without waiting. Callbacks can be registered per event
+    kind, or under "*" for every event, and are called as events are consumed.
+    """
+
+    def __init__(self, process, callbacks=None):
+        self.process = process
+        self.callbacks = callbacks if callbacks is not None else {}
+        self.queue = queue.Queue()
+        self.open_streams = 2
+        self.threads = [
+            threading.Thread(target=self.drain, args=(process.stdout, "stdout"), daemon=True),
+            threading.Thread(target=self.drain, args=(process.stderr, "stderr"), daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def drain(self, stream, name):
+        for line in stream:
+            event = read_event(line) if name == "stdout" else None
+            if event is None:
+                event = {"event": "log", "stream": name, "line": line.rstrip("\n")}
+            self.queue.put(event)
+        self.queue.put(None)
+
+    def dispatch(self, event):
+        if event is None:
+            self.open_streams -= 1
+            return None
+        for key in [event.get("event"), "*"]:
+            if key in self.callbacks:
+                self.callbacks[key](event)
+        return event
+
+    def __iter__(self):
+        while self.open_streams > 0:
+            event = self.dispatch(self.queue.get())
+            if event is not None:
+                yield event
+
+    def poll(self):
+        events = []
+        while self.open_streams > 0:
+            try:
+                event = self.dispatch(self.queue.get_nowait())
+            except queue.Empty:
+                break
+            if event is not None:
+                events.append(event)
+        return events
+
+    def finished(self):
+        return self.open_streams == 0
+
+
+def describe_event(event):
+
+    # Prints a human readable line for an event
+
+    kind = event["event"]
+    if kind == "log":
+        print(event["line"], file=(sys.stderr if event["stream"] == "stderr" else sys.stdout))
+    elif kind == "ingest":
+        print(f"Ingesting {event['rows']}\r", end='')
+    elif kind == "ingested":
+        print(f"Ingested {event['rows']},{event['columns']} from {event['file']}")
+    elif kind == "tree_start":
+        print(f"Computing tree {event['index']}")
+    elif kind == "tree":
+        if event.get("resumed"):
+            print(f"Kept tree {event['index']}")
+        else:
+            print(f"Finished tree {event['index']}: {event['nodes']} nodes in {event['seconds']:.1f}s")
+    elif kind == "finish":
+        print(f"Grew {event['trees']} trees in {event['seconds']:.1f}s")
+
+
+def empty_forest(input_counts, output_counts=None, ifh=None, ofh=None, header=None):
 
-    arg_list.extend([RUST_PATH, "-ic", location + "input.counts",
-                     "-oc", location + "output.counts", "-o", location + "tmp", "-auto"])
+    # A forest with no trees over in-memory matrices, equivalent to what load_from_rust reads back from write_inputs
+
+    if output_counts is None:
+        output_counts = input_counts
+
+    if header is not None:
+        ifh = header
+        ofh = header
+
+    if ifh is None:
+        ifh = np.arange(input_counts.shape[1], dtype=int)
+    if ofh is None:
+        ofh = np.arange(output_counts.shape[1], dtype=int)
+
+    return tr.Forest([], input=np.array(input_counts, dtype=float), output=np.array(output_counts, dtype=float),
+                     input_features=np.array(ifh).astype(str), output_features=np.array(ofh).astype(str))
+
+
+class TreeLoader:
+
+    """
+    Parses tree files into flat arrays in a pool of worker processes as rf_5 reports them
+    finished, so that loading a forest overlaps with fitting it. Trees are built and added to
+    the forest in tree index order once all are in, which gives the same node indices as
+    load_from_rust.
+    """
+
+    def __init__(self, forest, workers=None):
+        self.forest = forest
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.futures = {}
+
+    def submit(self, index, path):
+        self.futures[index] = self.executor.submit(forest_arrays.read_tree_file, path)
+
+    def finish(self):
+        tree_arrays = [self.futures[i].result() for i in sorted(self.futures)]
+        self.executor.shutdown()
+        self.forest.add_trees(
+            forest_arrays.build_trees(tree_arrays, self.forest))
+
+        if len(forest_arrays.unrepresented_samples(tree_arrays, len(self.forest.samples))) > 0:
+            print("WARNING, UNREPRESENTED SAMPLES")
+
+        return self.forest
+
+
+def rust_arguments(location, unsupervised=False, lrg_mem=False, prefix="tmp", shared=None, **kwargs):
+
+    # Builds the rf_5 command line for inputs written to location by write_inputs, or with
+    # the matrices in the shared memory segments of shared (a SharedInputs)
+
+    arg_list = [RUST_PATH]
+
+    if shared is None:
+        arg_list.extend(["-ic", location + "input.counts", "-oc", location + "output.counts"])
+    else:
+        arg_list.extend(shared.arguments())
+
+    arg_list.extend(["-o", location + prefix, "-auto"])
 
     for arg in kwargs.keys():
+        value = kwargs[arg]
+        # Rust only parses lowercase booleans
+        if isinstance(value, bool):
+            value = str(value).lower()
         arg_list.append("-" + str(arg))
-        arg_list.append(str(kwargs[arg]))
+        arg_list.append(str(value))
 
-    if lrg_mem is not None:
+    if lrg_mem:
         arg_list.append("-lrg_mem")
 
     if unsupervised:
         arg_list.append("-unsupervised")
 
-    print("Command: " + " ".join(arg_list))
+    return arg_list
 
-    with sp.Popen(arg_list, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True) as cp:
-        tree_count = 0
-        while True:
-            rc = cp.poll()
-            if rc is not None:
-                print(cp.stdout.read(), end='')
-                print(cp.stderr.read(), end='')
-                break
-            output = cp.stdout.readline()
-            if output[:6] == "Ingest":
-                print(output)
-            elif output[:9] == "Computing":
-                tree_count += 1
-                print(f"Computing tree {tree_count}")
-            else:
-                print(output)
 
-    return arg_list
+def fit_sharded(input_counts, shards=2, trees=100, cache=True, output_counts=None, ifh=None, ofh=None, header=None, lrg_mem=None, location=None, seed=None, numa=False, **kwargs):
+
+    """
+    Fit a random forest as several rf_5 processes on this machine. Each process (shard) grows a
+    contiguous range of tree indices. All shards share one seed, so the result is the forest a single
+    fit with that seed would give. This helps on boxes with many NUMA nodes, where one process per
+    node scales better than a single process with many threads.
+
+    Arguments are as for fit, plus:
+
+    shards: Number of rf_5 processes
+    trees: Total number of trees across all shards
+    seed: Seed shared by all shards, drawn at random if not given
+    numa: Pin shard i to NUMA node i (modulo the number of nodes) with numactl
+
+    Threads are split evenly across shards unless given explicitly. The output of each shard goes to
+    shard_i.log in the fit location.
+
+    To shard across machines instead, run rf_5 on each host with the same inputs and -seed, and
+    with -first_tree/-trees set to that host's range, then combine the outputs with tree_reader.Forest.merge.
+    """
+
+    if output_counts is None:
+        output_counts = input_counts
+        unsupervised = True
+    else:
+        unsupervised = False
+
+    tmp_dir = None
+    if location is None:
+        tmp_dir = tmp.TemporaryDirectory()
+        location = tmp_dir.name
+    location = location + "/"
+
+    write_inputs(location, input_counts, output_counts=output_counts, ifh=ifh, ofh=ofh, header=header)
+
+    if seed is None:
+        seed = np.random.randint(2**62)
+
+    if not any([t in kwargs for t in ['p', 'processors', 'threads']]):
+        kwargs['threads'] = max(1, (os.cpu_count() or 1) // shards)
+
+    numa_nodes = len(glob.glob("/sys/devices/system/node/node[0-9]*")) if numa else 0
+
+    ranges = [r for r in np.array_split(np.arange(trees), shards) if len(r) > 0]
+
+    processes = []
+    shard_arguments = []
+    for i, shard in enumerate(ranges):
+        arg_list = rust_arguments(location, unsupervised=unsupervised, lrg_mem=lrg_mem, prefix=f"shard_{i}",
+                                  ifh=(location + "tmp.ifh"), ofh=(location + "tmp.ofh"),
+                                  trees=len(shard), first_tree=int(shard[0]), seed=seed, **kwargs)
+        shard_arguments.append(arg_list)
+        if numa_nodes > 0:
+            node = i % numa_nodes
+            arg_list = ["numactl", f"--cpunodebind={node}", f"--membind={node}"] + arg_list
+        print(f"Shard {i}: trees {shard[0]} to {shard[-1]}")
+        log = open(location + f"shard_{i}.log", "w")
+        processes.append((sp.Popen(arg_list, stdin=sp.DEVNULL, stdout=log, stderr=sp.STDOUT), log))
+
+    failed = []
+    for i, (process, log) in enumerate(processes):
+        if process.wait() != 0:
+            failed.append(i)
+        log.close()
+
+    if len(failed) > 0:
+        for i in failed:
+            print(open(location + f"shard_{i}.log").read())
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+        raise Exception(f"Shards {failed} failed")
+
+    forest = tr.Forest.load_from_rust(location, prefix="shard", ifh="tmp.ifh", ofh="tmp.ofh",
+                                      clusters="tmp.clusters", input="input.counts", output="output.counts")
+
+    forest.set_cache(cache)
+
+    forest.arguments = shard_arguments[0]
+    forest.shard_arguments = shard_arguments
+
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+    return forest
+
+
+# Switches that rust takes without a value, and arguments that take several
+
+SWITCHES = ["-auto", "-unsupervised", "-lrg_mem", "-low_memory"]
+
+MULTIPLE = {"-input_shm": 3, "-output_shm": 3}
+
+
+def arguments_to_kwargs(arguments):
+
+    """
+    Inverts inner_fit: turns a stored argument list back into the keyword arguments that produced it.
+    Switches map to True. The binary path is dropped.
+    """
+
+    kwargs = {}
+    i = 1
+    while i < len(arguments):
+        key = arguments[i]
+        if key in SWITCHES:
+            kwargs[key[1:]] = True
+            i += 1
+        elif key in MULTIPLE:
+            kwargs[key[1:]] = arguments[i + 1:i + 1 + MULTIPLE[key]]
+            i += 1 + MULTIPLE[key]
+        else:
+            kwargs[key[1:]] = arguments[i + 1]
+            i += 2
+    return kwargs
 
 
 if __name__ == "__main__":
@@ -1,10 +1,13 @@
 import numpy as np
-from copy import copy, deepcopy
+from copy import deepcopy
 
 # RELINT THIS
 
 class Node:
 
+    # Nodes pickled before full statistics existed fall back on this
+    full_statistics = False
+
     def __init__(self, node_json, tree, forest, parent=None, cache=False, lr=None, level=0):
 
 
@@ -33,6 +36,14 @@ class Node:
         if 'medians' in node_json:
             if node_json['medians'] is not None:
                 self.median_cache = np.array(node_json['medians'])
+        # With full_statistics rf_5 computes statistics over every sample of every node, leaves
+        # included, rather than over the bootstrap of a split, so they can be used as they are
+        self.full_statistics = 'population' in node_json
+        if self.full_statistics:
+            self.srs_cache = np.array(node_json['ssr'])
+            self.pop_cache = node_json['population']
+        # Dispersion removed by this node's split, as measured by rf_5 on its bootstrap
+        self.gain = node_json.get('gain')
         self.weights = np.ones(len(self.forest.output_features))
         self.children = []
         self.child_clusters = ([], [])
@@ -48,6 +59,51 @@ class Node:
             self.local_samples = node_json['samples']
             # pass
 
+    @classmethod
+    def from_arrays(cls, columns, i, tree, forest, children, cache=False):
+
+        """
+        Builds node i of a tree from the arrays of forest_arrays.flatten_tree, with its children
+        already built. Gives the same node as unpacking the json, without the recursion.
+
+        Columns are the tree's arrays, with the one dimensional ones as lists (see
+        Tree.from_arrays), since indexing lists is much faster than indexing numpy arrays.
+        """
+
+        node = cls.__new__(cls)
+        node.cache = cache
+        node.tree = tree
+        node.forest = forest
+        node.parent = None
+        node.lr = None
+        node.level = 0
+        if columns['has_filter'][i]:
+            start, end = columns['filter_indptr'][i:i + 2]
+            node.filter = Filter.from_arrays(
+                columns['filter_features'][start:end], columns['filter_scores'][start:end], columns['filter_means'][start:end], columns['split'][i], columns['orientation'][i], node)
+        else:
+            node.filter = Filter(None, node)
+        node.local_samples = None
+        if columns['has_means'][i]:
+            node.mean_cache = columns['means'][i]
+            node.median_cache = columns['medians'][i]
+        node.full_statistics = 'population' in columns
+        if node.full_statistics:
+            node.srs_cache = columns['ssr'][i]
+            node.pop_cache = columns['population'][i]
+        gain = columns['gain'][i]
+        node.gain = None if gain != gain else gain
+        node.weights = np.ones(len(forest.output_features))
+        node.children = children
+        node.child_clusters = ([], [])
+        for lr, child in enumerate(children):
+            child.parent = node
+            child.lr = lr
+        if len(children) < 1:
+            start, end = columns['samples_indptr'][i:i + 2]
+            node.local_samples = columns['samples'][start:end]
+        return node
+
     # Two nodes used for testing, not relevant for normal operation
 
     def null():
@@ -96,15 +152,21 @@ class Node:
             nodes.append(child)
         return nodes
 
+    def cached(self, quantity, compute):
+
+        # Values that can be recomputed from the counts are cached by the forest's cache
+        # manager (see cache.py) when caching is on, computed with compute() otherwise
+
+        if not self.cache or self.forest is None:
+            return compute()
+        return self.forest.caches().get(quantity, self, compute)
+
     def encoding(self):
-        if self.cache:
-            if hasattr(self, 'encoding_cache'):
-                return self.encoding_cache
-        encoding = np.zeros(len(self.forest.samples), dtype=bool)
-        encoding[self.samples()] = True
-        if self.cache:
-            self.encoding_cache = encoding
-        return encoding
+        def compute():
+            encoding = np.zeros(len(self.forest.samples), dtype=bool)
+            encoding[self.samples()] = True
+            return encoding
+        return self.cached('encoding', compute)
 
     def sample_mask(self):
         # Alias of encoding
@@ -130,39 +192,32 @@ class Node:
         medians = np.median(counts, axis=0)
         srs = np.sum(np.power(counts - means, 2), axis=0)
 
-        self.mean_cache = means
-        self.median_cache = medians
-        self.srs_cache = srs
+        caches = self.forest.caches()
+        caches.put('means', self, means)
+        caches.put('medians', self, medians)
+        caches.put('srs', self, srs)
 
         for child in self.children:
             additive_mean = child.means() - means
-            child.additive_mean_cache = additive_mean
+            caches.put('additive_mean', child, additive_mean)
 
     def medians(self):
 
         # Medians of all features in this node. Relies on node_counts
 
-        if self.cache:
+        if self.cache or self.full_statistics:
             if hasattr(self, 'median_cache'):
                 return self.median_cache
-        matrix = self.node_counts()
-        medians = np.median(matrix, axis=0)
-        if self.cache:
-            self.median_cache = medians
-        return medians
+        return self.cached('medians', lambda: np.median(self.node_counts(), axis=0))
 
     def means(self):
 
         # Means of all features within this node. Relies on node_counts
 
-        if self.cache:
+        if self.cache or self.full_statistics:
             if hasattr(self, 'mean_cache'):
                 return self.mean_cache
-        matrix = self.node_counts()
-        means = np.mean(matrix, axis=0)
-        if self.cache:
-            self.mean_cache = means
-        return means
+        return self.cached('means', lambda: np.mean(self.node_counts(), axis=0))
 
     def feature_median(self, feature):
 
@@ -304,12 +359,7 @@ class Node:
     def squared_residual_sum(self):
         if hasattr(self, 'srs_cache'):
             return self.srs_cache
-        else:
-            squared_residuals = np.power(self.mean_residuals(), 2)
-            srs = np.sum(squared_residuals, axis=0)
-            if self.cache:
-                self.srs_cache = srs
-            return srs
+        return self.cached('srs', lambda: np.sum(np.power(self.mean_residuals(), 2), axis=0))
 
     def squared_residual_doublet(self):
 
@@ -338,20 +388,13 @@ class Node:
         # Dispersions of this node. currently hardcoded for L2 norm relative
         # to central tendency
 
-        if self.cache:
-            if hasattr(self, 'dispersion_cache'):
-                return self.dispersion_cache
-
         if mode == 'mean':
-            residuals = self.mean_residuals()
+            residuals = self.mean_residuals
         elif mode == 'median':
-            residuals = self.median_residuals()
+            residuals = self.median_residuals
         else:
             raise Exception(f"Mode not recognized:{mode}")
-        dispersions = np.mean(np.power(residuals, 2),axis=0)
-        if self.cache:
-            self.dispersion_cache = dispersions
-        return dispersions
+        return self.cached(f'{mode}_dispersions', lambda: np.mean(np.power(residuals(), 2), axis=0))
 
     def mean_error_ratio(self):
 
@@ -375,33 +418,20 @@ class Node:
         # Gains in dispersion relative to the root of the tree this node belongs to.
         # Only works if dispersions are of the summation type (eg sum of squared errors etc)
 
-        if self.cache:
-            if hasattr(self, 'absolute_gain_cache'):
-                return self.absolute_gain_cache
-        own_dispersions = self.dispersions()
-        root_dispersions = self.root().dispersions()
-        gains = root_dispersions - own_dispersions
-        if self.cache:
-            self.absolute_gain_cache = gains
-        return gains
+        return self.cached('absolute_gains', lambda: self.root().dispersions() - self.dispersions())
 
     def local_gains(self):
 
         # Gains in dispersion relative to the parent node.
         # As above, only works for summation-type errors like SSME
 
-        if self.cache:
-            if hasattr(self, 'local_gain_cache'):
-                return self.local_gain_cache
-        if self.parent is not None:
-            parent_dispersions = self.parent.dispersions()
-        else:
-            parent_dispersions = self.dispersions()
-        own_dispersions = self.dispersions()
-        gains = parent_dispersions - own_dispersions
-        if self.cache:
-            self.local_gain_cache = gains
-        return gains
+        def compute():
+            if self.parent is not None:
+                parent_dispersions = self.parent.dispersions()
+            else:
+                parent_dispersions = self.dispersions()
+            return parent_dispersions - self.dispersions()
+        return self.cached('local_gains', compute)
 
     def additive_gains(self):
 
@@ -412,18 +442,13 @@ class Node:
         # FROM THE SAME TREE that this sample belongs to, then summing the additive gains of
         # all nodes produces a prediction for that sample.
 
-        if self.cache:
-            if hasattr(self, 'additive_cache'):
-                return self.additive_cache
-        if self.parent is not None:
-            parent_medians = self.parent.medians()
-        else:
-            parent_medians = np.zeros(len(self.forest.output_features))
-        own_medians = self.medians()
-        additive = own_medians - parent_medians
-        if self.cache:
-            self.additive_cache = additive
-        return additive
+        def compute():
+            if self.parent is not None:
+                parent_medians = self.parent.medians()
+            else:
+                parent_medians = np.zeros(len(self.forest.output_features))
+            return self.medians() - parent_medians
+        return self.cached('additive', compute)
 
     def additive_mean_gains(self):
 
@@ -434,19 +459,13 @@ class Node:
         # FROM THE SAME TREE that this sample belongs to, then summing the additive gains of
         # all nodes produces a prediction for that sample.
 
-        if self.cache:
-            if hasattr(self, 'additive_mean_cache'):
-                return self.additive_mean_cache
-
-        if self.parent is not None:
-            parent_means = self.parent.means()
-        else:
-            parent_means = np.zeros(len(self.forest.output_features))
-        own_means = self.means()
-        additive = own_means - parent_means
-        if self.cache:
-            self.additive_mean_cache = additive
-        return additive
+        def compute():
+            if self.parent is not None:
+                parent_means = self.parent.means()
+            else:
+                parent_means = np.zeros(len(self.forest.output_features))
+            return self.means() - parent_means
+        return self.cached('additive_mean', compute)
 
     def feature_additive(self, feature):
 
@@ -684,23 +703,19 @@ class Node:
         # each sample cluster. Allows us to test if node clusters and sample clusters have a
         # correspondence
 
-        if self.cache:
-            if hasattr(self, 'sample_cluster_cache'):
-                return self.sample_cluster_cache
-
-        sample_clusters = self.forest.sample_cluster_encoding.T[self.samples(
-        )].T
-        sample_cluster_means = np.mean(sample_clusters, axis=1)
-
-        if self.cache:
-            self.sample_cluster_cache = sample_cluster_means
-
-        return sample_cluster_means
+        def compute():
+            sample_clusters = self.forest.sample_cluster_encoding.T[self.samples()].T
+            return np.mean(sample_clusters, axis=1)
+        return self.cached('sample_cluster_means', compute)
 
     def reset_cache(self):
 
         # Resets the cache values for various things.
         # Save memory, avoid errors when you add/remove output features
+        # Drops this node's values from the cache manager, and the statistics rf_5 gave it
+
+        if self.forest is not None and hasattr(self.forest, 'cache_manager'):
+            self.forest.cache_manager.discard(self)
 
         possible_caches = [
             "absolute_gain_cache",
@@ -710,6 +725,8 @@ class Node:
             "median_cache",
             "dispersion_cache",
             "mean_cache",
+            "srs_cache",
+            "pop_cache",
             "encoding_cache",
             "weighted_prediction_cache"
         ]
@@ -720,43 +737,34 @@ class Node:
             except:
                 continue
 
+        self.full_statistics = False
+
     def derive_samples(self, samples):
 
-        if self.local_samples is not None:
-            self_copy = self.derived_copy()
-            restricted = [s for s in self_copy.local_samples if s in samples]
-            self_copy.local_samples = restricted
-            return self_copy
+        # A copy of this node and its descendants holding only samples, with splits left
+        # without samples on one side turned into leaves (see forest_arrays.derive_samples)
 
-        child_copies = []
+        from rusty_axe.forest_arrays import derive_nodes
+        derived, originals = derive_nodes(self.nodes() + [self, ], samples, self.forest)
+        for node, original in zip(derived.nodes(), originals):
+            node.derived_from(original)
+            node.tree = None
+        return derived.root
 
-        for child in self.children:
-            child_copies.append(child.derive_samples(samples))
+    def derived_from(self, original):
 
-        if len(child_copies[0].samples()) < 1 or len(child_copies[1].samples()) < 1:
-            self_copy = self.derived_copy()
-            restricted = [s for s in self.samples() if s in samples]
-            self_copy.local_samples = restricted
-            return self_copy
-        else:
-            self_copy = self.derived_copy()
-            self_copy.children = child_copies
-            for child in self_copy.children:
-                child.parent = self_copy
-            return self_copy
-
-    def derived_copy(self):
-        self_copy = copy(self)
-        self_copy.forest = None
-        self_copy.tree = None
-        self_copy.parent = None
-        self_copy.children = []
-        self_copy.filter = self.filter.derived_copy()
-        self_copy.filter.node = self_copy
-        self_copy.local_samples = deepcopy(self.local_samples)
-        self_copy.child_clusters = deepcopy(self.child_clusters)
-        self_copy.reset_cache()
-        return self_copy
+        # Takes over what a derived node keeps of the node it was derived from besides the
+        # structure and samples. Statistics don't hold for the new samples, so they're left out
+
+        self.forest = None
+        self.cache = original.cache
+        self.level = original.level
+        self.lr = original.lr
+        self.weights = original.weights.copy()
+        self.child_clusters = deepcopy(original.child_clusters)
+        for attribute in ('index', 'split_cluster', 'leaf_cluster'):
+            if hasattr(original, attribute):
+                setattr(self, attribute, getattr(original, attribute))
 
 
 class Filter:
@@ -777,10 +785,14 @@ class Filter:
             print(filter_json)
             raise Exception
 
-    def derived_copy(self):
-        self_copy = copy(self)
-        self_copy.node = None
-        return self_copy
+    @classmethod
+    def from_arrays(cls, features, scores, means, split, orientation, node):
+        self = cls.__new__(cls)
+        self.node = node
+        self.reduction = Reduction.from_arrays(features, scores, means)
+        self.split = split
+        self.orientation = orientation
+        return self
 
     def feature(self):
         if len(self.reduction.features) == 1:
@@ -815,6 +827,14 @@ class Reduction:
             self.scores = reduction_json['scores']
             self.means = reduction_json['means']
 
+    @classmethod
+    def from_arrays(cls, features, scores, means):
+        self = cls.__new__(cls)
+        self.features = features
+        self.scores = scores
+        self.means = means
+        return self
+
     def score_sample(self, sample):
         compound_score = 0
         for feature, feature_score, feature_mean in zip(self.features, self.scores, self.means):
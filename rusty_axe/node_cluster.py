@@ -36,15 +36,16 @@ class NodeCluster:
         return self.forest.node_sample_encoding(self.nodes)
 
     def node_mask(self):
-        mask = np.zeros(len(self.forest.nodes()), dtype=bool)
+        mask = np.zeros(self.forest.registry().size, dtype=bool)
         indices = [n.index for n in self.nodes]
         mask[indices] = True
         return mask
 
     def parent_mask(self):
-        mask = np.zeros(len(self.forest.nodes()), dtype=bool)
-        parents = [p.index for p in self.parents()]
-        mask[parents] = True
+        registry = self.forest.registry()
+        mask = np.zeros(registry.size, dtype=bool)
+        parents = registry.parent[[n.index for n in self.nodes]]
+        mask[parents[parents >= 0]] = True
         return mask
 
     def sisters(self):
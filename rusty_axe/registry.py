@@ -0,0 +1,258 @@
+import numpy as np
+
+from rusty_axe.forest_arrays import gather
+
+
+class NodeRegistry:
+
+    """
+    The nodes of a forest, traversed once, with index arrays describing them.
+
+    nodes is every node in the order Forest.nodes() returns them, which is also the order of
+    node.index, so the arrays below can be indexed by node.index:
+
+    level: depth of each node, 0 for roots
+    leaf: whether the node has no children
+    tree: index of the tree the node belongs to
+    parent: index of the parent, -1 for roots
+    sister: index of the sister, -1 for roots
+
+    Leaves, stems and levels are worked out once per argument and kept, in the same order the
+    traversals in Tree and Node return them. The registry describes the trees as they were when
+    it was built, so it has to be invalidated whenever their structure changes (see
+    Forest.invalidate_registry).
+    """
+
+    def __init__(self, trees):
+        self.trees = trees
+        self.tree_count = len(trees)
+
+        nodes = []
+        tree = []
+        for t, forest_tree in enumerate(trees):
+            tree_nodes = forest_tree.nodes()
+            nodes.extend(tree_nodes)
+            tree.extend([t] * len(tree_nodes))
+
+        self.nodes = nodes
+        self.size = len(nodes)
+        self.positions = {id(node): i for i, node in enumerate(nodes)}
+
+        self.level = np.array([node.level for node in nodes], dtype=np.int64)
+        self.leaf = np.array([len(node.children) < 1 for node in nodes], dtype=bool)
+        self.tree = np.array(tree, dtype=np.int64)
+        self.parent = self.lookup([node.parent for node in nodes])
+        self.sister = self.lookup([node.sister() for node in nodes])
+        self.root = self.parent < 0
+
+        self.memo = {}
+
+    def valid(self, trees):
+        # Replacing or appending to the trees of a forest makes its registry stale
+        return trees is self.trees and len(trees) == self.tree_count
+
+    def lookup(self, nodes):
+        """
+        Indices of nodes, -1 for None
+        """
+        return np.array([-1 if node is None else self.positions[id(node)] for node in nodes], dtype=np.int64)
+
+    def select(self, mask):
+        return [self.nodes[i] for i in np.flatnonzero(mask)]
+
+    def memoized(self, key, compute):
+        if key not in self.memo:
+            self.memo[key] = compute()
+        return self.memo[key]
+
+    def where(self, level=None, leaf=None, tree=None, cluster=None):
+
+        """
+        Indices of the nodes matching every criterion given. Levels, trees and clusters may be a
+        single value or a list of them. Split clusters can be reassigned without changing the
+        structure, so they're read from the nodes each time.
+        """
+
+        mask = np.ones(self.size, dtype=bool)
+        if level is not None:
+            mask &= np.isin(self.level, level)
+        if leaf is not None:
+            mask &= self.leaf == leaf
+        if tree is not None:
+            mask &= np.isin(self.tree, tree)
+        if cluster is not None:
+            mask &= np.isin(self.split_labels(), cluster)
+        return np.flatnonzero(mask)
+
+    def split_labels(self):
+        return np.array([getattr(node, 'split_cluster', -1) for node in self.nodes], dtype=np.int64)
+
+    def select_nodes(self, root=True, depth=None):
+        def compute():
+            mask = np.ones(self.size, dtype=bool)
+            if not root:
+                mask &= ~self.root
+            if depth is not None:
+                mask &= self.level <= depth
+            return self.select(mask)
+        return self.memoized(('nodes', root, depth), compute)
+
+    def leaves(self, depth=None):
+        def compute():
+            leaves = []
+            for tree in self.trees:
+                leaves.extend(tree.leaves(depth=depth))
+            return leaves
+        return self.memoized(('leaves', depth), compute)
+
+    def stems(self, depth=None):
+        def compute():
+            mask = ~self.root & ~self.leaf
+            if depth is not None:
+                mask &= self.level <= depth
+            return self.select(mask)
+        return self.memoized(('stems', depth), compute)
+
+    def level_nodes(self, target):
+        return self.memoized(('level', target), lambda: self.select(self.level == target))
+
+    def column_statistics(self, values):
+        return ColumnStatistics(self, values)
+
+
+class ColumnStatistics:
+
+    """
+    Node statistics of extra output columns (values is samples x columns), for every node of a
+    registry at once and in node.index order, as Node would compute them from the counts.
+
+    Populations, sums and sums of squares are summed over the samples of each leaf and then added
+    up the trees a level at a time. Every other quantity follows from those except medians, which
+    are taken over the leaf samples below each node, a level at a time, and only if asked for.
+    """
+
+    def __init__(self, registry, values):
+        self.registry = registry
+        self.values = values
+        self.memo = {}
+
+        leaves = np.flatnonzero(registry.leaf)
+        samples = [np.unique(np.array(registry.nodes[i].samples(), dtype=int)) for i in leaves]
+        ids = np.repeat(leaves, [len(s) for s in samples])
+        samples = np.concatenate(samples + [np.zeros(0, dtype=int)])
+
+        size = registry.size
+        self.leaves = leaves
+        self.samples = samples
+        self.population = np.bincount(ids, minlength=size).astype(float)
+        self.sums = np.array([np.bincount(ids, weights=column, minlength=size)
+                              for column in values[samples].T]).T.reshape((size, values.shape[1]))
+        self.squares = np.array([np.bincount(ids, weights=column ** 2, minlength=size)
+                                 for column in values[samples].T]).T.reshape((size, values.shape[1]))
+
+        # Children are finished before their parents by going up from the deepest level
+
+        for level in range(registry.level.max(initial=0), 0, -1):
+            children = np.flatnonzero((registry.level == level) & ~registry.root)
+            parents = registry.parent[children]
+            np.add.at(self.population, parents, self.population[children])
+            np.add.at(self.sums, parents, self.sums[children])
+            np.add.at(self.squares, parents, self.squares[children])
+
+    def get(self, quantity):
+        if quantity not in self.memo:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self.memo[quantity] = getattr(self, quantity)()
+        return self.memo[quantity]
+
+    def per_node(self, array):
+        return array / self.population[:, None]
+
+    def parental(self, array, root_value):
+        # The value of each node's parent, root_value for roots
+        parental = array[np.maximum(self.registry.parent, 0)]
+        parental[self.registry.root] = root_value[self.registry.root]
+        return parental
+
+    def means(self):
+        return self.per_node(self.sums)
+
+    def medians(self):
+
+        # The leaves below a node are a contiguous run of the leaves in node.index order, so its
+        # samples are a contiguous run of self.samples. Runs of the nodes of one level don't
+        # overlap, so each level is sorted within its runs at once.
+
+        registry = self.registry
+        first = np.full(registry.size, registry.size, dtype=np.int64)
+        last = np.full(registry.size, -1, dtype=np.int64)
+        first[self.leaves] = np.arange(len(self.leaves))
+        last[self.leaves] = np.arange(len(self.leaves))
+        for level in range(registry.level.max(initial=0), 0, -1):
+            children = np.flatnonzero((registry.level == level) & ~registry.root)
+            np.minimum.at(first, registry.parent[children], first[children])
+            np.maximum.at(last, registry.parent[children], last[children])
+
+        offsets = np.concatenate([[0], np.cumsum(self.population[self.leaves])]).astype(np.int64)
+        medians = np.full(self.sums.shape, np.nan)
+        for level in range(registry.level.max(initial=0) + 1):
+            nodes = np.flatnonzero((registry.level == level) & (last >= 0))
+            starts = offsets[first[nodes]]
+            lengths = offsets[last[nodes] + 1] - starts
+            nodes, starts, lengths = nodes[lengths > 0], starts[lengths > 0], lengths[lengths > 0]
+            if len(nodes) < 1:
+                continue
+            # Sorting run * samples + rank sorts by run, then by value within each run
+            keys = np.repeat(np.arange(len(nodes)), lengths) * len(self.values)
+            samples = self.samples[gather(starts, starts + lengths)]
+            bounds = np.cumsum(lengths) - lengths
+            for j, (order, ranks) in enumerate(self.ranks()):
+                ordered = self.values[order[np.sort(keys + ranks[samples]) % len(self.values)], j]
+                medians[nodes, j] = (ordered[bounds + (lengths - 1) // 2] + ordered[bounds + lengths // 2]) / 2
+        return medians
+
+    def ranks(self):
+        # For each column, the samples in ascending order of value and the rank of each sample
+        if 'ranks' not in self.memo:
+            ranks = []
+            for column in self.values.T:
+                order = np.argsort(column, kind='stable')
+                rank = np.empty(len(order), dtype=np.int64)
+                rank[order] = np.arange(len(order))
+                ranks.append((order, rank))
+            self.memo['ranks'] = ranks
+        return self.memo['ranks']
+
+    def srs(self):
+        return self.squares - self.sums * self.get('means')
+
+    def mean_dispersions(self):
+        return self.per_node(self.get('srs'))
+
+    def median_dispersions(self):
+        medians = self.get('medians')
+        return self.per_node(self.squares - 2 * medians * self.sums + self.population[:, None] * medians ** 2)
+
+    def absolute_gains(self):
+        dispersions = self.get('mean_dispersions')
+        roots = np.flatnonzero(self.registry.root)
+        return dispersions[roots[self.registry.tree]] - dispersions
+
+    def local_gains(self):
+        dispersions = self.get('mean_dispersions')
+        return self.parental(dispersions, dispersions) - dispersions
+
+    def additive(self):
+        medians = self.get('medians')
+        return medians - self.parental(medians, np.zeros(medians.shape))
+
+    def additive_mean(self):
+        means = self.get('means')
+        return means - self.parental(means, np.zeros(means.shape))
+
+    def explained(self):
+        # The sum of squared additive means of the nodes below each root, by tree
+        squared = np.power(self.get('additive_mean'), 2)
+        explained = np.zeros((len(self.registry.trees), squared.shape[1]))
+        np.add.at(explained, self.registry.tree[~self.registry.root], squared[~self.registry.root])
+        return explained[self.registry.tree]
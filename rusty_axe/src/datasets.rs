@@ -0,0 +1,148 @@
+use ndarray::prelude::*;
+use rand::prelude::*;
+use rand::rngs::StdRng;
+
+use crate::random_forest::tree_seed;
+
+// Synthetic data with a known nested factor structure, the counterpart of rusty_axe.datasets
+// for benches and tests. The two generators share the model but not their random streams.
+//
+// Samples belong to a leaf of a balanced tree of clusters. Every cluster at every level has a
+// sparse loading over the features scaled by effect * decay^level, and a sample is the sum of
+// the loadings on the path to its leaf plus gaussian noise. Values can then be zero inflated
+// (sparsity is the fraction dropped to zero) and rounded to a resolution, which produces ties.
+// Chunks are seeded from the seed and their index, so any chunk can be drawn on its own.
+
+#[derive(Clone,Debug)]
+pub struct Hierarchy {
+    pub features: usize,
+    pub depth: usize,
+    pub branching: usize,
+    pub noise: f64,
+    pub sparsity: f64,
+    pub resolution: Option<f64>,
+    seed: u64,
+    loadings: Vec<Array2<f64>>,
+}
+
+impl Hierarchy {
+
+    pub fn new(features:usize,depth:usize,branching:usize,effect:f64,decay:f64,density:f64,seed:u64) -> Hierarchy {
+        let mut rng = StdRng::seed_from_u64(seed);
+        let loadings = (0..depth).map(|level| {
+            let clusters = branching.pow(level as u32 + 1);
+            let scale = effect * decay.powi(level as i32);
+            Array2::from_shape_fn((clusters,features),|_| {
+                if rng.gen::<f64>() < density { standard_normal(&mut rng) * scale } else { 0. }
+            })
+        }).collect();
+        Hierarchy {
+            features,
+            depth,
+            branching,
+            noise: 1.,
+            sparsity: 0.,
+            resolution: None,
+            seed,
+            loadings,
+        }
+    }
+
+    pub fn leaves(&self) -> usize {
+        self.branching.pow(self.depth as u32)
+    }
+
+    // Cluster of a leaf at a level, 0 being the first split
+
+    pub fn label(&self, leaf:usize, level:usize) -> usize {
+        leaf / self.branching.pow((self.depth - level - 1) as u32)
+    }
+
+    pub fn loadings(&self, level:usize) -> ArrayView2<f64> {
+        self.loadings[level].view()
+    }
+
+    // The index-th chunk of the dataset: a samples x features matrix and the leaf of each sample
+
+    pub fn chunk(&self, index:usize, samples:usize) -> (Array2<f64>,Vec<usize>) {
+        let mut rng = StdRng::seed_from_u64(tree_seed(self.seed,index));
+        let leaves: Vec<usize> = (0..samples).map(|_| rng.gen_range(0..self.leaves())).collect();
+        let mut values = Array2::zeros((samples,self.features));
+        for (mut row,&leaf) in values.axis_iter_mut(Axis(0)).zip(leaves.iter()) {
+            for v in row.iter_mut() {
+                *v = standard_normal(&mut rng) * self.noise;
+            }
+            for level in 0..self.depth {
+                row += &self.loadings[level].row(self.label(leaf,level));
+            }
+            for v in row.iter_mut() {
+                if self.sparsity > 0. && rng.gen::<f64>() < self.sparsity {
+                    *v = 0.;
+                }
+                else if let Some(resolution) = self.resolution {
+                    *v = (*v / resolution).round() * resolution;
+                }
+            }
+        }
+        (values,leaves)
+    }
+
+    pub fn matrix(&self, samples:usize, chunk_size:usize) -> (Array2<f64>,Vec<usize>) {
+        let mut values = Array2::zeros((0,self.features));
+        let mut leaves = Vec::with_capacity(samples);
+        for (index,start) in (0..samples).step_by(chunk_size).enumerate() {
+            let (chunk,chunk_leaves) = self.chunk(index,chunk_size.min(samples - start));
+            values.append(Axis(0),chunk.view()).unwrap();
+            leaves.extend(chunk_leaves);
+        }
+        (values,leaves)
+    }
+
+}
+
+// Box-Muller, to avoid depending on rand_distr for one distribution
+
+fn standard_normal<R:Rng>(rng:&mut R) -> f64 {
+    let u1: f64 = 1. - rng.gen::<f64>();
+    let u2: f64 = rng.gen::<f64>();
+    (-2. * u1.ln()).sqrt() * (2. * std::f64::consts::PI * u2).cos()
+}
+
+#[cfg(test)]
+mod dataset_tests {
+
+    use super::*;
+
+    #[test]
+    fn hierarchy_chunks_reproduce() {
+        let hierarchy = Hierarchy::new(20,3,2,2.,0.5,0.2,7);
+        let (a,a_leaves) = hierarchy.matrix(250,100);
+        let (b,b_leaves) = hierarchy.matrix(250,100);
+        assert_eq!(a.dim(),(250,20));
+        assert_eq!(a,b);
+        assert_eq!(a_leaves,b_leaves);
+        let (chunk,_) = hierarchy.chunk(2,50);
+        assert_eq!(chunk,a.slice(s![200..,..]));
+    }
+
+    #[test]
+    fn hierarchy_labels_nest() {
+        let hierarchy = Hierarchy::new(5,3,2,1.,0.5,0.5,0);
+        assert_eq!(hierarchy.leaves(),8);
+        assert_eq!(hierarchy.label(5,0),1);
+        assert_eq!(hierarchy.label(5,1),2);
+        assert_eq!(hierarchy.label(5,2),5);
+    }
+
+    #[test]
+    fn hierarchy_sparsity_and_ties() {
+        let mut hierarchy = Hierarchy::new(50,2,3,2.,0.5,0.2,1);
+        hierarchy.sparsity = 0.8;
+        hierarchy.resolution = Some(1.);
+        let (values,_) = hierarchy.matrix(1000,1000);
+        let zeros = values.iter().filter(|v| **v == 0.).count() as f64 / values.len() as f64;
+        assert!(zeros > 0.75);
+        assert!(values.iter().all(|v| v.fract() == 0.));
+    }
+
+}
@@ -0,0 +1,71 @@
+use std::fs::read_to_string;
+use std::sync::OnceLock;
+use std::time::Instant;
+
+use serde_json::{Value,Map};
+
+// Progress is reported as newline delimited JSON on stdout. Every event is a single JSON object
+// on its own line, tagged with its kind under "event" and stamped with the seconds since the run
+// started under "time". Free text may still be interleaved; readers should treat any line that
+// isn't a JSON object as a log line.
+//
+// Events:
+//  ingest      {file, rows}                          every 1000 rows of a text matrix
+//  ingested    {file, rows, columns}
+//  prototype   {bytes}
+//  tree_start  {index}
+//  tree        {index, path, nodes, leaves, oob, seconds, peak_rss} or {index, path, resumed} for kept trees
+//  importances {path}
+//  finish      {trees, seconds, peak_rss}
+//  profile     {path}                                when -profile true
+
+static START: OnceLock<Instant> = OnceLock::new();
+
+pub fn start() {
+    START.get_or_init(Instant::now);
+}
+
+pub fn elapsed() -> f64 {
+    START.get_or_init(Instant::now).elapsed().as_secs_f64()
+}
+
+pub fn emit(event: &str, fields: Value) {
+    let mut map = match fields {
+        Value::Object(map) => map,
+        _ => Map::new(),
+    };
+    map.insert("event".to_string(),Value::from(event));
+    map.insert("time".to_string(),Value::from(elapsed()));
+    // println! holds the stdout lock for the whole line, so events from different threads never interleave
+    println!("{}",Value::Object(map));
+}
+
+// Peak resident set size of this process in bytes, where the platform reports it
+
+pub fn peak_rss() -> Option<u64> {
+    let status = read_to_string("/proc/self/status").ok()?;
+    let line = status.lines().find(|l| l.starts_with("VmHWM:"))?;
+    let kilobytes = line.split_whitespace().nth(1)?.parse::<u64>().ok()?;
+    Some(kilobytes * 1024)
+}
+
+#[cfg(test)]
+mod event_tests {
+
+    use super::*;
+
+    #[test]
+    fn peak_rss_is_reported() {
+        if cfg!(target_os = "linux") {
+            assert!(peak_rss().unwrap() > 0);
+        }
+    }
+
+    #[test]
+    fn elapsed_is_monotone() {
+        start();
+        let first = elapsed();
+        assert!(elapsed() >= first);
+    }
+
+}
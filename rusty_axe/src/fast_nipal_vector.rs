@@ -43,10 +43,10 @@ impl Projector {
         projector
     }
 
-    pub fn calculate_projection(
+    pub fn calculate_projection<R: Rng>(
         &mut self,
+        rng: &mut R,
     ) -> Option<(Array1<f64>, Array1<f64>, Array1<f64>, Array1<f64>)> {
-        let mut rng = thread_rng();
         self.weights = Array::from_iter((0..self.weights.dim()).map(|_| rng.gen::<f64>()));
         self.loadings = Array::from_iter((0..self.loadings.dim()).map(|_| rng.gen::<f64>()));
         // self.weights.fill(1.);
@@ -98,13 +98,13 @@ impl Projector {
         ))
     }
 
-    pub fn calculate_n_projections(mut self, n: usize) -> Option<Projection> {
+    pub fn calculate_n_projections<R: Rng>(mut self, n: usize, rng: &mut R) -> Option<Projection> {
         let mut loadings = Array2::zeros((n, self.array.dim().0));
         let mut weights = Array2::zeros((n, self.array.dim().1));
         let mut means = Array2::zeros((n, self.array.dim().1));
         let mut scale_factors = Array2::zeros((n, self.array.dim().0));
         for i in 0..n {
-            let (n_loadings, n_scores, n_means, n_scale_factors) = self.calculate_projection()?;
+            let (n_loadings, n_scores, n_means, n_scale_factors) = self.calculate_projection(rng)?;
             loadings.row_mut(i).assign(&n_loadings);
             weights.row_mut(i).assign(&n_scores);
             means.row_mut(i).assign(&n_means);
@@ -129,9 +129,9 @@ pub struct Projection {
     pub scale_factors: Array2<f64>,
 }
 
-pub fn project(arr: Array2<f64>, n: usize) -> Option<Projection> {
+pub fn project<R: Rng>(arr: Array2<f64>, n: usize, rng: &mut R) -> Option<Projection> {
     let projector = Projector::from(arr);
-    projector.calculate_n_projections(n)
+    projector.calculate_n_projections(n, rng)
 }
 
 fn outer(v1: &Array1<f64>, v2: &Array1<f64>) -> Array2<f64> {
@@ -165,7 +165,7 @@ mod nipals_tests {
     fn iris_projection() {
         let iris = iris();
         // println!("{:?}", iris);
-        let projection = Projector::from(iris).calculate_n_projections(4);
+        let projection = Projector::from(iris).calculate_n_projections(4, &mut thread_rng());
         // println!("{:?}", projection);
 
         let answer = array![
@@ -190,7 +190,7 @@ mod nipals_tests {
     #[test]
     fn degenerate_test() {
         let degenerate = array![[1., 1., 1.], [2., 2., 2.], [3., 3., 3.],];
-        let projection = Projector::from(degenerate).calculate_n_projections(3);
+        let projection = Projector::from(degenerate).calculate_n_projections(3, &mut thread_rng());
         println!("{:?}", projection);
 
         panic!();
@@ -1,4 +1,3 @@
-// #![feature(test)]
 
 
 
@@ -8,8 +7,12 @@ use std::collections::HashMap;
 use std::fs::File;
 use std::io::prelude::*;
 use std::fmt::Debug;
-use crate::utils::{arr_from_vec2};
-use ndarray::Array2;
+use std::convert::TryInto;
+use memmap2::Mmap;
+use rayon::prelude::*;
+use crate::events;
+use serde_json::json;
+use ndarray::{Array2,ArrayViewMut2,Axis};
 
 //::/ Author: Boris Brenerman
 //::/ Created: 2017 academic year, Johns Hopkins University, Department of Biology, Taylor Lab
@@ -32,6 +35,8 @@ pub struct Parameters {
     // pub stdin: bool,
     pub input_count_array_file: String,
     pub output_count_array_file: String,
+    pub input_shm: Option<SharedMatrix>,
+    pub output_shm: Option<SharedMatrix>,
     pub input_feature_header_file: Option<String>,
     pub output_feature_header_file: Option<String>,
     pub sample_header_file: Option<String>,
@@ -59,6 +64,20 @@ pub struct Parameters {
     pub dispersion_mode: DispersionMode,
     pub split_fraction_regularization: f64,
 
+    pub prototype_cache: bool,
+
+    pub low_memory: bool,
+    pub memory_limit: Option<usize>,
+
+    pub seed: Option<u64>,
+    pub resume: bool,
+    pub first_tree: usize,
+
+    pub profile: bool,
+
+    pub oob: bool,
+    pub full_statistics: bool,
+
 }
 
 impl Parameters {
@@ -69,6 +88,8 @@ impl Parameters {
             unsupervised: false,
             input_count_array_file: "".to_string(),
             output_count_array_file: "".to_string(),
+            input_shm: None,
+            output_shm: None,
             input_feature_header_file: None,
             output_feature_header_file: None,
             sample_header_file: None,
@@ -95,6 +116,20 @@ impl Parameters {
             standardize: false,
             dispersion_mode: DispersionMode::SSME,
             split_fraction_regularization: 1.,
+
+            prototype_cache: false,
+
+            low_memory: false,
+            memory_limit: None,
+
+            seed: None,
+            resume: false,
+            first_tree: 0,
+
+            profile: false,
+
+            oob: false,
+            full_statistics: false,
         };
         arg_struct
     }
@@ -152,6 +187,22 @@ impl Parameters {
                     arg_struct.output_count_array_file = args.next().expect("Failed to retrieve output location");
                     // arg_struct.output_array = Some(read_matrix(&args.next().expect("Error parsing output count location!")));
                 }
+                "-input_shm" | "-ishm" => {
+                    let name = args.next().expect("Failed to retrieve input segment");
+                    let rows = args.next().expect("Failed to retrieve input rows").parse::<usize>().expect("Error parsing input rows");
+                    let columns = args.next().expect("Failed to retrieve input columns").parse::<usize>().expect("Error parsing input columns");
+                    let shared = SharedMatrix{name,rows,columns};
+                    arg_struct.input_count_array_file = shared.location();
+                    arg_struct.input_shm = Some(shared);
+                }
+                "-output_shm" | "-oshm" => {
+                    let name = args.next().expect("Failed to retrieve output segment");
+                    let rows = args.next().expect("Failed to retrieve output rows").parse::<usize>().expect("Error parsing output rows");
+                    let columns = args.next().expect("Failed to retrieve output columns").parse::<usize>().expect("Error parsing output columns");
+                    let shared = SharedMatrix{name,rows,columns};
+                    arg_struct.output_count_array_file = shared.location();
+                    arg_struct.output_shm = Some(shared);
+                }
                 "-dm" | "-dispersion_mode" => {
                     arg_struct.dispersion_mode = DispersionMode::read(&args.next().expect("Failed to read split mode"));
                 },
@@ -219,6 +270,33 @@ impl Parameters {
                 "-ss" | "-sample_sub" | "-sample_subsample" | "-sample_subsamples" => {
                     arg_struct.sample_subsample = args.next().expect("Error processing sample subsample arg").parse::<usize>().expect("Error sample subsample arg");
                 },
+                "-prototype_cache" | "-pc" => {
+                    arg_struct.prototype_cache = args.next().expect("Error processing prototype cache arg").parse::<bool>().expect("Error parsing prototype cache arg");
+                },
+                "-lrg_mem" | "-low_memory" => {
+                    arg_struct.low_memory = true;
+                },
+                "-mem_limit" | "-memory_limit" => {
+                    arg_struct.memory_limit = Some(parse_memory(&args.next().expect("Error processing memory limit")));
+                },
+                "-seed" | "-seed_base" => {
+                    arg_struct.seed = Some(args.next().expect("Error processing seed").parse::<u64>().expect("Error parsing seed"));
+                },
+                "-first_tree" | "-tree_offset" => {
+                    arg_struct.first_tree = args.next().expect("Error processing first tree").parse::<usize>().expect("Error parsing first tree");
+                },
+                "-profile" => {
+                    arg_struct.profile = args.next().expect("Error processing profile arg").parse::<bool>().expect("Error parsing profile arg");
+                },
+                "-oob" => {
+                    arg_struct.oob = args.next().expect("Error processing oob arg").parse::<bool>().expect("Error parsing oob arg");
+                },
+                "-full_statistics" => {
+                    arg_struct.full_statistics = args.next().expect("Error processing full statistics arg").parse::<bool>().expect("Error parsing full statistics arg");
+                },
+                "-resume" => {
+                    arg_struct.resume = args.next().expect("Error processing resume arg").parse::<bool>().expect("Error parsing resume arg");
+                },
                 "-reduction" | "-r"  => {
                     arg_struct.reduction = args.next().expect("Error reading number of components").parse::<usize>().expect("-not a number");
                 },
@@ -248,13 +326,17 @@ impl Parameters {
     }
 
     pub fn input_array(&self) -> Array2<f64>{
-        let vv = read_matrix(&self.input_count_array_file);
-        arr_from_vec2(vv)
+        if let Some(shared) = &self.input_shm {
+            return shared.read()
+        }
+        read_matrix_parallel(&self.input_count_array_file)
     }
 
     pub fn output_array(&self) -> Array2<f64>{
-        let vv = read_matrix(&self.output_count_array_file);
-        arr_from_vec2(vv)
+        if let Some(shared) = &self.output_shm {
+            return shared.read()
+        }
+        read_matrix_parallel(&self.output_count_array_file)
     }
 
     pub fn input_feature_names(&self) -> Option<Vec<String>> {
@@ -269,6 +351,108 @@ impl Parameters {
         Some(read_header(self.sample_header_file.as_ref()?))
     }
 
+    // The prototype only depends on the contents of the count files and on the settings
+    // that are baked into the rank matrices, so those are all that go into its fingerprint.
+    // Depth, leaf size, subsampling etc can change freely without invalidating a cached prototype.
+
+    pub fn prototype_fingerprint(&self) -> Result<u64,io::Error> {
+        let settings = format!(
+            "{:?}|{:?}|{:?}|{:?}",
+            self.norm_mode,
+            self.dispersion_mode,
+            self.split_fraction_regularization,
+            self.standardize,
+        );
+        let mut hash = fnv1a(FNV_OFFSET,settings.as_bytes());
+        hash = fingerprint_file(hash,&self.input_count_array_file)?;
+        hash = fingerprint_file(hash,&self.output_count_array_file)?;
+        Ok(hash)
+    }
+
+    // Shared memory segments get a fresh name every fit and their path is in RAM, so with
+    // -input_shm the cache sits next to the output of the fit instead. The fingerprint covers
+    // the contents of the counts either way.
+
+    pub fn prototype_cache_address(&self,fingerprint:u64) -> String {
+        let base = if self.input_shm.is_some() { &self.report_address } else { &self.input_count_array_file };
+        format!("{}.{:016x}.prototype",base,fingerprint)
+    }
+
+    // Trees written by an earlier run can only be kept if everything that shapes a tree is
+    // unchanged: the prototype, the headers that name its features, and the growth settings.
+    // The seed is checked separately, since a resumed run may adopt the seed of the original.
+
+    pub fn run_fingerprint(&self) -> Result<u64,io::Error> {
+        let settings = format!(
+            "{:?}|{:?}|{:?}|{:?}|{:?}|{:?}|{:?}|{:?}|{:?}|{:?}|{:?}|{:?}",
+            self.unsupervised,
+            self.leaf_size_cutoff,
+            self.depth_cutoff,
+            self.sample_subsample,
+            self.input_feature_subsample,
+            self.output_feature_subsample,
+            self.reduce_input,
+            self.reduce_output,
+            self.reduction,
+            self.components,
+            self.oob,
+            self.full_statistics,
+        );
+        let mut hash = fnv1a(self.prototype_fingerprint()?,settings.as_bytes());
+        for header in [&self.input_feature_header_file,&self.output_feature_header_file,&self.sample_header_file].iter() {
+            hash = match header {
+                Some(address) => fingerprint_file(hash,address)?,
+                None => fnv1a(hash,b"-"),
+            };
+        }
+        Ok(hash)
+    }
+
+}
+
+// Memory sizes may be given in bytes or with a k/m/g/t suffix, eg 200G or 512mb
+
+pub fn parse_memory(input: &str) -> usize {
+    let lower = input.trim().to_lowercase();
+    let trimmed = lower.trim_end_matches('b');
+    let (number,scale): (&str,usize) = match trimmed.chars().last() {
+        Some('k') => (&trimmed[..trimmed.len()-1],1 << 10),
+        Some('m') => (&trimmed[..trimmed.len()-1],1 << 20),
+        Some('g') => (&trimmed[..trimmed.len()-1],1 << 30),
+        Some('t') => (&trimmed[..trimmed.len()-1],1 << 40),
+        _ => (trimmed,1),
+    };
+    (number.parse::<f64>().expect("Error parsing memory limit") * scale as f64) as usize
+}
+
+const FNV_OFFSET: u64 = 0xcbf29ce484222325;
+const FNV_PRIME: u64 = 0x100000001b3;
+
+// FNV-1a is not cryptographic, but it is stable across builds and platforms, unlike the
+// std hasher, which is what we want for keying files on disk.
+
+pub fn fnv1a(mut hash: u64, bytes: &[u8]) -> u64 {
+    for byte in bytes {
+        hash ^= *byte as u64;
+        hash = hash.wrapping_mul(FNV_PRIME);
+    }
+    hash
+}
+
+pub fn fingerprint_file(mut hash: u64, location: &str) -> Result<u64,io::Error> {
+    let mut handle = io::BufReader::with_capacity(1 << 20, File::open(location)?);
+    loop {
+        let length = {
+            let buffer = handle.fill_buf()?;
+            if buffer.len() == 0 {
+                break
+            }
+            hash = fnv1a(hash,buffer);
+            buffer.len()
+        };
+        handle.consume(length);
+    }
+    Ok(hash)
 }
 
 
@@ -348,20 +532,178 @@ pub fn read_matrix(location:&str) -> Vec<Vec<f64>> {
 
         count_array.push(gene_vector);
 
-        if i % 100 == 0 {
-            print!("Ingesting {}\r", i);
+        if i % 1000 == 0 {
+            events::emit("ingest",json!({"file":location,"rows":i}));
         }
 
 
     };
 
-    print!("Ingested {},{}\r", count_array.len(),count_array.get(0).unwrap_or(&vec![]).len());
-    print!("                                          ");
+    events::emit("ingested",json!({"file":location,"rows":count_array.len(),"columns":count_array.get(0).map(|r| r.len()).unwrap_or(0)}));
 
     count_array
 
 }
 
+// Parses the same whitespace delimited text as read_matrix, in parallel. The file is mapped and
+// cut into byte ranges at line boundaries. Rows are counted in each range, the matrix is allocated
+// once, and each range parses its lines straight into its own block of rows on the rayon pool.
+// Floats go through str::parse, which implements the Eisel-Lemire fast path. Blank lines are
+// skipped, and rows must all be as long as the first.
+
+pub fn read_matrix_parallel(location:&str) -> Array2<f64> {
+
+    let handle = File::open(location).expect("Count file error!");
+    let length = handle.metadata().expect("Count file error!").len();
+    if length == 0 {
+        events::emit("ingested",json!({"file":location,"rows":0,"columns":0}));
+        return Array2::zeros((0,0))
+    }
+    let map = unsafe { Mmap::map(&handle).expect("Failed to map count file") };
+    let bytes: &[u8] = &map;
+
+    let ranges = line_ranges(bytes,rayon::current_num_threads() * 4);
+
+    let range_rows: Vec<usize> = ranges.par_iter()
+        .map(|&(start,end)| lines(&bytes[start..end]).count())
+        .collect();
+    let rows: usize = range_rows.iter().sum();
+    let columns = lines(bytes).next().map(|line| tokens(line).count()).unwrap_or(0);
+
+    let mut matrix = Array2::zeros((rows,columns));
+
+    {
+        let mut blocks: Vec<(usize,ArrayViewMut2<f64>)> = Vec::with_capacity(ranges.len());
+        let mut rest = matrix.view_mut();
+        let mut first_row = 0;
+        for &block_rows in range_rows.iter() {
+            let (block,remainder) = rest.split_at(Axis(0),block_rows);
+            blocks.push((first_row,block));
+            rest = remainder;
+            first_row += block_rows;
+        }
+
+        ranges.into_par_iter().zip(blocks.into_par_iter()).for_each(|((start,end),(first_row,mut block))| {
+            for (i,line) in lines(&bytes[start..end]).enumerate() {
+                let mut row = block.row_mut(i);
+                let mut j = 0;
+                for token in tokens(line) {
+                    if j >= columns {
+                        panic!("Row {} of {} is longer than the first row ({} columns)",first_row + i,location,columns);
+                    }
+                    row[j] = parse_cell(token);
+                    j += 1;
+                }
+                if j < columns {
+                    panic!("Row {} of {} has {} columns, the first row has {}",first_row + i,location,j,columns);
+                }
+            }
+        });
+    }
+
+    events::emit("ingested",json!({"file":location,"rows":rows,"columns":columns}));
+
+    matrix
+
+}
+
+// Splits bytes into about n ranges that each start at the beginning of a line and end after a newline
+
+fn line_ranges(bytes:&[u8],n:usize) -> Vec<(usize,usize)> {
+    let step = (bytes.len() / n.max(1)).max(1);
+    let mut ranges = Vec::with_capacity(n);
+    let mut start = 0;
+    while start < bytes.len() {
+        let target = (start + step).min(bytes.len());
+        let end = match bytes[target..].iter().position(|b| *b == b'\n') {
+            Some(offset) => target + offset + 1,
+            None => bytes.len(),
+        };
+        ranges.push((start,end));
+        start = end;
+    }
+    ranges
+}
+
+fn lines(bytes:&[u8]) -> impl Iterator<Item=&[u8]> {
+    bytes.split(|b| *b == b'\n').filter(|line| line.iter().any(|b| !b.is_ascii_whitespace()))
+}
+
+fn tokens(line:&[u8]) -> impl Iterator<Item=&[u8]> {
+    line.split(|b| b.is_ascii_whitespace()).filter(|token| token.len() > 0)
+}
+
+fn parse_cell(token:&[u8]) -> f64 {
+    let value = std::str::from_utf8(token).ok().and_then(|cell| cell.parse::<f64>().ok());
+    match value {
+        Some(value) if value.is_nan() => panic!("Nan in input. Please sanitize matrix!"),
+        Some(value) => value,
+        None => panic!("Couldn't parse a cell in the text file, cell content: {:?}",String::from_utf8_lossy(token)),
+    }
+}
+
+// Writes a matrix as a .npy file (format 1.0, little endian f64, C order), which is how a parsed
+// text matrix is handed back to python (rf_5 -parse_matrix)
+
+pub fn write_npy(matrix:&Array2<f64>,location:&str) -> Result<(),io::Error> {
+    let mut header = format!("{{'descr': '<f8', 'fortran_order': False, 'shape': ({}, {}), }}",matrix.dim().0,matrix.dim().1);
+    // The magic string, version and header length take 10 bytes, and data starts 64 byte aligned
+    while (10 + header.len() + 1) % 64 != 0 {
+        header.push(' ');
+    }
+    header.push('\n');
+    let mut handle = io::BufWriter::with_capacity(1 << 20,File::create(location)?);
+    handle.write_all(b"\x93NUMPY\x01\x00")?;
+    handle.write_all(&(header.len() as u16).to_le_bytes())?;
+    handle.write_all(header.as_bytes())?;
+    for value in matrix.iter() {
+        handle.write_all(&value.to_le_bytes())?;
+    }
+    handle.flush()
+}
+
+// A matrix handed over in POSIX shared memory rather than a file, as lumberjack.fit does with
+// shared_memory=True: rows x columns native endian f64s in row major order, in the segment
+// /dev/shm/{name}. The segment is mapped read only and belongs to the caller, who unlinks it.
+// Its location doubles as the count file address, so fingerprints hash the segment's bytes.
+// Platforms without /dev/shm (macOS) can't hand matrices over this way, lumberjack falls back to
+// count files there.
+
+#[derive(Debug,Clone,Serialize,Deserialize)]
+pub struct SharedMatrix {
+    pub name: String,
+    pub rows: usize,
+    pub columns: usize,
+}
+
+impl SharedMatrix {
+
+    pub fn location(&self) -> String {
+        format!("/dev/shm/{}",self.name.trim_start_matches('/'))
+    }
+
+    pub fn read(&self) -> Array2<f64> {
+        let location = self.location();
+        let handle = File::open(&location).unwrap_or_else(|error| {
+            panic!("Shared memory segment {} can't be opened ({}), -input_shm/-output_shm need /dev/shm, pass count files instead",location,error)
+        });
+        let map = unsafe { Mmap::map(&handle).expect("Failed to map shared memory segment") };
+        let length = self.rows * self.columns;
+        if map.len() < length * 8 {
+            panic!("Shared memory segment {} holds {} bytes, too few for a {}x{} matrix",location,map.len(),self.rows,self.columns);
+        }
+        let values: Vec<f64> = map[..length * 8].chunks_exact(8)
+            .map(|bytes| f64::from_ne_bytes(bytes.try_into().unwrap()))
+            .collect();
+        if values.iter().any(|v| v.is_nan()) {
+            panic!("Nan in input. Please sanitize matrix!")
+        }
+        events::emit("ingested",json!({"file":location,"rows":self.rows,"columns":self.columns}));
+        Array2::from_shape_vec((self.rows,self.columns),values).unwrap()
+    }
+
+}
+
 pub fn read_header(location: &str) -> Vec<String> {
 
     let mut header_map = HashMap::new();
@@ -425,6 +767,89 @@ pub mod primary_testing {
 
     }
 
+    #[test]
+    fn test_parse_memory() {
+        assert_eq!(parse_memory("1024"),1024);
+        assert_eq!(parse_memory("2k"),2048);
+        assert_eq!(parse_memory("1.5G"),3 << 29);
+        assert_eq!(parse_memory("256gb"),256 << 30);
+    }
+
+    #[test]
+    fn test_parameters_low_memory() {
+        let mut args_iter = vec!["blank","-lrg_mem","-mem_limit","64G"].into_iter().map(|x| x.to_string());
+        let args = Parameters::read(&mut args_iter);
+        assert!(args.low_memory);
+        assert_eq!(args.memory_limit,Some(64 << 30));
+    }
+
+    #[test]
+    fn test_parameters_resume() {
+        let mut args_iter = vec!["blank","-seed","42","-resume","true"].into_iter().map(|x| x.to_string());
+        let args = Parameters::read(&mut args_iter);
+        assert_eq!(args.seed,Some(42));
+        assert!(args.resume);
+    }
+
+    #[test]
+    fn test_parameters_shard() {
+        let mut args_iter = vec!["blank","-t","250","-first_tree","500","-seed_base","9"].into_iter().map(|x| x.to_string());
+        let args = Parameters::read(&mut args_iter);
+        assert_eq!(args.tree_limit,250);
+        assert_eq!(args.first_tree,500);
+        assert_eq!(args.seed,Some(9));
+    }
+
+    #[test]
+    fn test_parameters_oob_and_statistics() {
+        let mut args_iter = vec!["blank","-oob","true"].into_iter().map(|x| x.to_string());
+        let args = Parameters::read(&mut args_iter);
+        assert!(args.oob);
+        assert!(!Parameters::empty().oob);
+        let mut args_iter = vec!["blank","-full_statistics","true"].into_iter().map(|x| x.to_string());
+        assert!(Parameters::read(&mut args_iter).full_statistics);
+    }
+
+    #[test]
+    fn test_parameters_shared_memory() {
+        let mut args_iter = vec!["blank","-input_shm","/rf5_in","2","3","-oshm","rf5_out","2","1"].into_iter().map(|x| x.to_string());
+        let args = Parameters::read(&mut args_iter);
+        assert_eq!(args.input_count_array_file,"/dev/shm/rf5_in");
+        assert_eq!(args.output_count_array_file,"/dev/shm/rf5_out");
+        let shared = args.input_shm.unwrap();
+        assert_eq!((shared.rows,shared.columns),(2,3));
+    }
+
+    #[test]
+    fn test_prototype_cache_address_shared_memory() {
+        let mut args_iter = vec!["blank","-ic","counts","-o","fit/tmp"].into_iter().map(|x| x.to_string());
+        let args = Parameters::read(&mut args_iter);
+        assert_eq!(args.prototype_cache_address(1),"counts.0000000000000001.prototype");
+        let mut args_iter = vec!["blank","-ishm","rf5_a","2","3","-o","fit/tmp"].into_iter().map(|x| x.to_string());
+        let args = Parameters::read(&mut args_iter);
+        assert_eq!(args.prototype_cache_address(1),"fit/tmp.0000000000000001.prototype");
+    }
+
+    #[test]
+    fn test_read_shared_matrix() {
+        let name = format!("rf5_test_{}",std::process::id());
+        let shared = SharedMatrix{name,rows:2,columns:2};
+        if std::fs::metadata("/dev/shm").is_err() {
+            return
+        }
+        let bytes: Vec<u8> = [1.,2.,3.,4.].iter().flat_map(|v:&f64| v.to_ne_bytes().to_vec()).collect();
+        std::fs::write(shared.location(),bytes).unwrap();
+        let matrix = shared.read();
+        std::fs::remove_file(shared.location()).unwrap();
+        assert_eq!(matrix,ndarray::arr2(&[[1.,2.],[3.,4.]]));
+    }
+
+    #[test]
+    fn test_fnv1a_reference() {
+        assert_eq!(fnv1a(FNV_OFFSET,b""), 0xcbf29ce484222325);
+        assert_eq!(fnv1a(FNV_OFFSET,b"a"), 0xaf63dc4c8601ec8c);
+    }
+
     #[test]
     fn test_read_counts_trivial() {
         assert_eq!(
@@ -441,6 +866,50 @@ pub mod primary_testing {
         );
     }
 
+    #[test]
+    fn test_read_matrix_parallel_simple() {
+        assert_eq!(
+            read_matrix_parallel(&format!("{}/simple.txt",TEST_LOCATION)),
+            arr_from_vec2(read_matrix(&format!("{}/simple.txt",TEST_LOCATION)))
+        );
+    }
+
+    #[test]
+    fn test_read_matrix_parallel_ranges() {
+        let location = std::env::temp_dir().join(format!("rf5_parallel_{}.txt",std::process::id()));
+        let mut text = String::new();
+        for i in 0..1000 {
+            text.push_str(&format!("{} {:e}\t-{}.5\r\n",i,i as f64 * 0.25,i));
+            if i % 97 == 0 {
+                text.push_str("  \n");
+            }
+        }
+        std::fs::write(&location,text).unwrap();
+        let matrix = read_matrix_parallel(location.to_str().unwrap());
+        std::fs::remove_file(&location).unwrap();
+        assert_eq!(matrix.dim(),(1000,3));
+        assert_eq!(matrix.row(999).to_vec(),vec![999.,249.75,-999.5]);
+        let bytes = b"1 2\n3 4\n5 6";
+        for n in 1..8 {
+            let ranges = line_ranges(bytes,n);
+            assert_eq!(ranges[0].0,0);
+            assert_eq!(ranges.last().unwrap().1,bytes.len());
+            assert!(ranges.windows(2).all(|w| w[0].1 == w[1].0 && bytes[w[0].1 - 1] == b'\n'));
+        }
+    }
+
+    #[test]
+    fn test_write_npy_header() {
+        let location = std::env::temp_dir().join(format!("rf5_npy_{}.npy",std::process::id()));
+        write_npy(&ndarray::arr2(&[[1.,2.],[3.,4.]]),location.to_str().unwrap()).unwrap();
+        let bytes = std::fs::read(&location).unwrap();
+        std::fs::remove_file(&location).unwrap();
+        let header_length = u16::from_le_bytes([bytes[8],bytes[9]]) as usize;
+        assert_eq!((10 + header_length) % 64,0);
+        assert_eq!(bytes.len(),10 + header_length + 32);
+        assert_eq!(&bytes[10 + header_length..10 + header_length + 8],&1f64.to_le_bytes());
+    }
+
     #[test]
     fn test_read_header_trivial() {
         assert_eq!(
@@ -1,394 +1,539 @@
 
 use std::f64;
+use std::io::{Error,Write};
 use serde_json;
 
 use ndarray::prelude::*;
 
 extern crate rand;
 use rand::prelude::*;
+use rand::rngs::StdRng;
+use rayon::prelude::*;
 
 use crate::rank_matrix::{RankMatrix};
 use crate::Feature;
-use crate::Sample;
 use crate::io::Parameters;
 use crate::Filter;
 use crate::random_forest::Prototype;
+use crate::utils::median;
+use crate::profile::{Profile,Phase};
 
 use crate::fast_nipal_vector::{project,Projection};
 
-#[derive(Clone,Debug)]
-pub struct Node {
+// A tree is an arena of small node records. Nodes don't own samples or features: every node
+// is a contiguous range of the tree's sample buffer, which is partitioned in place as nodes
+// split, and prototype nodes always span all features of the prototype. Filters only carry
+// feature indices, names are attached once when the tree is written out.
+// Every random draw made while growing a tree comes from the tree's own seeded generator, and
+// nodes are split in a fixed depth-first order, so a tree is reproduced exactly by its seed.
+// With out-of-bag estimates on, a tree first draws a bootstrap of the whole sample set and only
+// ever picks splits or computes statistics from samples in it. Out-of-bag samples still descend
+// the tree through its filters, so every node holds them, but they have no say in how it splits.
 
-    pub prototype: bool,
+#[derive(Clone,Debug)]
+pub struct NodeRecord {
 
-    input_features: Vec<Feature>,
-    output_features: Vec<Feature>,
-    samples: Vec<Sample>,
+    start: usize,
+    end: usize,
 
     filter: Option<Filter>,
-    input_projection: Option<Projection>,
-    output_projection: Option<Projection>,
 
     means: Option<Vec<f64>>,
     medians: Option<Vec<f64>>,
 
-    pub depth: usize,
-    pub children: Vec<Node>,
+    // Sums of squared residuals from the means, only with full statistics
+    ssr: Option<Vec<f64>>,
 
-}
+    // Dispersion removed by this node's split, on its bootstrap
+    gain: Option<f64>,
 
-impl Node {
-
-    pub fn prototype<'a>(
-        input_features:&'a[Feature],
-        output_features:&'a[Feature],
-        samples:&'a[Sample],
-    ) -> Node {
-
-        let new_node = Node {
+    pub depth: usize,
+    pub children: Option<(u32,u32)>,
 
-            prototype: true,
+}
 
-            input_features: input_features.to_owned(),
-            output_features: output_features.to_owned(),
-            samples: samples.to_owned(),
+impl NodeRecord {
 
+    fn new(start:usize,end:usize,depth:usize,filter:Option<Filter>) -> NodeRecord {
+        NodeRecord {
+            start,
+            end,
+            filter,
             means: None,
             medians: None,
+            ssr: None,
+            gain: None,
+            depth,
+            children: None,
+        }
+    }
 
-            depth: 0,
-            children: vec![],
+    pub fn len(&self) -> usize {
+        self.end - self.start
+    }
 
-            filter: None,
-            input_projection: None,
-            output_projection: None,
+}
 
-        };
+#[derive(Clone,Debug)]
+pub struct Tree {
+    pub records: Vec<NodeRecord>,
+    samples: Vec<usize>,
+    in_bag: Option<Vec<bool>>,
+    rng: StdRng,
+    pub profile: Profile,
+}
 
-        new_node
+impl Tree {
 
+    pub fn new(samples:usize,seed:u64) -> Tree {
+        Tree {
+            records: vec![NodeRecord::new(0,samples,0,None)],
+            samples: (0..samples).collect(),
+            in_bag: None,
+            rng: StdRng::seed_from_u64(seed),
+            profile: Profile::disabled(),
+        }
     }
 
-    fn derive_prototype(&self,samples:Vec<Sample>,filter:Option<Filter>) -> Node {
-        if !self.prototype {panic!("Attempted to derive a prototype from a slim node")}
-        Node {
-            prototype: true,
-
-            input_features: self.input_features.clone(),
-            output_features: self.output_features.clone(),
-            samples: samples,
-
-            means: None,
-            medians: None,
-
-            depth: self.depth+1,
-            children: vec![],
+    pub fn samples(&self,index:usize) -> &[usize] {
+        let record = &self.records[index];
+        &self.samples[record.start..record.end]
+    }
 
-            filter: filter,
-            input_projection: None,
-            output_projection: None,
+    fn draw_in_bag(&mut self, parameters:&Parameters) {
+        self.in_bag = if parameters.oob {
+            let samples = self.samples.len();
+            let mut in_bag = vec![false;samples];
+            for _ in 0..samples {
+                in_bag[self.rng.gen_range(0..samples)] = true;
+            }
+            Some(in_bag)
         }
+        else { None };
     }
 
-    // Oh god what was I thinking?
-
-    // fn bootstrap(&self,parameters:&Parameters) -> (Vec<Feature>,Vec<Feature>,Vec<Sample>) {
+    // With full statistics, every node gets the means, medians and sums of squared residuals of
+    // all output features over all of its samples rather than a bootstrap, leaves included
 
-    //     let input_feature_indices: Vec<usize>;
-    //     let output_feature_indices: Vec<usize>;
+    fn fill_statistics(&mut self, index:usize, prototype:&Prototype, parameters:&Parameters) {
+        if !parameters.full_statistics {
+            return
+        }
+        let timer = self.profile.start();
+        let (means,medians,ssr) = full_statistics(prototype,self.samples(index));
+        self.profile.record(Phase::NodeStatistics,timer);
+        let record = &mut self.records[index];
+        record.means = Some(means);
+        record.medians = Some(medians);
+        record.ssr = Some(ssr);
+    }
 
-    //     if parameters.unsupervised {
-    //         let input_feature_len = self.input_features.len();
-    //         let mut all_indices = (0..input_feature_len).collect::<Vec<usize>>();
-    //         let (ii,oi) = all_indices.partial_shuffle(&mut thread_rng(),input_feature_len/2);
-    //         // Why can't you destructure into an initialized variable? It is a mystery.
-    //         input_feature_indices = ii.to_vec();
-    //         output_feature_indices = oi.to_vec();
-    //     }
-    //     else {
-    //         input_feature_indices = (0..self.input_features.len()).collect();
-    //         output_feature_indices = (0..self.output_features.len()).collect();
-    //     }
+    pub fn out_of_bag(&self) -> Option<Vec<usize>> {
+        self.in_bag.as_ref().map(|in_bag| (0..in_bag.len()).filter(|&s| !in_bag[s]).collect())
+    }
 
-    //     let mut rng = thread_rng();
-    //     let input_index_bootstrap: Vec<usize> = (0..parameters.input_feature_subsample).map(|_| rng.gen_range(0..input_feature_indices.len())).collect();
-    //     let output_index_bootstrap: Vec<usize> = (0..parameters.output_feature_subsample).map(|_| rng.gen_range(0..output_feature_indices.len())).collect();
+    // Dispersion gain of every split credited to the input features of its filter, each split
+    // weighted by the fraction of the tree's samples that reached it
+
+    pub fn importances(&self, features:usize) -> Vec<f64> {
+        let mut importances = vec![0.;features];
+        let total = self.records[0].len().max(1) as f64;
+        for record in self.records.iter() {
+            if let (Some(gain),Some((left,_))) = (record.gain,record.children) {
+                if let Some(filter) = &self.records[left as usize].filter {
+                    filter.attribute(gain * record.len() as f64 / total,&mut importances);
+                }
+            }
+        }
+        importances
+    }
 
-    //     let input_feature_bootstrap: Vec<Feature> = input_index_bootstrap.iter().map(|&i| self.input_features[i].clone()).collect();
-    //     let output_feature_bootstrap: Vec< Feature> = output_index_bootstrap.iter().map(|&i| self.output_features[i].clone()).collect();
+    pub fn split(&mut self, index:usize, prototype:&Prototype, parameters:&Parameters) -> Option<(usize,usize)> {
 
-    //     let sample_index_bootstrap: Vec<usize> = (0..parameters.sample_subsample).map(|_| rng.gen_range(0..self.samples.len())).collect();
-    //     let sample_bootstrap: Vec<Sample> = sample_index_bootstrap.iter().map(|i| self.samples[*i].clone()).collect();
+        let (start,end,depth) = {
+            let record = &self.records[index];
+            (record.start,record.end,record.depth)
+        };
 
-    //     (input_feature_bootstrap,output_feature_bootstrap,sample_bootstrap)
-    // }
+        if depth >= parameters.depth_cutoff {
+            return None
+        };
 
-    
-    fn bootstrap(&self,parameters:&Parameters) -> (Vec<Feature>,Vec<Feature>,Vec<Sample>) {
+        self.profile.depth = depth;
 
-        let input_feature_indices: Vec<usize>;
-        let output_feature_indices: Vec<usize>;
-        let mut rng = thread_rng();
+        let in_bag_samples: Vec<usize>;
+        let drawable: &[usize] = match &self.in_bag {
+            Some(in_bag) => {
+                in_bag_samples = self.samples[start..end].iter().cloned().filter(|&s| in_bag[s]).collect();
+                &in_bag_samples
+            },
+            None => &self.samples[start..end],
+        };
 
-        if parameters.unsupervised {
-            let input_feature_len = self.input_features.len();
-            let mut all_indices = (0..input_feature_len).collect::<Vec<usize>>();
-            let (ii,oi) = all_indices.partial_shuffle(&mut rng,input_feature_len/2);
-            // Why can't you destructure into an initialized variable? It is a mystery.
-            input_feature_indices = ii.to_vec();
-            output_feature_indices = oi.to_vec();
-        }
-        else {
-            input_feature_indices = (0..self.input_features.len()).collect();
-            output_feature_indices = (0..self.output_features.len()).collect();
+        if drawable.is_empty() {
+            return None
         }
 
-        let input_index_bootstrap: Vec<usize> = 
-            (0..parameters.input_feature_subsample)
-            .map(|_| rng.gen_range(0..input_feature_indices.len()))
-            .map(|i:usize| input_feature_indices[i].clone())
-            .collect();
-
-        let output_index_bootstrap: Vec<usize> = 
-            (0..parameters.output_feature_subsample)
-            .map(|_| rng.gen_range(0..output_feature_indices.len()))
-            .map(|i:usize| output_feature_indices[i].clone())
-            .collect();
+        let timer = self.profile.start();
+        let bootstrap = Bootstrap::draw(drawable,prototype,parameters,&mut self.rng);
+        self.profile.record(Phase::Bootstrap,timer);
 
-        let input_feature_bootstrap: Vec<Feature> = input_index_bootstrap.iter().map(|&i| self.input_features[i].clone()).collect();
-        let output_feature_bootstrap: Vec< Feature> = output_index_bootstrap.iter().map(|&i| self.output_features[i].clone()).collect();
+        let candidate_filters = bootstrap.candidate_filters(prototype,parameters,&mut self.rng,&mut self.profile);
 
-        let sample_index_bootstrap: Vec<usize> = (0..parameters.sample_subsample).map(|_| rng.gen_range(0..self.samples.len())).collect();
-        let sample_bootstrap: Vec<Sample> = sample_index_bootstrap.iter().map(|i| self.samples[*i].clone()).collect();
+        let mut selected_candidates = None;
 
-        (input_feature_bootstrap,output_feature_bootstrap,sample_bootstrap)
-    }
+        let timer = self.profile.start();
+        for (f_left,f_right,gain) in candidate_filters {
+            let left_samples = f_left.filter_samples(&prototype.input_array,&self.samples[start..end]);
+            let right_samples = f_right.filter_samples(&prototype.input_array,&self.samples[start..end]);
+            if left_samples.len() > parameters.leaf_size_cutoff && right_samples.len() > parameters.leaf_size_cutoff {
+                selected_candidates = Some((f_left,f_right,gain,left_samples,right_samples));
+                break
+            }
+        }
+        self.profile.record(Phase::FilterSamples,timer);
 
-    fn derive_bootstrap(&self,parameters:&Parameters) -> Node {
-        let (input_bootstrap,output_bootstrap,sample_bootstrap) = self.bootstrap(parameters);
-        let node = Node {
+        let (left_filter,right_filter,gain,left_samples,right_samples) = selected_candidates?;
 
-            prototype: false,
+        // Full statistics are filled in once the node is split, so bootstrap statistics are
+        // skipped, unless the output is reduced and drawing them moves the generator
 
-            input_features: input_bootstrap,
-            output_features: output_bootstrap,
-            samples: sample_bootstrap,
+        let statistics = if parameters.full_statistics && !parameters.reduce_output {
+            None
+        }
+        else {
+            let timer = self.profile.start();
+            let statistics = node_statistics(prototype,parameters,drawable,&mut self.rng);
+            self.profile.record(Phase::NodeStatistics,timer);
+            Some(statistics)
+        };
 
-            means: None,
-            medians: None,
+        // Partition this node's range in place: left samples, then right samples, then anything
+        // neither filter accepted (which stays with this node only).
 
-            depth: self.depth,
-            children: vec![],
+        let mut taken = vec![false;end-start];
+        let mut partitioned = Vec::with_capacity(end-start);
+        for &local in left_samples.iter().chain(right_samples.iter()) {
+            taken[local] = true;
+            partitioned.push(self.samples[start + local]);
+        }
+        for (local,_) in taken.iter().enumerate().filter(|(_,t)| !**t) {
+            partitioned.push(self.samples[start + local]);
+        }
+        self.samples[start..end].copy_from_slice(&partitioned);
 
-            filter: None,
-            input_projection: None,
-            output_projection: None,
+        let left_end = start + left_samples.len();
+        let right_end = left_end + right_samples.len();
 
-        };
-        node
-    }
+        let left_index = self.records.len();
+        let right_index = left_index + 1;
 
+        self.records.push(NodeRecord::new(start,left_end,depth+1,Some(left_filter)));
+        self.records.push(NodeRecord::new(left_end,right_end,depth+1,Some(right_filter)));
 
-    fn input_projection(&mut self, prototype:&Prototype,parameters:&Parameters) -> &Projection {
-        self.input_projection.get_or_insert({
-            let feature_indices: Vec<usize> = self.input_features.iter().map(|f| f.index).collect();
-            let sample_indices: Vec<usize> = self.samples.iter().map(|s| s.index).collect();
-            let input_array = prototype.input_array.select(Axis(0),&sample_indices).select(Axis(1),&feature_indices);
+        let record = &mut self.records[index];
+        if let Some((means,medians)) = statistics {
+            record.means = Some(means);
+            record.medians = Some(medians);
+        }
+        record.gain = Some(gain);
+        record.children = Some((left_index as u32,right_index as u32));
 
-            project(input_array,parameters.reduction).expect("Projection failed")
-        })
+        Some((left_index,right_index))
     }
 
-    fn output_projection(&mut self, prototype:&Prototype,parameters:&Parameters) -> &Projection {
-        self.output_projection.get_or_insert({
-            let feature_indices: Vec<usize> = self.output_features.iter().map(|f| f.index).collect();
-            let sample_indices: Vec<usize> = self.samples.iter().map(|s| s.index).collect();
-            let output_array = prototype.output_array.select(Axis(0),&sample_indices).select(Axis(1),&feature_indices);
-            project(output_array,parameters.reduction).expect("Projection failed")
-        })
+    pub fn grow(&mut self, prototype:&Prototype, parameters:&Parameters) {
+        self.draw_in_bag(parameters);
+        self.grow_node(0,prototype,parameters);
     }
 
-    fn input_rank_matrix(&mut self,prototype:&Prototype,parameters:&Parameters) -> RankMatrix {
-        if parameters.reduce_input {
-            let projection = self.input_projection(prototype,parameters);
-            RankMatrix::from_array(&projection.loadings,parameters)
-        }
-        else {
-            let feature_indices: Vec<usize> = self.input_features.iter().map(|f| f.index).collect();
-            let sample_indices: Vec<usize> = self.samples.iter().map(|s| s.index).collect();
-            prototype.input_ranks.derive_specified(&feature_indices,&sample_indices)
+    fn grow_node(&mut self, index:usize, prototype:&Prototype, parameters:&Parameters) {
+        let children = self.split(index,prototype,parameters);
+        self.fill_statistics(index,prototype,parameters);
+        if let Some((left,right)) = children {
+            self.grow_node(left,prototype,parameters);
+            self.grow_node(right,prototype,parameters);
         }
     }
 
-    fn output_rank_matrix(&mut self,prototype:&Prototype,parameters:&Parameters) -> RankMatrix {
-        if parameters.reduce_output {
-            let projection = self.output_projection(prototype,parameters);
-            RankMatrix::from_array(&projection.loadings,parameters)
-        }
-        else {
-            let feature_indices: Vec<usize> = self.output_features.iter().map(|f| f.index).collect();
-            let sample_indices: Vec<usize> = self.samples.iter().map(|s| s.index).collect();
-            prototype.output_ranks.derive_specified(&feature_indices,&sample_indices)
-        }
+    // Grows the tree and writes it out depth-first as it goes. A node's record is written as soon
+    // as it has been split, after which its statistics are released, so only the structure of
+    // the tree and a single sample buffer are held in memory.
+    // The output is identical to to_serial().dump()
+
+    pub fn stream<W: Write>(&mut self, prototype:&Prototype, parameters:&Parameters, input_features:&[Feature], handle: &mut W) -> Result<(),Error> {
+        self.draw_in_bag(parameters);
+        self.stream_node(0,prototype,parameters,input_features,handle)
     }
-    //
 
-    pub fn candidate_filters(&mut self,prototype:&Prototype,parameters:&Parameters) -> Vec<(Filter,Filter)> {
+    fn stream_node<W: Write>(&mut self, index:usize, prototype:&Prototype, parameters:&Parameters, input_features:&[Feature], handle: &mut W) -> Result<(),Error> {
 
-        let input_ranks = self.input_rank_matrix(prototype, parameters);
-        let output_ranks = self.output_rank_matrix(prototype, parameters);
+        let children = self.split(index,prototype,parameters);
+        self.fill_statistics(index,prototype,parameters);
 
-        let minima = RankMatrix::split_candidates(input_ranks,output_ranks);
+        self.profile.depth = self.records[index].depth;
+        let timer = self.profile.start();
+        self.write_record(index,input_features,handle)?;
+        self.profile.record(Phase::Serialization,timer);
 
-        let input_features = self.input_features.clone();
+        let record = &mut self.records[index];
+        record.means = None;
+        record.medians = None;
+        record.ssr = None;
 
-        let filters = if parameters.reduce_input {
-            minima.into_iter()
-            .map(|(local_feature,_,local_threshold)| {
+        if let Some((left,right)) = children {
+            self.stream_node(left,prototype,parameters,input_features,handle)?;
+            handle.write_all(b",")?;
+            self.stream_node(right,prototype,parameters,input_features,handle)?;
+        }
 
-                let Projection {
-                    weights, means, ..
-                } = self.input_projection(prototype,parameters);
+        self.close_record(index,handle)
+    }
 
-                let left_filter = Filter::new(input_features.clone(),means.row(local_feature).to_vec(),weights.row(local_feature).to_vec(),local_threshold,false);
-                let right_filter = Filter::new(input_features.clone(),means.row(local_feature).to_vec(),weights.row(local_feature).to_vec(),local_threshold,true);
-                (left_filter,right_filter)
-            }).collect()
+    // Writes everything but the children of a node, leaving the children list open
+
+    fn write_record<W: Write>(&self, index:usize, input_features:&[Feature], handle: &mut W) -> Result<(),Error> {
+        let record = &self.records[index];
+        handle.write_all(b"{\"samples\":")?;
+        serde_json::to_writer(&mut *handle,self.samples(index))?;
+        handle.write_all(b",\"means\":")?;
+        serde_json::to_writer(&mut *handle,&record.means)?;
+        handle.write_all(b",\"medians\":")?;
+        serde_json::to_writer(&mut *handle,&record.medians)?;
+        if let Some(ssr) = &record.ssr {
+            handle.write_all(b",\"ssr\":")?;
+            serde_json::to_writer(&mut *handle,ssr)?;
+            handle.write_all(format!(",\"population\":{}",record.len()).as_bytes())?;
         }
-        else {
-            minima.into_iter()
-            .map(|(local_feature,_,local_threshold)| {
-                let left_filter = Filter::new(vec![input_features[local_feature].clone(),],vec![0.,],vec![1.,],local_threshold,false);
-                let right_filter = Filter::new(vec![input_features[local_feature].clone(),],vec![0.,],vec![1.,],local_threshold,true);
-                (left_filter,right_filter)
-            }).collect()
-        };
+        handle.write_all(b",\"filter\":")?;
+        serde_json::to_writer(&mut *handle,&record.filter.as_ref().map(|f| f.resolve(input_features)))?;
+        if let Some(gain) = record.gain {
+            handle.write_all(b",\"gain\":")?;
+            serde_json::to_writer(&mut *handle,&gain)?;
+        }
+        handle.write_all(format!(",\"depth\":{},\"children\":[",record.depth).as_bytes())?;
+        Ok(())
+    }
 
-        filters
+    // Closes the children list of a node. The root also carries the out-of-bag samples of the
+    // tree, which are only known once the bootstrap has been drawn.
 
+    fn close_record<W: Write>(&self, index:usize, handle: &mut W) -> Result<(),Error> {
+        handle.write_all(b"]")?;
+        if index == 0 {
+            if let Some(out_of_bag) = self.out_of_bag() {
+                handle.write_all(b",\"oob\":")?;
+                serde_json::to_writer(&mut *handle,&out_of_bag)?;
+            }
+        }
+        handle.write_all(b"}")
     }
 
-    pub fn local_split(&mut self,prototype:&Prototype,parameters:&Parameters) -> Option<(Filter,Filter)> {
-        let candidates = self.candidate_filters(prototype, parameters);
-        candidates.get(0).map(|t| t.clone())
+    pub fn leaves(&self) -> Vec<usize> {
+        (0..self.records.len()).filter(|&i| self.records[i].children.is_none()).collect()
     }
 
-    pub fn split(&mut self, prototype:&Prototype,parameters:&Parameters) -> Option<&mut [Node]> {
+    pub fn to_serial(&self, input_features:&[Feature]) -> SerialNode {
+        self.serial_node(0,input_features)
+    }
 
-        if self.depth >= parameters.depth_cutoff {
-            return None
+    fn serial_node(&self, index:usize, input_features:&[Feature]) -> SerialNode {
+        let record = &self.records[index];
+        let children = match record.children {
+            Some((left,right)) => vec![
+                self.serial_node(left as usize,input_features),
+                self.serial_node(right as usize,input_features),
+            ],
+            None => vec![],
         };
+        SerialNode {
+            samples: self.samples(index).to_vec(),
+            means: record.means.clone(),
+            medians: record.medians.clone(),
+            ssr: record.ssr.clone(),
+            population: record.ssr.as_ref().map(|_| record.len()),
+            filter: record.filter.as_ref().map(|f| f.resolve(input_features)),
+            gain: record.gain,
+            depth: record.depth,
+            children,
+            oob: if index == 0 { self.out_of_bag() } else { None },
+        }
+    }
 
-        if !self.prototype {panic!("Attempted to split on a non-prototype node")};
+}
 
-        let mut slim_node = self.derive_bootstrap(parameters);
-        let candidate_filters = slim_node.candidate_filters(prototype,parameters);
-        let sample_indices: Vec<usize> = self.samples.iter().map(|s| s.index).collect();
-        let inputs = prototype.input_array.select(Axis(0),&sample_indices);
+// A bootstrap draw of samples and features from a node, used to pick candidate splits.
+// Everything is an index into the prototype.
 
-        let mut selected_candidates = None;
+#[derive(Clone,Debug)]
+pub struct Bootstrap {
+    input_features: Vec<usize>,
+    output_features: Vec<usize>,
+    samples: Vec<usize>,
+}
 
-        for (f_left,f_right) in candidate_filters {
-            let left_samples: Vec<Sample> = f_left.filter_matrix(&inputs).into_iter().map(|i| self.samples[i].clone()).collect();
-            let right_samples: Vec<Sample> = f_right.filter_matrix(&inputs).into_iter().map(|i| self.samples[i].clone()).collect();
-            if left_samples.len() > parameters.leaf_size_cutoff && right_samples.len() > parameters.leaf_size_cutoff {
-                selected_candidates = Some((f_left,f_right,left_samples,right_samples));
-                break
-            }
-        }
+impl Bootstrap {
 
-        let (left_filter,right_filter,left_samples,right_samples) = selected_candidates?;
+    pub fn draw<R: Rng>(samples:&[usize], prototype:&Prototype, parameters:&Parameters, rng:&mut R) -> Bootstrap {
 
-        let left_child = self.derive_prototype(left_samples, Some(left_filter));
-        let right_child = self.derive_prototype(right_samples, Some(right_filter));
+        let input_feature_indices: Vec<usize>;
+        let output_feature_indices: Vec<usize>;
 
-        self.means = Some(self.output_rank_matrix(prototype, parameters).means());
-        self.medians = Some(self.output_rank_matrix(prototype, parameters).medians());
+        let input_feature_len = prototype.input_array.dim().1;
+        let output_feature_len = prototype.output_array().dim().1;
 
-        let children = vec![left_child,right_child];
-        self.children = children;
+        if parameters.unsupervised {
+            let mut all_indices = (0..input_feature_len).collect::<Vec<usize>>();
+            let (ii,oi) = all_indices.partial_shuffle(rng,input_feature_len/2);
+            // Why can't you destructure into an initialized variable? It is a mystery.
+            input_feature_indices = ii.to_vec();
+            output_feature_indices = oi.to_vec();
+        }
+        else {
+            input_feature_indices = (0..input_feature_len).collect();
+            output_feature_indices = (0..output_feature_len).collect();
+        }
 
-        Some(&mut self.children)
+        let input_features: Vec<usize> =
+            (0..parameters.input_feature_subsample)
+            .map(|_| input_feature_indices[rng.gen_range(0..input_feature_indices.len())])
+            .collect();
 
-    }
+        let output_features: Vec<usize> =
+            (0..parameters.output_feature_subsample)
+            .map(|_| output_feature_indices[rng.gen_range(0..output_feature_indices.len())])
+            .collect();
 
-    pub fn grow(&mut self, prototype:&Prototype, parameters:&Parameters) {
-        if let Some(children) = self.split(prototype,parameters) {
-            for child in children.iter_mut() {
-                child.grow(prototype,parameters);
-            }
+        let samples: Vec<usize> = (0..parameters.sample_subsample).map(|_| samples[rng.gen_range(0..samples.len())]).collect();
+
+        Bootstrap {
+            input_features,
+            output_features,
+            samples,
         }
     }
 
-    pub fn blank_node() -> Node {
-        let input_features = &vec![][..];
-        let output_features = &vec![][..];
-        let samples = &vec![][..];
-        Node::prototype(input_features,output_features,samples,)
+    pub fn full(samples:&[usize], prototype:&Prototype) -> Bootstrap {
+        Bootstrap {
+            input_features: (0..prototype.input_array.dim().1).collect(),
+            output_features: (0..prototype.output_array().dim().1).collect(),
+            samples: samples.to_vec(),
+        }
     }
 
-    pub fn set_children(&mut self, children: Vec<Node>) {
-        self.children = children;
-    }
+    pub fn candidate_filters<R: Rng>(&self,prototype:&Prototype,parameters:&Parameters,rng:&mut R,profile:&mut Profile) -> Vec<(Filter,Filter,f64)> {
 
-    pub fn samples(&self) -> &[Sample] {
-        &self.samples
-    }
+        let timer = profile.start();
+        let input_projection = if parameters.reduce_input {
+            Some(project_indices(&prototype.input_array,&self.input_features,&self.samples,parameters,rng))
+        }
+        else { None };
+        if parameters.reduce_input {
+            profile.record(Phase::Projection,timer);
+        }
 
-    pub fn sample_names(&self) -> Vec<String> {
-        self.samples().iter().map(|s| s.name().to_owned()).collect()
-    }
+        let timer = profile.start();
+        let input_ranks = match &input_projection {
+            Some(projection) => RankMatrix::from_array(&projection.loadings,parameters),
+            None => prototype.input_ranks.derive_specified(&self.input_features,&self.samples),
+        };
+        let output_ranks = output_rank_matrix(prototype,parameters,&self.output_features,&self.samples,rng);
+        profile.record(Phase::DeriveRanks,timer);
 
-    pub fn input_features(&self) -> &[Feature] {
-        &self.input_features
-    }
+        let timer = profile.start();
+        let minima = RankMatrix::split_candidates(input_ranks,output_ranks);
+        profile.record(Phase::OrderDispersions,timer);
+
+        let filters = match input_projection {
+            Some(Projection { weights, means, .. }) => {
+                let input_features = Feature::vec(self.input_features.clone());
+                minima.into_iter()
+                .map(|(local_feature,_,local_threshold,gain)| {
+                    let left_filter = Filter::new(input_features.clone(),means.row(local_feature).to_vec(),weights.row(local_feature).to_vec(),local_threshold,false);
+                    let right_filter = Filter::new(input_features.clone(),means.row(local_feature).to_vec(),weights.row(local_feature).to_vec(),local_threshold,true);
+                    (left_filter,right_filter,gain)
+                }).collect()
+            },
+            None => {
+                minima.into_iter()
+                .map(|(local_feature,_,local_threshold,gain)| {
+                    let feature = Feature::q(&self.input_features[local_feature]);
+                    let left_filter = Filter::new(vec![feature.clone(),],vec![0.,],vec![1.,],local_threshold,false);
+                    let right_filter = Filter::new(vec![feature,],vec![0.,],vec![1.,],local_threshold,true);
+                    (left_filter,right_filter,gain)
+                }).collect()
+            },
+        };
 
-    pub fn input_feature_names(&self) -> Vec<String> {
-        self.input_features().iter().map(|f| f.name().to_owned()).collect()
-    }
+        filters
 
-    pub fn output_features(&self) -> &[Feature] {
-        &self.output_features
     }
 
-    pub fn output_feature_names(&self) -> Vec<String> {
-        self.output_features().iter().map(|f| f.name().to_owned()).collect()
+    pub fn local_split<R: Rng>(&self,prototype:&Prototype,parameters:&Parameters,rng:&mut R) -> Option<(Filter,Filter)> {
+        let candidates = self.candidate_filters(prototype, parameters, rng, &mut Profile::disabled());
+        candidates.get(0).map(|(left,right,_)| (left.clone(),right.clone()))
     }
 
-    pub fn crawl_children(&self) -> Vec<&Node> {
-        let mut output = Vec::new();
-        for child in &self.children {
-            output.extend(child.crawl_children());
-        }
-        output.push(&self);
-        output
-    }
+}
 
-    pub fn crawl_leaves(&self) -> Vec<&Node> {
-        let mut output = Vec::new();
-        if self.children.len() < 1 {
-            return vec![&self]
-        }
-        else {
-            for child in &self.children {
-                output.extend(child.crawl_leaves());
-            }
-        };
-        output
+fn project_indices<R: Rng>(array:&Array2<f64>,features:&[usize],samples:&[usize],parameters:&Parameters,rng:&mut R) -> Projection {
+    let selection = array.select(Axis(0),samples).select(Axis(1),features);
+    project(selection,parameters.reduction,rng).expect("Projection failed")
+}
+
+fn output_rank_matrix<R: Rng>(prototype:&Prototype,parameters:&Parameters,features:&[usize],samples:&[usize],rng:&mut R) -> RankMatrix {
+    if parameters.reduce_output {
+        let projection = project_indices(prototype.output_array(),features,samples,parameters,rng);
+        RankMatrix::from_array(&projection.loadings,parameters)
+    }
+    else {
+        prototype.output_ranks().derive_specified(features,samples)
     }
+}
 
-    pub fn to_serial(&self) -> SerialNode {
-        let serialized_children = self.children.iter().map(|c| c.to_serial()).collect();
-        SerialNode {
-            samples: self.samples.iter().map(|s| s.index).collect(),
-            means: self.means.clone(),
-            medians: self.medians.clone(),
-            filter: self.filter.clone(),
-            depth: self.depth,
-            children: serialized_children,
-        }
+// Means and medians of every output feature over a node's samples. Unless the output is
+// reduced these come straight from the output array one column at a time, rather than
+// by deriving a full output rank matrix for the node.
+
+fn node_statistics<R: Rng>(prototype:&Prototype,parameters:&Parameters,samples:&[usize],rng:&mut R) -> (Vec<f64>,Vec<f64>) {
+    if parameters.reduce_output {
+        let features: Vec<usize> = (0..prototype.output_array().dim().1).collect();
+        let output_ranks = output_rank_matrix(prototype,parameters,&features,samples,rng);
+        return (output_ranks.means(),output_ranks.medians())
     }
+    let statistics: Vec<(f64,f64)> = prototype.output_array().axis_iter(Axis(1))
+        .into_par_iter()
+        .map(|column| {
+            let mut values: Vec<f64> = samples.iter().map(|&s| column[s]).collect();
+            let mean = values.iter().sum::<f64>() / values.len() as f64;
+            (mean,median(&mut values))
+        })
+        .collect();
+    statistics.into_iter().unzip()
+}
 
+// Statistics over the whole of a node, from the output array directly. Features are independent,
+// so they are computed in parallel.
+
+fn full_statistics(prototype:&Prototype,samples:&[usize]) -> (Vec<f64>,Vec<f64>,Vec<f64>) {
+    let statistics: Vec<(f64,f64,f64)> = prototype.output_array().axis_iter(Axis(1))
+        .into_par_iter()
+        .map(|column| {
+            let mut values: Vec<f64> = samples.iter().map(|&s| column[s]).collect();
+            let mean = values.iter().sum::<f64>() / values.len().max(1) as f64;
+            let ssr = values.iter().map(|v| (v - mean).powi(2)).sum::<f64>();
+            (mean,median(&mut values),ssr)
+        })
+        .collect();
+    let mut means = Vec::with_capacity(statistics.len());
+    let mut medians = Vec::with_capacity(statistics.len());
+    let mut ssr = Vec::with_capacity(statistics.len());
+    for (mean,median,residuals) in statistics {
+        means.push(mean);
+        medians.push(median);
+        ssr.push(residuals);
+    }
+    (means,medians,ssr)
 }
 
 #[derive(Clone,Debug,Serialize,Deserialize)]
@@ -396,9 +541,17 @@ pub struct SerialNode {
     samples: Vec<usize>,
     means: Option<Vec<f64>>,
     medians: Option<Vec<f64>>,
+    #[serde(default,skip_serializing_if = "Option::is_none")]
+    ssr: Option<Vec<f64>>,
+    #[serde(default,skip_serializing_if = "Option::is_none")]
+    population: Option<usize>,
     filter: Option<Filter>,
+    #[serde(default,skip_serializing_if = "Option::is_none")]
+    gain: Option<f64>,
     depth: usize,
     children: Vec<SerialNode>,
+    #[serde(default,skip_serializing_if = "Option::is_none")]
+    oob: Option<Vec<usize>>,
 
 }
 
@@ -421,6 +574,36 @@ impl SerialNode {
     pub fn from_str(input:&str) -> Result<SerialNode,serde_json::Error> {
         serde_json::from_str(input)
     }
+
+    pub fn leaves(&self) -> Vec<&SerialNode> {
+        if self.children.len() < 1 {
+            return vec![self]
+        }
+        self.children.iter().flat_map(|c| c.leaves()).collect()
+    }
+
+    pub fn out_of_bag(&self) -> Option<&[usize]> {
+        self.oob.as_ref().map(|oob| &oob[..])
+    }
+
+    // Same as Tree::importances, for a tree read back from disk
+
+    pub fn importances(&self, features:usize) -> Vec<f64> {
+        let mut importances = vec![0.;features];
+        self.add_importances(self.samples.len().max(1) as f64,&mut importances);
+        importances
+    }
+
+    fn add_importances(&self, total:f64, importances:&mut [f64]) {
+        if let (Some(gain),Some(child)) = (self.gain,self.children.get(0)) {
+            if let Some(filter) = &child.filter {
+                filter.attribute(gain * self.samples.len() as f64 / total,importances);
+            }
+        }
+        for child in self.children.iter() {
+            child.add_importances(total,importances);
+        }
+    }
 }
 
 
@@ -437,11 +620,117 @@ mod node_testing {
         Prototype::new(iris(),iris(),&parameters)
     }
 
-    pub fn iris_node(parameters:&Parameters) -> Node {
-        let input = (0..4).map(|i| Feature::q(&i)).collect::<Vec<Feature>>();
-        let output = (0..4).map(|i| Feature::q(&i)).collect::<Vec<Feature>>();
-        let samples = (0..150).map(|i| Sample::q(&i)).collect::<Vec<Sample>>();
-        Node::prototype(&input, &output, &samples)
+    pub fn iris_features() -> Vec<Feature> {
+        (0..4).map(|i| Feature::q(&i)).collect::<Vec<Feature>>()
+    }
+
+    pub fn iris_parameters() -> Parameters {
+        let mut parameters = Parameters::empty();
+        parameters.sample_subsample = 150;
+        parameters.input_feature_subsample = 4;
+        parameters.output_feature_subsample = 4;
+        parameters.depth_cutoff = 3;
+        parameters.leaf_size_cutoff = 10;
+        parameters
+    }
+
+    #[test]
+    fn node_test_stream_iris() {
+        let parameters = iris_parameters();
+        let prototype = iris_prototype();
+        let mut tree = Tree::new(150,0);
+        let mut handle: Vec<u8> = vec![];
+        tree.stream(&prototype, &parameters, &iris_features(), &mut handle).unwrap();
+        let serial = SerialNode::from_str(std::str::from_utf8(&handle).unwrap()).unwrap();
+        assert_eq!(serial.samples.len(),150);
+        let leaf_samples: usize = serial.leaves().iter().map(|l| l.samples.len()).sum();
+        assert_eq!(leaf_samples,150);
+    }
+
+    #[test]
+    fn node_test_out_of_bag() {
+        let mut parameters = iris_parameters();
+        parameters.oob = true;
+        let prototype = iris_prototype();
+        let mut tree = Tree::new(150,3);
+        let mut handle: Vec<u8> = vec![];
+        tree.stream(&prototype, &parameters, &iris_features(), &mut handle).unwrap();
+        let streamed = SerialNode::from_str(std::str::from_utf8(&handle).unwrap()).unwrap();
+
+        let mut grown = Tree::new(150,3);
+        grown.grow(&prototype, &parameters);
+        assert_eq!(std::str::from_utf8(&handle).unwrap(),grown.to_serial(&iris_features()).to_string().unwrap());
+
+        let out_of_bag = streamed.out_of_bag().unwrap();
+        assert!(out_of_bag.len() > 20 && out_of_bag.len() < 80);
+        assert!(streamed.children.iter().all(|c| c.oob.is_none()));
+        assert!(streamed.gain.unwrap() > 0.);
+
+        let importances = streamed.importances(4);
+        assert!(importances.iter().sum::<f64>() > 0.);
+        for (a,b) in importances.iter().zip(tree.importances(4).iter()) {
+            assert!((a - b).abs() < 1e-9);
+        }
+    }
+
+    #[test]
+    fn node_test_full_statistics() {
+        let mut parameters = iris_parameters();
+        parameters.full_statistics = true;
+        let prototype = iris_prototype();
+        let mut tree = Tree::new(150,0);
+        let mut handle: Vec<u8> = vec![];
+        tree.stream(&prototype, &parameters, &iris_features(), &mut handle).unwrap();
+        let serial = SerialNode::from_str(std::str::from_utf8(&handle).unwrap()).unwrap();
+
+        let iris_means = iris().mean_axis(Axis(0)).unwrap();
+        for (a,b) in serial.means.as_ref().unwrap().iter().zip(iris_means.iter()) {
+            assert!((a - b).abs() < 1e-9);
+        }
+        for leaf in serial.leaves() {
+            assert_eq!(leaf.population,Some(leaf.samples.len()));
+            assert_eq!(leaf.ssr.as_ref().unwrap().len(),4);
+            assert!(leaf.medians.is_some());
+        }
+    }
+
+    #[test]
+    fn node_test_arena_partition() {
+        let parameters = iris_parameters();
+        let prototype = iris_prototype();
+        let mut tree = Tree::new(150,0);
+        tree.grow(&prototype, &parameters);
+        for (i,record) in tree.records.iter().enumerate() {
+            if let Some((left,right)) = record.children {
+                let left = &tree.records[left as usize];
+                let right = &tree.records[right as usize];
+                assert_eq!(left.start,record.start);
+                assert_eq!(left.end,right.start);
+                assert!(right.end <= record.end);
+                assert_eq!(left.depth,record.depth + 1);
+            }
+            let mut samples = tree.samples(i).to_vec();
+            samples.sort();
+            samples.dedup();
+            assert_eq!(samples.len(),record.len());
+        }
+        let leaf_samples: usize = tree.leaves().iter().map(|&l| tree.records[l].len()).sum();
+        assert_eq!(leaf_samples,150);
+    }
+
+    #[test]
+    fn node_test_seeded_trees_reproduce() {
+        let mut parameters = iris_parameters();
+        parameters.sample_subsample = 50;
+        parameters.input_feature_subsample = 2;
+        parameters.reduce_input = true;
+        let prototype = iris_prototype();
+        let serialize = |seed: u64| {
+            let mut tree = Tree::new(150,seed);
+            tree.grow(&prototype, &parameters);
+            tree.to_serial(&iris_features()).to_string().unwrap()
+        };
+        assert_eq!(serialize(7),serialize(7));
     }
 
     #[test]
@@ -454,9 +743,10 @@ mod node_testing {
         parameters.norm_mode = NormMode::L1;
         parameters.dispersion_mode = DispersionMode::SSME;
         parameters.split_fraction_regularization = 0.;
-        let mut root = iris_node(&parameters);
         let prototype = iris_prototype();
-        let (left,right) = root.local_split(&prototype, &parameters).unwrap();
+        let samples: Vec<usize> = (0..150).collect();
+        let root = Bootstrap::full(&samples,&prototype);
+        let (left,right) = root.local_split(&prototype, &parameters, &mut thread_rng()).unwrap();
         println!("Filters: {:?}", (&left,&right));
         let left_children = left.filter_matrix(&prototype.input_array);
         let right_children = right.filter_matrix(&prototype.input_array);
@@ -0,0 +1,198 @@
+use std::alloc::{GlobalAlloc,Layout,System};
+use std::sync::atomic::{AtomicBool,AtomicIsize,AtomicUsize,Ordering};
+use std::time::Instant;
+
+use serde_json::{Value,Map,json};
+
+// Phases of growing a tree that are timed when profiling. OrderDispersions covers the whole
+// parallel split search (RankMatrix::split_candidates), which is dominated by order_dispersions.
+// DeriveRanks covers bootstrapped rank matrices, including the output projection if the output
+// is reduced. Projection is the NIPALS projection of the input.
+
+#[derive(Clone,Copy,Debug)]
+pub enum Phase {
+    Bootstrap,
+    Projection,
+    DeriveRanks,
+    OrderDispersions,
+    FilterSamples,
+    NodeStatistics,
+    Serialization,
+}
+
+const PHASES: [&str;7] = [
+    "bootstrap",
+    "projection",
+    "derive_ranks",
+    "order_dispersions",
+    "filter_samples",
+    "node_statistics",
+    "serialization",
+];
+
+#[derive(Clone,Debug,Default)]
+struct Record {
+    calls: usize,
+    seconds: f64,
+}
+
+// Cumulative time and call counts per phase and per depth level. A disabled profile never
+// reads the clock, so timing calls can stay in place at no cost.
+
+#[derive(Clone,Debug)]
+pub struct Profile {
+    enabled: bool,
+    pub depth: usize,
+    records: Vec<Vec<Record>>,
+}
+
+impl Profile {
+
+    pub fn new(enabled:bool) -> Profile {
+        Profile {
+            enabled,
+            depth: 0,
+            records: vec![vec![];PHASES.len()],
+        }
+    }
+
+    pub fn disabled() -> Profile {
+        Profile::new(false)
+    }
+
+    pub fn start(&self) -> Option<Instant> {
+        if self.enabled { Some(Instant::now()) } else { None }
+    }
+
+    pub fn record(&mut self, phase:Phase, timer:Option<Instant>) {
+        if let Some(timer) = timer {
+            let by_depth = &mut self.records[phase as usize];
+            if by_depth.len() <= self.depth {
+                by_depth.resize(self.depth + 1,Record::default());
+            }
+            let record = &mut by_depth[self.depth];
+            record.calls += 1;
+            record.seconds += timer.elapsed().as_secs_f64();
+        }
+    }
+
+    pub fn merge(&mut self, other:&Profile) {
+        for (mine,theirs) in self.records.iter_mut().zip(other.records.iter()) {
+            if mine.len() < theirs.len() {
+                mine.resize(theirs.len(),Record::default());
+            }
+            for (m,t) in mine.iter_mut().zip(theirs.iter()) {
+                m.calls += t.calls;
+                m.seconds += t.seconds;
+            }
+        }
+    }
+
+    pub fn to_json(&self) -> Value {
+        let mut phases = Map::new();
+        for (name,by_depth) in PHASES.iter().zip(self.records.iter()) {
+            phases.insert(name.to_string(),json!({
+                "calls": by_depth.iter().map(|r| r.calls).sum::<usize>(),
+                "seconds": by_depth.iter().map(|r| r.seconds).sum::<f64>(),
+                "by_depth": by_depth.iter().map(|r| json!({"calls":r.calls,"seconds":r.seconds})).collect::<Vec<Value>>(),
+            }));
+        }
+        Value::Object(phases)
+    }
+
+}
+
+// A thin wrapper around the system allocator that counts allocations while profiling is on.
+// Counters are process wide, so with several trees in flight they can't be attributed to one tree.
+
+pub struct CountingAllocator;
+
+static COUNTING: AtomicBool = AtomicBool::new(false);
+static ALLOCATIONS: AtomicUsize = AtomicUsize::new(0);
+static ALLOCATED: AtomicUsize = AtomicUsize::new(0);
+static LIVE: AtomicIsize = AtomicIsize::new(0);
+static PEAK: AtomicIsize = AtomicIsize::new(0);
+
+fn grow_live(bytes:isize) {
+    let live = LIVE.fetch_add(bytes,Ordering::Relaxed) + bytes;
+    PEAK.fetch_max(live,Ordering::Relaxed);
+}
+
+unsafe impl GlobalAlloc for CountingAllocator {
+
+    unsafe fn alloc(&self, layout:Layout) -> *mut u8 {
+        let pointer = System.alloc(layout);
+        if !pointer.is_null() && COUNTING.load(Ordering::Relaxed) {
+            ALLOCATIONS.fetch_add(1,Ordering::Relaxed);
+            ALLOCATED.fetch_add(layout.size(),Ordering::Relaxed);
+            grow_live(layout.size() as isize);
+        }
+        pointer
+    }
+
+    unsafe fn dealloc(&self, pointer:*mut u8, layout:Layout) {
+        System.dealloc(pointer,layout);
+        if COUNTING.load(Ordering::Relaxed) {
+            LIVE.fetch_sub(layout.size() as isize,Ordering::Relaxed);
+        }
+    }
+
+    unsafe fn realloc(&self, pointer:*mut u8, layout:Layout, new_size:usize) -> *mut u8 {
+        let new_pointer = System.realloc(pointer,layout,new_size);
+        if !new_pointer.is_null() && COUNTING.load(Ordering::Relaxed) {
+            ALLOCATIONS.fetch_add(1,Ordering::Relaxed);
+            if new_size > layout.size() {
+                ALLOCATED.fetch_add(new_size - layout.size(),Ordering::Relaxed);
+            }
+            grow_live(new_size as isize - layout.size() as isize);
+        }
+        new_pointer
+    }
+
+}
+
+pub fn start_counting() {
+    COUNTING.store(true,Ordering::Relaxed);
+}
+
+// Live heap is counted from the moment counting starts, so peak_heap is relative to that point
+
+pub fn memory_json() -> Value {
+    json!({
+        "allocations": ALLOCATIONS.load(Ordering::Relaxed),
+        "allocated_bytes": ALLOCATED.load(Ordering::Relaxed),
+        "peak_heap": PEAK.load(Ordering::Relaxed).max(0),
+        "peak_rss": crate::events::peak_rss(),
+    })
+}
+
+#[cfg(test)]
+mod profile_tests {
+
+    use super::*;
+
+    #[test]
+    fn profile_records_by_depth() {
+        let mut profile = Profile::new(true);
+        profile.depth = 2;
+        let timer = profile.start();
+        profile.record(Phase::OrderDispersions,timer);
+        let mut total = Profile::new(true);
+        total.merge(&profile);
+        total.merge(&profile);
+        let report = total.to_json();
+        assert_eq!(report["order_dispersions"]["calls"],2);
+        assert_eq!(report["order_dispersions"]["by_depth"].as_array().unwrap().len(),3);
+        assert_eq!(report["bootstrap"]["calls"],0);
+    }
+
+    #[test]
+    fn disabled_profile_records_nothing() {
+        let mut profile = Profile::disabled();
+        let timer = profile.start();
+        assert!(timer.is_none());
+        profile.record(Phase::Bootstrap,timer);
+        assert_eq!(profile.to_json()["bootstrap"]["calls"],0);
+    }
+
+}
@@ -1,18 +1,28 @@
 use std::io::Write;
-use std::io::Error;
+use std::io::{Error,ErrorKind};
 use std::io;
+use std::fs::{File,rename,read_to_string};
+use std::mem::size_of;
+use std::sync::atomic::{AtomicUsize,Ordering};
+use std::sync::Mutex;
+use std::thread;
+use std::time::Instant;
+use serde_json::{Value,json};
 use ndarray::prelude::{Array2};
-
-use rayon::prelude::*;
+use memmap2::Mmap;
 
 
 extern crate rand;
+use rand::prelude::*;
 
 use crate::io::Parameters;
+use crate::events;
+use crate::profile::{self,Profile};
 use crate::Feature;
 use crate::Sample;
-use crate::node::Node;
+use crate::node::{Tree,SerialNode};
 use crate::rank_matrix::RankMatrix;
+use crate::rank_vector::Node as RankNode;
 
 pub struct Forest {
     input_features: Vec<Feature>,
@@ -22,88 +32,477 @@ pub struct Forest {
     prototype: Prototype,
 
     parameters: Parameters,
+
+    seed: u64,
+
+    // Per tree reports and the running total across trees when profiling
+    profiles: Mutex<(Vec<Value>,Profile)>,
+
+    // Split gains credited to each input feature, summed over trees
+    importances: Mutex<Vec<f64>>,
 }
 
-#[derive(Debug)]
+// The output array and ranks are None when they would be identical to the input, which is
+// the usual case for unsupervised runs. Use output_array()/output_ranks() to access them.
+
+#[derive(Debug,Serialize,Deserialize)]
 pub struct Prototype {
     pub input_array: Array2<f64>,
-    pub output_array: Array2<f64>,
+    output_array: Option<Array2<f64>>,
     pub input_ranks: RankMatrix,
-    pub output_ranks: RankMatrix,
+    output_ranks: Option<RankMatrix>,
 }
 
 impl Prototype {
     pub fn new(input:Array2<f64>,output:Array2<f64>,parameters: &Parameters) -> Prototype {
-        Prototype {
-            input_ranks:RankMatrix::from_array(&input.t().to_owned(),parameters),
-            output_ranks: RankMatrix::from_array(&output.t().to_owned(),parameters),
-            input_array: input,
-            output_array: output,
+        if input == output {
+            Prototype {
+                input_ranks:RankMatrix::from_array(&input.t().to_owned(),parameters),
+                output_ranks: None,
+                input_array: input,
+                output_array: None,
+            }
+        }
+        else {
+            Prototype {
+                input_ranks:RankMatrix::from_array(&input.t().to_owned(),parameters),
+                output_ranks: Some(RankMatrix::from_array(&output.t().to_owned(),parameters)),
+                input_array: input,
+                output_array: Some(output),
+            }
+        }
+    }
+
+    pub fn output_array(&self) -> &Array2<f64> {
+        self.output_array.as_ref().unwrap_or(&self.input_array)
+    }
+
+    pub fn output_ranks(&self) -> &RankMatrix {
+        self.output_ranks.as_ref().unwrap_or(&self.input_ranks)
+    }
+
+    // Approximate resident size in bytes
+
+    pub fn footprint(&self) -> usize {
+        let array_entries = self.input_array.len() + self.output_array.as_ref().map(|a| a.len()).unwrap_or(0);
+        let rank_entries: usize = std::iter::once(&self.input_ranks).chain(self.output_ranks.iter())
+            .map(|r| r.dimensions.0 * (r.dimensions.1 + 2))
+            .sum();
+        array_entries * size_of::<f64>() + rank_entries * (size_of::<RankNode>() + size_of::<usize>())
+    }
+
+    // If the prototype cache is enabled we look for a previously built prototype next to the
+    // input counts, keyed by the fingerprint of the count files and rank settings. On a miss
+    // we build it as usual and leave a copy behind for the next run.
+
+    pub fn from_parameters(parameters: &Parameters) -> Prototype {
+
+        if !parameters.prototype_cache {
+            return Prototype::new(parameters.input_array(),parameters.output_array(),parameters)
+        }
+
+        let fingerprint = parameters.prototype_fingerprint().expect("Failed to fingerprint count files");
+        let address = parameters.prototype_cache_address(fingerprint);
+
+        match Prototype::load(&address,fingerprint) {
+            Ok(prototype) => {
+                println!("Loaded cached prototype {}",address);
+                prototype
+            },
+            Err(_) => {
+                let prototype = Prototype::new(parameters.input_array(),parameters.output_array(),parameters);
+                if let Err(err) = prototype.dump(&address,fingerprint) {
+                    eprintln!("WARNING: Failed to cache prototype at {}: {:?}",address,err);
+                }
+                prototype
+            }
+        }
+    }
+
+    pub fn dump(&self, address: &str, fingerprint: u64) -> Result<(),Error> {
+
+        // We write to a scratch file and rename so that concurrent runs never observe a partial cache
+
+        let scratch = format!("{}.{}.partial",address,std::process::id());
+        {
+            let mut handle = io::BufWriter::new(File::create(&scratch)?);
+            let header = (PROTOTYPE_CACHE_VERSION,fingerprint);
+            bincode::serialize_into(&mut handle,&header).map_err(|e| Error::new(ErrorKind::Other,e))?;
+            bincode::serialize_into(&mut handle,self).map_err(|e| Error::new(ErrorKind::Other,e))?;
+            handle.flush()?;
+        }
+        rename(scratch,address)
+    }
+
+    pub fn load(address: &str, fingerprint: u64) -> Result<Prototype,Error> {
+
+        // The cache is read straight out of a memory map, so we never hold a second copy
+        // of the serialized bytes alongside the deserialized prototype.
+
+        let handle = File::open(address)?;
+        let map = unsafe { Mmap::map(&handle)? };
+
+        let header: (u32,u64) = bincode::deserialize(&map[..]).map_err(|e| Error::new(ErrorKind::InvalidData,e))?;
+        if header != (PROTOTYPE_CACHE_VERSION,fingerprint) {
+            return Err(Error::new(ErrorKind::InvalidData,"Stale prototype cache"))
         }
+
+        let offset = bincode::serialized_size(&header).map_err(|e| Error::new(ErrorKind::InvalidData,e))? as usize;
+        bincode::deserialize(&map[offset..]).map_err(|e| Error::new(ErrorKind::InvalidData,e))
     }
 }
 
+const PROTOTYPE_CACHE_VERSION: u32 = 2;
+
+#[derive(Debug,Serialize,Deserialize)]
+struct Checkpoint {
+    version: u32,
+    fingerprint: u64,
+    seed: u64,
+}
+
+const CHECKPOINT_VERSION: u32 = 1;
+
+// Seeds for individual trees are derived from the forest seed with a SplitMix64 step, so that
+// neighbouring tree indices get unrelated streams and any one tree can be regrown on its own.
+
+pub fn tree_seed(base:u64,index:usize) -> u64 {
+    let mut z = base.wrapping_add((index as u64).wrapping_add(1).wrapping_mul(0x9e3779b97f4a7c15));
+    z = (z ^ (z >> 30)).wrapping_mul(0xbf58476d1ce4e5b9);
+    z = (z ^ (z >> 27)).wrapping_mul(0x94d049bb133111eb);
+    z ^ (z >> 31)
+}
+
 impl Forest {
 
+    pub fn initialize(parameters: Parameters) -> Forest {
+        let prototype = Prototype::from_parameters(&parameters);
+        events::emit("prototype",json!({"bytes":prototype.footprint()}));
+        Forest::initialize_from_prototype(prototype,parameters)
+    }
+
     pub fn initialize_from(input_array: Array2<f64>, output_array: Array2<f64>,parameters: Parameters) -> Forest{
+        let prototype = Prototype::new(input_array,output_array, &parameters);
+        Forest::initialize_from_prototype(prototype,parameters)
+    }
+
+    pub fn initialize_from_prototype(prototype: Prototype,parameters: Parameters) -> Forest {
 
                 let samples = Sample::nvec(&parameters.sample_names().unwrap_or(
-                    (0..input_array.dim().0).map(|i| format!("{:?}",i)).collect()
+                    (0..prototype.input_array.dim().0).map(|i| format!("{:?}",i)).collect()
                 ));
 
                 let input_features = Feature::nvec(&parameters.input_feature_names().unwrap_or(
-                    (0..input_array.dim().1).map(|i| format!("{:?}",i)).collect()
+                    (0..prototype.input_array.dim().1).map(|i| format!("{:?}",i)).collect()
                 ));
                 let output_features = Feature::nvec(&parameters.output_feature_names().unwrap_or(
-                    (0..output_array.dim().1).map(|i| format!("{:?}",i)).collect()
+                    (0..prototype.output_array().dim().1).map(|i| format!("{:?}",i)).collect()
                 ));
 
-                let prototype = Prototype::new(input_array,output_array, &parameters);
 
+                let seed = parameters.seed.unwrap_or_else(|| thread_rng().gen());
+                let importances = vec![0.;input_features.len()];
 
                 Forest {
                     input_features,
                     output_features,
                     samples,
                     prototype,
+                    profiles: Mutex::new((vec![],Profile::new(parameters.profile))),
+                    importances: Mutex::new(importances),
                     parameters: parameters,
+                    seed,
                 }
     }
 
     pub fn compute_tree(&self,index:usize) -> Result<(),Error> {
 
-        // print!("Computing tree {}\r",index);
-        print!("Computing tree {}",index);
-        io::stdout().flush()?;
+        let started = Instant::now();
+        events::emit("tree_start",json!({"index":index}));
 
-        let mut root = Node::prototype(
-                    &self.input_features,
-                    &self.output_features,
-                    &self.samples,
-                );
+        let mut tree = Tree::new(self.samples.len(),self.tree_seed(index));
+        tree.profile = Profile::new(self.parameters.profile);
 
-        root.grow(&self.prototype,&self.parameters);
+        // Trees are written to a scratch file and renamed once complete, so a tree file that
+        // exists is never a partial one, even if the run is killed while writing it.
 
-        let specific_address = format!("{}.tree_{}.compact",self.parameters.report_address,index);
+        let specific_address = self.tree_address(index);
+        let scratch = format!("{}.partial",specific_address);
+
+        {
+            let mut handle = io::BufWriter::new(File::create(&scratch)?);
+            tree.stream(&self.prototype,&self.parameters,&self.input_features,&mut handle)?;
+            handle.flush()?;
+        }
+
+        rename(scratch,&specific_address)?;
+
+        // The tree event is only sent once the file is in place, so a reader can pick the tree
+        // up straight away while the rest of the forest is still growing.
+
+        events::emit("tree",json!({
+            "index":index,
+            "path":specific_address,
+            "nodes":tree.records.len(),
+            "leaves":tree.leaves().len(),
+            "oob":tree.out_of_bag().map(|oob| oob.len()),
+            "seconds":started.elapsed().as_secs_f64(),
+            "peak_rss":events::peak_rss(),
+        }));
+
+        self.add_importances(&tree.importances(self.input_features.len()));
+
+        if self.parameters.profile {
+            let mut profiles = self.profiles.lock().expect("Error, profile lock poisoned");
+            profiles.0.push(json!({
+                "index":index,
+                "seconds":started.elapsed().as_secs_f64(),
+                "nodes":tree.records.len(),
+                "phases":tree.profile.to_json(),
+            }));
+            profiles.1.merge(&tree.profile);
+        }
+
+        Ok(())
+
+    }
+
+    pub fn tree_address(&self,index:usize) -> String {
+        format!("{}.tree_{}.compact",self.parameters.report_address,index)
+    }
+
+    pub fn tree_seed(&self,index:usize) -> u64 {
+        tree_seed(self.seed,index)
+    }
+
+    fn checkpoint_address(&self) -> String {
+        format!("{}.checkpoint",self.parameters.report_address)
+    }
+
+    // A tree counts as complete if its file is present and holds a whole JSON document
+
+    pub fn completed_tree(&self,index:usize) -> bool {
+        match File::open(self.tree_address(index)) {
+            Ok(handle) => serde_json::from_reader::<_,serde::de::IgnoredAny>(io::BufReader::new(handle)).is_ok(),
+            Err(_) => false,
+        }
+    }
 
-        root.to_serial().dump(specific_address)
+    // The trees this run is responsible for. A shard of a larger forest grows the index range
+    // starting at first_tree, and since tree seeds and file names follow the global index, shards
+    // grown with the same seed add up to exactly the forest a single run would have grown.
 
+    pub fn tree_indices(&self) -> std::ops::Range<usize> {
+        self.parameters.first_tree..(self.parameters.first_tree + self.parameters.tree_limit)
+    }
+
+    // Works out which trees this run still has to grow. Every run leaves a checkpoint next to its
+    // trees recording the run fingerprint and the seed. When resuming against a matching checkpoint
+    // we adopt its seed, so missing trees come out exactly as the original run would have grown them,
+    // and skip every tree that was already written. Otherwise all trees are grown from scratch.
+
+    pub fn pending_trees(&mut self) -> Result<Vec<usize>,Error> {
+
+        let all_trees: Vec<usize> = self.tree_indices().collect();
+
+        let fingerprint = match self.parameters.run_fingerprint() {
+            Ok(fingerprint) => fingerprint,
+            Err(err) => {
+                if self.parameters.resume {
+                    eprintln!("WARNING: Couldn't fingerprint this run, growing all trees: {:?}",err);
+                }
+                return Ok(all_trees)
+            }
+        };
+
+        if self.parameters.resume {
+            match self.read_checkpoint() {
+                Some(previous) if previous.version == CHECKPOINT_VERSION && previous.fingerprint == fingerprint && self.parameters.seed.unwrap_or(previous.seed) == previous.seed => {
+                    self.seed = previous.seed;
+                    let pending: Vec<usize> = all_trees.into_iter().filter(|&i| !self.completed_tree(i)).collect();
+                    println!("Resuming, {} of {} trees already complete",self.parameters.tree_limit - pending.len(),self.parameters.tree_limit);
+                    return Ok(pending)
+                },
+                Some(_) => eprintln!("WARNING: Checkpoint at {} is from a different run, growing all trees",self.checkpoint_address()),
+                None => println!("No checkpoint at {}, growing all trees",self.checkpoint_address()),
+            }
+        }
+
+        self.write_checkpoint(&Checkpoint {version: CHECKPOINT_VERSION, fingerprint, seed: self.seed})?;
+
+        Ok(all_trees)
+    }
+
+    fn read_checkpoint(&self) -> Option<Checkpoint> {
+        let handle = File::open(self.checkpoint_address()).ok()?;
+        serde_json::from_reader(io::BufReader::new(handle)).ok()
+    }
+
+    fn write_checkpoint(&self,checkpoint:&Checkpoint) -> Result<(),Error> {
+        let address = self.checkpoint_address();
+        let scratch = format!("{}.partial",address);
+        {
+            let mut handle = io::BufWriter::new(File::create(&scratch)?);
+            serde_json::to_writer(&mut handle,checkpoint)?;
+            handle.flush()?;
+        }
+        rename(scratch,address)
+    }
+
+    // A rough upper bound on the working set of one tree in bytes: its sample buffer and
+    // partition scratch, the bootstrapped rank matrices used to search for a split, per-thread
+    // scratch while dispersions are ordered, node statistics, and projections if reducing.
+
+    pub fn tree_footprint(&self) -> usize {
+        let parameters = &self.parameters;
+        let word = size_of::<usize>();
+        let float = size_of::<f64>();
+        let rank_entry = size_of::<RankNode>() + word;
+        let samples = self.samples.len();
+        let subsample = parameters.sample_subsample + 2;
+        let threads = rayon::current_num_threads();
+
+        let buffer = samples * (2 * word + 1);
+        let ranks = (parameters.input_feature_subsample + parameters.output_feature_subsample) * subsample * rank_entry;
+        let scratch = threads * subsample * (size_of::<RankNode>() + word + float);
+        let statistics = self.output_features.len() * 2 * float + threads * samples * float;
+        let reduction = if parameters.reduce_input || parameters.reduce_output {
+            4 * subsample * parameters.input_feature_subsample.max(parameters.output_feature_subsample) * float
+        }
+        else { 0 };
+
+        buffer + ranks + scratch + statistics + reduction
+    }
+
+    // How many trees we can grow at once. By default one per thread, but under a memory limit
+    // only as many as fit next to the prototype. Low memory mode grows one tree at a time and
+    // puts all threads to work within it, which is slower but keeps a single working set.
+
+    pub fn concurrent_trees(&self) -> usize {
+        let threads = rayon::current_num_threads().min(self.parameters.tree_limit).max(1);
+
+        if self.parameters.low_memory {
+            return 1
+        }
+
+        match self.parameters.memory_limit {
+            None => threads,
+            Some(limit) => {
+                let prototype = self.prototype.footprint();
+                let tree = self.tree_footprint().max(1);
+                let fits = limit.saturating_sub(prototype) / tree;
+                println!("Memory estimate: prototype {} bytes, {} bytes per tree, limit {} bytes",prototype,tree,limit);
+                if fits < 1 {
+                    eprintln!("WARNING: Memory limit leaves no room for a tree next to the prototype, growing one tree at a time");
+                }
+                fits.max(1).min(threads)
+            }
+        }
     }
 
     pub fn generate(&mut self) -> Result<(),Error> {
 
+        let pending = self.pending_trees()?;
 
-        if self.parameters.parallel_trees {
+        // Trees kept from an earlier run are announced up front, like any other finished tree
 
-            println!("Working on trees (not in order)");
+        for index in self.tree_indices().filter(|i| !pending.contains(i)) {
+            events::emit("tree",json!({"index":index,"path":self.tree_address(index),"resumed":true}));
+            let tree = SerialNode::from_str(&read_to_string(self.tree_address(index))?)?;
+            self.add_importances(&tree.importances(self.input_features.len()));
+        }
 
-            let results: Vec<Result<(),Error>> = (0..self.parameters.tree_limit)
-                .into_par_iter()
-                .map(|i| {
-                    self.compute_tree(i)
-                }).collect();
+        let result = self.grow_trees(&pending);
 
-            print!("\n");
+        if self.parameters.profile {
+            self.write_profile()?;
+        }
+
+        if result.is_ok() {
+            self.write_importances()?;
+        }
+
+        events::emit("finish",json!({"trees":pending.len(),"seconds":events::elapsed(),"peak_rss":events::peak_rss()}));
+
+        result
+    }
+
+    // Writes the profiling report next to the trees: time and calls per phase, in total, per tree
+    // and per depth, the process wide allocation counters, and the parameters of the run.
+
+    pub fn write_profile(&self) -> Result<(),Error> {
+        let mut profiles = self.profiles.lock().expect("Error, profile lock poisoned");
+        profiles.0.sort_by_key(|tree| tree["index"].as_u64());
+        let report = json!({
+            "seconds":events::elapsed(),
+            "phases":profiles.1.to_json(),
+            "trees":profiles.0,
+            "memory":profile::memory_json(),
+            "parameters":self.parameters,
+        });
+        let address = format!("{}.profile.json",self.parameters.report_address);
+        let mut handle = io::BufWriter::new(File::create(&address)?);
+        serde_json::to_writer_pretty(&mut handle,&report)?;
+        handle.flush()?;
+        events::emit("profile",json!({"path":address}));
+        Ok(())
+    }
+
+    fn add_importances(&self,importances:&[f64]) {
+        let mut total = self.importances.lock().expect("Error, importance lock poisoned");
+        for (t,i) in total.iter_mut().zip(importances.iter()) {
+            *t += i;
+        }
+    }
+
+    // Writes the mean importance of each input feature across the trees of this run, one per
+    // line in the order of the input header
+
+    pub fn write_importances(&self) -> Result<(),Error> {
+        let total = self.importances.lock().expect("Error, importance lock poisoned");
+        let trees = self.parameters.tree_limit.max(1) as f64;
+        let address = format!("{}.importances",self.parameters.report_address);
+        let mut handle = io::BufWriter::new(File::create(&address)?);
+        for importance in total.iter() {
+            writeln!(handle,"{}",importance / trees)?;
+        }
+        handle.flush()?;
+        events::emit("importances",json!({"path":address}));
+        Ok(())
+    }
+
+    fn grow_trees(&self,pending:&[usize]) -> Result<(),Error> {
+
+        if self.parameters.parallel_trees {
+
+            let workers = self.concurrent_trees().min(pending.len()).max(1);
+
+            println!("Working on trees (not in order), {} at a time",workers);
+
+            // Each worker pulls the next tree index until none are left. Workers are plain threads
+            // rather than rayon tasks, so a worker blocked inside one tree's parallel split search
+            // can't be handed another tree by work stealing. This is what keeps the number of
+            // live trees bounded by the memory budget.
+
+            let forest = &*self;
+            let next_tree = AtomicUsize::new(0);
+
+            let results: Vec<Result<(),Error>> = thread::scope(|scope| {
+                let handles: Vec<_> = (0..workers).map(|_| {
+                    scope.spawn(|| {
+                        let mut results = vec![];
+                        loop {
+                            let next = next_tree.fetch_add(1,Ordering::SeqCst);
+                            if next >= pending.len() {
+                                break
+                            }
+                            results.push(forest.compute_tree(pending[next]));
+                        }
+                        results
+                    })
+                }).collect();
+                handles.into_iter().flat_map(|h| h.join().expect("Tree worker panicked")).collect()
+            });
 
             results.into_iter().try_fold((),|_,x| x)
         }
@@ -111,13 +510,11 @@ impl Forest {
 
             println!("Working on trees");
 
-            let results: Vec<Result<(),Error>> = (0..self.parameters.tree_limit)
-                .map(|i| {
+            let results: Vec<Result<(),Error>> = pending.iter()
+                .map(|&i| {
                     self.compute_tree(i)
                 }).collect();
 
-            print!("\n");
-
             results.into_iter().try_fold((),|_,x| x)
 
         }
@@ -153,5 +550,64 @@ mod random_forest_tests {
         // panic!();
     }
 
+    #[test]
+    fn prototype_cache_round_trip() {
+        let prototype = iris_prototype();
+        let address = std::env::temp_dir().join(format!("rf_5_prototype_test_{}",std::process::id()));
+        let address = address.to_str().unwrap();
+        prototype.dump(address,7).unwrap();
+        assert!(Prototype::load(address,8).is_err());
+        let loaded = Prototype::load(address,7).unwrap();
+        assert_eq!(loaded.input_array,prototype.input_array);
+        assert_eq!(loaded.output_ranks().full_values(),prototype.output_ranks().full_values());
+        std::fs::remove_file(address).unwrap();
+    }
+
+    #[test]
+    fn resume_grows_only_missing_trees() {
+        let directory = std::env::temp_dir().join(format!("rf_5_resume_test_{}",std::process::id()));
+        std::fs::create_dir_all(&directory).unwrap();
+        let counts = directory.join("input.counts");
+        let iris_text: Vec<String> = iris().outer_iter().map(|row| row.iter().map(|v| v.to_string()).collect::<Vec<String>>().join("\t")).collect();
+        std::fs::write(&counts,iris_text.join("\n")).unwrap();
+
+        let mut parameters = Parameters::empty();
+        parameters.input_count_array_file = counts.to_str().unwrap().to_string();
+        parameters.output_count_array_file = parameters.input_count_array_file.clone();
+        parameters.report_address = directory.join("tmp").to_str().unwrap().to_string();
+        parameters.tree_limit = 3;
+        parameters.parallel_trees = false;
+        parameters.sample_subsample = 50;
+        parameters.input_feature_subsample = 2;
+        parameters.output_feature_subsample = 2;
+        parameters.depth_cutoff = 3;
+        parameters.leaf_size_cutoff = 10;
+        parameters.resume = true;
+
+        let mut forest = Forest::initialize(parameters.clone());
+        forest.generate().unwrap();
+        let original = std::fs::read_to_string(forest.tree_address(1)).unwrap();
+        std::fs::remove_file(forest.tree_address(1)).unwrap();
+
+        let mut resumed = Forest::initialize(parameters);
+        assert_eq!(resumed.pending_trees().unwrap(),vec![1]);
+        resumed.generate().unwrap();
+        assert_eq!(std::fs::read_to_string(resumed.tree_address(1)).unwrap(),original);
+
+        std::fs::remove_dir_all(directory).unwrap();
+    }
+
+    #[test]
+    fn shard_indices_follow_first_tree() {
+        let mut parameters = Parameters::empty();
+        parameters.tree_limit = 3;
+        parameters.first_tree = 5;
+        parameters.seed = Some(11);
+        let forest = Forest::initialize_from(iris(),iris(),parameters);
+        assert_eq!(forest.tree_indices().collect::<Vec<usize>>(),vec![5,6,7]);
+        assert!(forest.tree_address(5).ends_with(".tree_5.compact"));
+        assert_eq!(forest.tree_seed(5),tree_seed(11,5));
+    }
+
 
 }
@@ -285,20 +285,26 @@ impl RankMatrix {
 
 
 
-    pub fn split_candidates(input_matrix:RankMatrix,output_matrix:RankMatrix) -> Vec<(usize,usize,f64)> {
+    // Candidate splits, one per input feature, best first. Each is the input feature, the sample
+    // the split falls at, the threshold value, and the dispersion gain of the split: how much
+    // lower the dispersion of the two halves is than the dispersion of the whole.
 
+    pub fn split_candidates(input_matrix:RankMatrix,output_matrix:RankMatrix) -> Vec<(usize,usize,f64,f64)> {
 
-        let draw_orders: Vec<Vec<usize>> = input_matrix.meta_vector.iter().map(|mv| mv.draw_order()).collect();
 
-        let mut minima: Vec<(usize,usize,f64)> =
-            draw_orders
-                // .into_iter()
-                .into_par_iter()
+        // Draw orders are computed inside each task rather than up front, so only one per
+        // thread is alive at a time
+
+        let mut minima: Vec<(usize,usize,f64,f64)> =
+            input_matrix.meta_vector
+                // .iter()
+                .par_iter()
                 .enumerate()
-                .flat_map(|(i,draw_order)| {
+                .flat_map(|(i,mv)| {
+                    let draw_order = mv.draw_order();
                     let ordered_dispersions = output_matrix.order_dispersions(&draw_order);
                     let (local_index,dispersion) = ArgMinMax::argmin_v(ordered_dispersions.iter().skip(1))?;
-                    Some((i,draw_order[local_index],*dispersion))
+                    Some((i,draw_order[local_index],*dispersion,ordered_dispersions[0] - *dispersion))
                 })
                 .collect();
 
@@ -306,8 +312,8 @@ impl RankMatrix {
 
         minima.sort_by(|&a,&b| (a.2).partial_cmp(&b.2).unwrap());
 
-        for triplet in minima.iter_mut() {
-            triplet.2 = input_matrix.feature_fetch(triplet.0,triplet.1);
+        for candidate in minima.iter_mut() {
+            candidate.2 = input_matrix.feature_fetch(candidate.0,candidate.1);
         }
 
         minima
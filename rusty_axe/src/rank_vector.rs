@@ -197,7 +197,7 @@ impl<
     }
 
     #[inline]
-    fn mpop(&mut self, target: usize) -> (f64, f64) {
+    pub fn mpop(&mut self, target: usize) -> (f64, f64) {
         let target_zone = self.nodes[target].zone;
         if target_zone != 0 {
 
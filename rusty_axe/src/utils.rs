@@ -11,6 +11,20 @@ pub fn arr_from_vec2(vec:Vec<Vec<f64>>) -> Array2<f64> {
 
 
 
+pub fn median(values: &mut [f64]) -> f64 {
+    if values.len() < 1 {
+        return 0.
+    }
+    values.sort_unstable_by(|a,b| a.partial_cmp(&b).unwrap_or(Ordering::Greater));
+    let half = values.len() / 2;
+    if values.len()%2==0 {
+        (values[half - 1] + values[half]) / 2.
+    }
+    else {
+        values[half]
+    }
+}
+
 pub fn slow_mad(values: &Vec<f64>) -> f64 {
     let median: f64;
     if values.len() < 1 {
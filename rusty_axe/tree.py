@@ -12,6 +12,37 @@ class Tree:
     def __init__(self, tree_json, forest):
         self.root = Node(tree_json, self, forest, cache=forest.cache)
         self.forest = forest
+        # Samples this tree never used to pick a split, if it was grown with oob=True
+        self.oob = tree_json.get('oob')
+
+    @classmethod
+    def from_arrays(cls, arrays, forest):
+
+        """
+        Builds a tree from the arrays of forest_arrays.flatten_tree. Children come before
+        their parents in the arrays, so every node is built after its children.
+        """
+
+        self = cls.__new__(cls)
+        self.forest = forest
+        oob = arrays.get('oob')
+        self.oob = None if oob is None else oob.tolist()
+
+        columns = {key: (value if value.ndim > 1 else value.tolist())
+                   for key, value in arrays.items()}
+
+        nodes = []
+        for i, (left, right) in enumerate(columns['children'].tolist()):
+            children = [nodes[left], nodes[right]] if left >= 0 else []
+            nodes.append(Node.from_arrays(
+                columns, i, self, forest, children, cache=forest.cache))
+
+        for node in reversed(nodes):
+            for child in node.children:
+                child.level = node.level + 1
+
+        self.root = nodes[-1]
+        return self
 
     def nodes(self, root=True):
         nodes = []
@@ -51,12 +82,15 @@ class Tree:
             child.trim(limit)
 
     def derive_samples(self, samples):
-        root_copy = self.root.derive_samples(samples)
+        # See forest_arrays.derive_samples, which Forest.derive_samples uses for every tree at once
+        from rusty_axe.forest_arrays import derive_nodes
+        derived, originals = derive_nodes(self.nodes(), samples, self.forest, oob=self.oob)
         self_copy = self.derived_copy()
-        self_copy.root = root_copy
-        for node in self_copy.root.nodes():
+        self_copy.root = derived.root
+        self_copy.oob = derived.oob
+        for node, original in zip(derived.nodes(), originals):
+            node.derived_from(original)
             node.tree = self_copy
-        self_copy.root.tree = self_copy
         return self_copy
 
     def derived_copy(self):
@@ -4,7 +4,10 @@ from rusty_axe.node import Node, Reduction, Filter
 from rusty_axe.prediction import Prediction
 from rusty_axe.sample_cluster import SampleCluster
 from rusty_axe.node_cluster import NodeCluster
+from rusty_axe.cache import CacheManager
+from rusty_axe.registry import NodeRegistry
 from rusty_axe.tree import Tree
+import rusty_axe.forest_arrays as forest_arrays
 
 from json import dumps as jsn_dumps
 from os import makedirs
@@ -117,15 +120,28 @@ class Forest:
 ########################################################################
 ########################################################################
 
+    def registry(self):
+
+        """
+        The forest's NodeRegistry, built the first time it's needed. Node lists returned by the
+        methods below are copies of the registry's, so callers are free to modify them.
+        """
+
+        registry = getattr(self, 'node_registry', None)
+        if registry is None or not registry.valid(self.trees):
+            registry = NodeRegistry(self.trees)
+            self.node_registry = registry
+        return registry
+
+    def invalidate_registry(self):
+        # Has to be called whenever nodes are added, removed or reindexed
+        self.node_registry = None
+
     def nodes(self, root=True, depth=None):
-        nodes = []
-        for tree in self.trees:
-            nodes.extend(tree.nodes(root=root))
-        if depth is not None:
-            nodes = [n for n in nodes if n.level <= depth]
-        return nodes
+        return list(self.registry().select_nodes(root=root, depth=depth))
 
     def reindex_nodes(self):
+        self.invalidate_registry()
         nodes = self.nodes()
         for i, node in enumerate(nodes):
             node.index = i
@@ -136,26 +152,18 @@ class Forest:
             if node.local_samples is not None:
                 new_samples = [map[s] for s in node.local_samples]
                 node.local_samples = new_samples
+        for tree in self.trees:
+            if tree.oob is not None:
+                tree.oob = [map[s] for s in tree.oob if s in map]
 
     def leaves(self, depth=None):
-        leaves = []
-        for tree in self.trees:
-            leaves.extend(tree.leaves(depth=depth))
-        return leaves
+        return list(self.registry().leaves(depth=depth))
 
     def level(self, target):
-        level = []
-        for tree in self.trees:
-            level.extend(tree.level(target))
-        return level
+        return list(self.registry().level_nodes(target))
 
     def stems(self, depth=None):
-        stems = []
-        for tree in self.trees:
-            stems.extend(tree.stems())
-        if depth is not None:
-            stems = [s for s in stems if s.level <= depth]
-        return stems
+        return list(self.registry().stems(depth=depth))
 
     def roots(self):
         return [tree.root for tree in self.trees]
@@ -171,9 +179,7 @@ class Forest:
         self.reset_cache()
 
     def leaf_mask(self):
-        leaf_mask = np.zeros(len(self.nodes()), dtype=bool)
-        leaf_mask[[leaf.index for leaf in self.leaves()]] = True
-        return leaf_mask
+        return self.registry().leaf.copy()
 
     """
 
@@ -464,13 +470,200 @@ class Forest:
             print("Failed to save")
 
     def load(location):
+        # Forests saved with save are directories, older backups are pickles
+        if os.path.isdir(location):
+            return Forest.open(location)
         with open(location, mode='br') as f:
             return pickle.load(f)
 
-    def load_from_rust(location, prefix="/run", ifh="/run.ifh", ofh='run.ofh', clusters='run.cluster', input="input.counts", output="output.counts"):
+    # Attributes kept in the manifest of a saved forest rather than as arrays
+
+    STORED_ATTRIBUTES = ['cache', 'coordinate_type', 'core_output_features', 'arguments', 'shard_arguments',
+                         'grow_arguments', 'profile', 'likely_tree', 'reverse_likely_tree']
+
+    STORED_ARRAYS = ['sample_labels', 'leaf_labels', 'tsne_coordinates',
+                     'pca_coordinates', 'umap_coordinates', 'coordinate_cache']
+
+    def tree_arrays(self):
+
+        """
+        The forest arrays of the trees (see forest_arrays). Trees of a lazy forest that haven't
+        been built are taken from its arrays as they are, without building them.
+        """
+
+        if isinstance(self.trees, forest_arrays.LazyTrees) and len(self.trees.built) == 0 and len(self.trees.extra) == 0:
+            return self.trees.arrays
+        tree_arrays = []
+        for i, tree in enumerate(self.trees):
+            if isinstance(self.trees, forest_arrays.LazyTrees) and i < self.trees.stored() and i not in self.trees.built:
+                tree_arrays.append(forest_arrays.tree_view(self.trees.arrays, i))
+            else:
+                tree_arrays.append(forest_arrays.tree_to_arrays(tree))
+        return forest_arrays.concatenate(tree_arrays)
+
+    def save(self, path):
+
+        """
+        Saves the forest to the directory path as .npy arrays: the nodes of every tree (structure,
+        leaf samples, filters and statistics, see forest_arrays), input and output matrices,
+        split cluster membership, sample and leaf labels and coordinates, plus a manifest with
+        the format version and the remaining attributes. Load it with Forest.open.
+
+        Saving to the same path again only rewrites the arrays that changed, and arrays that are
+        still mapped from the files they'd be written to aren't read at all, so saving a forest
+        opened with mmap after relabeling it costs about as much as the labels.
+        """
+
+        arrays = {}
+
+        for key, value in self.tree_arrays().items():
+            arrays["trees/" + key] = value
+
+        arrays['input'] = self.input
+        arrays['output'] = self.output
+        arrays['input_features'] = np.array(self.input_features, dtype=str)
+        arrays['output_features'] = np.array(self.output_features, dtype=str)
+        arrays['samples'] = np.array(self.samples, dtype=str)
+
+        attributes = {}
+
+        if hasattr(self, 'split_clusters'):
+            arrays['split_labels'] = np.array(
+                [getattr(node, 'split_cluster', -1) for node in self.nodes()], dtype=np.int64)
+            child_clusters = [node.child_clusters[lr]
+                              for node in self.nodes() for lr in (0, 1)]
+            arrays['child_cluster_indptr'] = np.cumsum(
+                [0] + [len(c) for c in child_clusters])
+            arrays['child_clusters'] = np.array(
+                [label for c in child_clusters for label in c], dtype=np.int64)
+            arrays['split_cluster_ids'] = np.array(
+                [cluster.id for cluster in self.split_clusters], dtype=np.int64)
+            arrays['split_cluster_indptr'] = np.cumsum(
+                [0] + [len(cluster.nodes) for cluster in self.split_clusters])
+            arrays['split_cluster_nodes'] = np.array(
+                [node.index for cluster in self.split_clusters for node in cluster.nodes], dtype=np.int64)
+            attributes['split_cluster_names'] = [
+                getattr(cluster, 'stored_name', None) for cluster in self.split_clusters]
+
+        if hasattr(self, 'unrestored') and not hasattr(self, 'split_clusters'):
+            arrays.update(self.unrestored[0])
+            attributes.update(self.unrestored[1])
+
+        if hasattr(self, 'sample_clusters'):
+            attributes['sample_cluster_names'] = {
+                str(cluster.id): cluster.stored_name for cluster in self.sample_clusters if hasattr(cluster, 'stored_name')}
+
+        for name in Forest.STORED_ARRAYS:
+            if hasattr(self, name):
+                arrays[name] = np.asarray(getattr(self, name))
+
+        for name in Forest.STORED_ATTRIBUTES:
+            if hasattr(self, name):
+                try:
+                    attributes[name] = json.loads(
+                        json.dumps(getattr(self, name), default=int))
+                except (TypeError, ValueError):
+                    print(f"Not saving {name}, it can't be stored as json")
+
+        opened = None
+        if hasattr(self, 'store') and os.path.exists(self.store[0]) and os.path.samefile(self.store[0], path):
+            opened = self.store[1]
+
+        written, manifest = forest_arrays.write_store(path, arrays, attributes, opened=opened)
+        print(f"Saved forest to {path}, wrote {len(written)} of {len(arrays)} arrays")
+
+        self.store = (path, manifest)
+
+        return written
+
+    def open(path, mmap_mode='r', lazy=False):
+
+        """
+        Opens a forest saved with save. With mmap_mode ('r', 'r+' or 'c' as for np.load, None to
+        read everything into memory) arrays are memory mapped, so statistics and matrices are
+        read from disk as they are used.
+
+        With lazy=True trees are also built only when used, as in load_lazy, and split
+        and leaf clusters aren't restored, since that would build every node. Their labels are
+        still in the saved directory, so a later save keeps them.
+        """
+
+        manifest, arrays = forest_arrays.read_store(path, mmap_mode=mmap_mode)
+        attributes = manifest['attributes']
+
+        forest = Forest([], input=arrays['input'], output=arrays['output'],
+                        input_features=np.array(arrays['input_features']), output_features=np.array(arrays['output_features']),
+                        samples=arrays['samples'].tolist(), cache=attributes.get('cache', False))
+
+        tree_arrays = {name[len("trees/"):]: value for name,
+                       value in arrays.items() if name.startswith("trees/")}
+
+        if lazy:
+            forest.trees = forest_arrays.LazyTrees(tree_arrays, forest)
+            forest.unrestored = (
+                {name: arrays[name] for name in ['split_labels', 'child_cluster_indptr', 'child_clusters', 'split_cluster_ids',
+                                                 'split_cluster_indptr', 'split_cluster_nodes', 'leaf_labels'] if name in arrays},
+                {name: attributes[name] for name in ['split_cluster_names'] if name in attributes})
+        else:
+            trees = forest_arrays.build_trees(
+                [forest_arrays.tree_view(tree_arrays, t) for t in range(len(tree_arrays['tree_indptr']) - 1)], forest)
+            forest.add_trees(trees)
+
+            if 'split_cluster_ids' in arrays:
+
+                nodes = forest.nodes()
+                ids = arrays['split_cluster_ids'].tolist()
+                indptr = arrays['split_cluster_indptr'].tolist()
+                members = arrays['split_cluster_nodes'].tolist()
+                child_indptr = arrays['child_cluster_indptr'].tolist()
+                child_clusters = arrays['child_clusters'].tolist()
+                for i, (node, label) in enumerate(zip(nodes, arrays['split_labels'].tolist())):
+                    if label >= 0:
+                        node.split_cluster = label
+                    node.child_clusters = tuple(
+                        child_clusters[child_indptr[2 * i + lr]:child_indptr[2 * i + lr + 1]] for lr in (0, 1))
+                forest.split_clusters = []
+                for c, cluster in enumerate(ids):
+                    node_cluster = NodeCluster(
+                        forest, [nodes[i] for i in members[indptr[c]:indptr[c + 1]]], cluster)
+                    name = attributes.get('split_cluster_names', [None] * len(ids))[c]
+                    if name is not None:
+                        node_cluster.set_name(name)
+                    forest.split_clusters.append(node_cluster)
+                forest.factors = forest.split_clusters
+
+            if 'leaf_labels' in arrays:
+                forest.set_leaf_labels(np.array(arrays['leaf_labels']))
+
+        if 'sample_labels' in arrays:
+            forest.set_sample_labels(np.array(arrays['sample_labels']))
+            for cluster in forest.sample_clusters:
+                name = attributes.get('sample_cluster_names', {}).get(str(cluster.id))
+                if name is not None:
+                    cluster.set_name(name)
+
+        for name in ['tsne_coordinates', 'pca_coordinates', 'umap_coordinates', 'coordinate_cache']:
+            if name in arrays:
+                setattr(forest, name, arrays[name])
+
+        for name in Forest.STORED_ATTRIBUTES:
+            if name in attributes and name != 'cache':
+                setattr(forest, name, attributes[name])
+
+        forest.store = (path, manifest)
+
+        return forest
+
+    def load_from_rust(location, prefix="/run", ifh="/run.ifh", ofh='run.ofh', clusters='run.cluster', input="input.counts", output="output.counts", workers=None):
+
+        """
+        Loads a forest from the files rf_5 wrote to location. Tree files are parsed into flat
+        arrays in a pool of worker processes (workers, by default one per core), then turned
+        into nodes here.
+        """
 
         combined_tree_files = sorted(
-            glob.glob(location + prefix + "*.compact"))
+            glob.glob(location + prefix + "*.compact"), key=tree_file_order)
 
         input = np.loadtxt(location + input)
         output = np.loadtxt(location + output)
@@ -487,27 +680,232 @@ class Forest:
         first_forest = Forest([], input_features=ifh, output_features=ofh,
                               input=input, output=output, split_labels=split_labels)
 
-        trees = []
-        for tree_file in combined_tree_files:
-            print(f"Loading {tree_file}\r", end='')
-            trees.append(
-                Tree(json.load(open(tree_file.strip())), first_forest))
+        print(f"Loading {len(combined_tree_files)} trees")
+        tree_arrays = forest_arrays.read_tree_files(
+            [tree_file.strip() for tree_file in combined_tree_files], workers=workers)
 
         # first_forest.prototype = Tree(json.load(open(location+prefix+".prototype")),first_forest)
 
-        first_forest.trees = trees
-
-        for i, node in enumerate(first_forest.nodes()):
-            node.index = i
+        first_forest.add_trees(
+            forest_arrays.build_trees(tree_arrays, first_forest))
 
-        sample_encoding = first_forest.node_sample_encoding(
-            first_forest.leaves())
-
-        if np.sum(np.sum(sample_encoding, axis=1) == 0) > 0:
+        if len(forest_arrays.unrepresented_samples(tree_arrays, len(first_forest.samples))) > 0:
             print("WARNING, UNREPRESENTED SAMPLES")
 
         return first_forest
 
+    def load_lazy(location, prefix="/run", ifh="/run.ifh", ofh='run.ofh', input="input.counts", output="output.counts", workers=None):
+
+        """
+        Opens the forest rf_5 wrote to location without building it. The first time, tree files
+        and count matrices are converted to memory mapped arrays in location + prefix + ".arrays/",
+        which is reused for as long as the tree files are unchanged, so opening again is instant.
+
+        Trees are built from the arrays the first time they are used (forest.trees is a
+        forest_arrays.LazyTrees) and node statistics are read from the mapped arrays, so
+        resident memory grows with the part of the forest that is actually looked at. Methods
+        that go over every node still work, they just page in the whole forest. Split clusters
+        are not loaded, since labeling nodes would build them all.
+        """
+
+        tree_files = [tree_file.strip() for tree_file in sorted(
+            glob.glob(location + prefix + "*.compact"), key=tree_file_order)]
+        directory = location + prefix + ".arrays/"
+
+        sources = [[os.path.basename(tree_file), os.path.getsize(tree_file), os.path.getmtime(tree_file)]
+                   for tree_file in tree_files]
+        header = None
+        try:
+            with open(directory + "header.json") as f:
+                header = json.load(f)
+        except Exception:
+            pass
+
+        if header is None or header['sources'] != sources:
+            print(f"Converting {len(tree_files)} trees to {directory}")
+            if os.path.exists(directory):
+                rmtree(directory)
+            forest_arrays.convert_tree_files(tree_files, directory + "trees/", workers=workers)
+            np.save(directory + "input.npy", np.loadtxt(location + input))
+            np.save(directory + "output.npy", np.loadtxt(location + output))
+            header = {
+                'input_features': np.loadtxt(location + ifh, dtype=str, ndmin=1).tolist(),
+                'output_features': np.loadtxt(location + ofh, dtype=str, ndmin=1).tolist(),
+                'sources': sources,
+            }
+            with open(directory + "header.json", 'w') as f:
+                json.dump(header, f)
+
+        forest = Forest([], input_features=np.array(header['input_features']), output_features=np.array(header['output_features']),
+                        input=np.load(directory + "input.npy", mmap_mode='r'),
+                        output=np.load(directory + "output.npy", mmap_mode='r'))
+        forest.trees = forest_arrays.LazyTrees(
+            forest_arrays.read_arrays(directory + "trees/"), forest)
+
+        return forest
+
+    def grow(self, n_trees, **kwargs):
+
+        """
+        Warm start: fits n_trees more trees with the arguments this forest was originally fit with
+        (self.arguments) and appends them to the forest. Keyword arguments override the originals,
+        eg grow(100, depth=8).
+
+        Existing trees keep their node indices, caches and split clusters. Only the new nodes are
+        indexed and, if split clusters exist, assigned to them.
+
+        If the directory the forest was fit in still exists, its count files are reused and the prototype
+        cache is switched on, so rust doesn't rebuild the prototype after the first call.
+        """
+
+        import rusty_axe.lumberjack as lj
+
+        if not hasattr(self, 'arguments'):
+            raise Exception("No stored arguments, fit this forest with lumberjack.fit to grow it")
+
+        original = lj.arguments_to_kwargs(self.arguments)
+        # Forests fit with shared_memory have no count files to go back to
+        shared_memory = 'input_shm' in original
+        fit_location = original['ic'][:-len("input.counts")] if 'ic' in original else None
+
+        # Location dependent arguments are regenerated by inner_fit. If the forest was grown with
+        # a seed we carry on from the next tree index, so the new trees are the ones a larger fit
+        # with that seed would have grown. Otherwise new trees get a fresh seed.
+
+        for key in ['ic', 'oc', 'input_shm', 'output_shm', 'o', 'ifh', 'ofh', 'auto', 'resume', 'first_tree', 'tree_offset']:
+            original.pop(key, None)
+        if 'seed' in original or 'seed' in kwargs:
+            original['first_tree'] = len(self.trees)
+        lrg_mem = original.pop('lrg_mem', False)
+        lrg_mem = original.pop('low_memory', False) or lrg_mem
+        unsupervised = original.pop('unsupervised', False)
+        original.update(kwargs)
+        original['trees'] = n_trees
+
+        prefix = f"grow_{len(self.trees)}"
+
+        tmp_dir = None
+        if fit_location is not None and os.path.exists(fit_location + "input.counts"):
+            location = fit_location
+            if 'pc' not in original:
+                original.setdefault('prototype_cache', True)
+            arguments = lj.inner_fit(location, ifh=(location + "tmp.ifh"), ofh=(location + "tmp.ofh"),
+                                     lrg_mem=lrg_mem, unsupervised=unsupervised, prefix=prefix, **original)
+        else:
+            tmp_dir = tmp.TemporaryDirectory()
+            location = tmp_dir.name + "/"
+            arguments = lj.save_trees(location, self.input, output_counts=self.output, ifh=self.input_features,
+                                      ofh=self.output_features, lrg_mem=lrg_mem, unsupervised=unsupervised, prefix=prefix, shared_memory=shared_memory, **original)
+
+        tree_files = sorted(glob.glob(location + prefix + "*.compact"), key=tree_file_order)
+
+        print(f"Loading {len(tree_files)} trees")
+        trees = forest_arrays.build_trees(
+            forest_arrays.read_tree_files(tree_files), self)
+
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+        self.add_trees(trees)
+
+        self.grow_arguments = getattr(self, 'grow_arguments', []) + [arguments, ]
+
+        return trees
+
+    def add_trees(self, trees):
+
+        """
+        Appends trees to the forest. New nodes are indexed after the existing ones, in the same
+        order nodes() returns them, and are assigned to existing split clusters if there are any.
+        """
+
+        offset = self.registry().size
+        new_nodes = []
+        for tree in trees:
+            tree.forest = self
+            new_nodes.extend(tree.nodes())
+        for i, node in enumerate(new_nodes):
+            node.index = offset + i
+            node.forest = self
+            node.cache = self.cache
+
+        self.trees.extend(trees)
+
+        if hasattr(self, 'split_clusters'):
+            self.extend_split_clusters(new_nodes)
+
+    def extend_split_clusters(self, nodes):
+
+        """
+        Assigns nodes that aren't labeled yet to the existing split clusters without reclustering.
+        Roots join the root cluster. Other nodes down to the deepest labeled level join the cluster
+        whose mean partial is closest by cosine distance. Deeper nodes inherit their ancestor's label
+        as in interpret_splits.
+        """
+
+        clusters = {cluster.id: cluster for cluster in self.split_clusters}
+        labeled = [c for c in self.split_clusters if c.id != 0 and len(c.nodes) > 0]
+
+        roots = [n for n in nodes if n.parent is None]
+        stems = []
+        if len(labeled) > 0:
+            depth = max([n.level for c in labeled for n in c.nodes])
+            stems = [n for n in nodes if n.parent is not None and n.level <= depth]
+
+        if len(stems) > 0:
+            centroids = np.array([np.mean(self.partial_matrix(c.nodes), axis=0) for c in labeled])
+            partials = self.partial_matrix(stems)
+            labels = np.argmin(cdist(partials, centroids, metric='cosine'), axis=1)
+
+            # Deepest first, so that unlabeled descendants inherit from their nearest labeled ancestor
+
+            for i in np.argsort([-n.level for n in stems], kind='stable'):
+                cluster = labeled[labels[i]]
+                stems[i].set_split_cluster(cluster.id)
+                cluster.nodes.append(stems[i])
+
+        for root in roots:
+            root.set_split_cluster(0)
+            if 0 in clusters:
+                clusters[0].nodes.append(root)
+
+    def merge(forests, **kwargs):
+
+        """
+        Combines forests fit on the same data into one, eg the shards of a fit spread across machines.
+        Forests may be given as Forest objects, or as directories of rf_5 output, which are loaded with
+        load_from_rust (keyword arguments are passed on to it).
+
+        Trees are copied in the order given, through their arrays (see tree_arrays), so the inputs are
+        left as they were, and nodes are indexed as if the merged forest had been loaded in one go.
+        Split clusters of the inputs are not carried over, since they aren't comparable across forests.
+        """
+
+        forests = [f if isinstance(f, Forest) else Forest.load_from_rust(f, **kwargs) for f in forests]
+
+        first = forests[0]
+        for forest in forests[1:]:
+            if forest.input.shape != first.input.shape or forest.output.shape != first.output.shape:
+                raise Exception("Can't merge forests fit on different data")
+            if list(forest.input_features) != list(first.input_features):
+                raise Exception("Can't merge forests with different input features")
+            if list(forest.output_features) != list(first.output_features):
+                raise Exception("Can't merge forests with different output features")
+
+        merged = Forest([], input=first.input, output=first.output, input_features=first.input_features,
+                        output_features=first.output_features, samples=first.samples, cache=first.cache)
+
+        for forest in forests:
+            arrays = forest.tree_arrays()
+            tree_arrays = [forest_arrays.tree_view(arrays, t)
+                           for t in range(len(arrays['tree_indptr']) - 1)]
+            merged.add_trees(forest_arrays.build_trees(tree_arrays, merged))
+
+        if hasattr(first, 'arguments'):
+            merged.arguments = first.arguments
+
+        return merged
+
     def from_sklearn(forest):
 
         raw_trees = [e.tree_ for e in forest.estimators_]
@@ -537,43 +935,62 @@ class Forest:
 
     def derive_samples(self, samples):
 
-        new_trees = []
+        """
+        A forest of the same trees restricted to samples, which become its samples in the order
+        given. Leaves keep only the samples in the subset, and splits that leave one side empty
+        become leaves (see forest_arrays.derive_samples). Trees are built from the derived arrays
+        when they're used, and share what didn't change with this forest's. Split cluster labels
+        carry over.
+        """
 
-        for i, tree in enumerate(self.trees):
-            print(f"Deriving tree {i}")
-            new_trees.append(tree.derive_samples(samples))
+        arrays, retained = forest_arrays.derive_samples(
+            self.tree_arrays(), samples, len(self.samples))
 
         new_forest = Forest(
-            new_trees,
-            copy.deepcopy(self.input[samples]),
-            copy.deepcopy(self.output[samples]),
-            input_features=copy.deepcopy(self.input_features),
-            output_features=copy.deepcopy(self.output_features),
+            [],
+            self.input[samples],
+            self.output[samples],
+            input_features=self.input_features,
+            output_features=self.output_features,
             samples=list(np.array(self.samples)[samples]),
             split_labels=None,
             cache=self.cache
         )
 
-        for tree in new_forest.trees:
-            tree.forest = new_forest
+        new_forest.trees = forest_arrays.LazyTrees(arrays, new_forest)
 
-        for node in new_forest.nodes():
-            node.forest = new_forest
+        if hasattr(self, 'split_clusters'):
+            split_labels = self.registry().split_labels()[retained]
+            new_forest.external_split_labels(
+                new_forest.nodes(), split_labels, roots=True)
 
-        split_labels = [n.split_cluster for n in new_forest.nodes()]
-        new_forest.external_split_labels(
-            new_forest.nodes(), split_labels, roots=True)
+        return new_forest
 
-        new_forest.reindex_samples(samples)
+    def set_cache(self, value, budget='auto', budgets=None, spill=None):
 
-        new_forest.reset_cache()
+        """
+        Switches node caching on or off. Cached values are held by the forest's CacheManager
+        (see caches()), and passing a budget in bytes, per quantity budgets or a spill location
+        (a directory, or True for a temporary one) replaces it with one configured accordingly.
 
-        return new_forest
+        By default the cache is limited to a fraction of physical memory (see CacheManager),
+        budget=None lifts the limit.
+        """
 
-    def set_cache(self, value):
         self.cache = value
         for node in self.nodes():
             node.cache = value
+        if budget != 'auto' or budgets is not None or spill is not None:
+            self.cache_manager = CacheManager(budget=budget, budgets=budgets, spill=spill)
+
+    def caches(self):
+        # Forests pickled before the cache manager existed get one when first asked
+        if not hasattr(self, 'cache_manager'):
+            self.cache_manager = CacheManager()
+        return self.cache_manager
+
+    def cache_statistics(self):
+        return self.caches().stats()
 
     def compute_cache(self):
         for i, tree in enumerate(self.trees):
@@ -582,46 +999,108 @@ class Forest:
         print("")
 
     def reset_cache(self):
+        self.caches().clear()
         for node in self.nodes():
             node.reset_cache()
 
+    # Statistics nodes keep as attributes, and the quantities of the cache manager, that have
+    # one value per output feature. Editing output features edits these in place
+
+    FEATURE_ATTRIBUTES = {'mean_cache': 'means', 'median_cache': 'medians',
+                          'srs_cache': 'srs', 'explained_cache': 'explained'}
+
+    FEATURE_QUANTITIES = ['means', 'medians', 'srs', 'mean_dispersions', 'median_dispersions',
+                          'absolute_gains', 'local_gains', 'additive', 'additive_mean']
+
+    def edit_feature_statistics(self, edit):
+        for node in self.nodes():
+            node.weights = edit(node, 'weights', node.weights)
+            for attribute, quantity in self.FEATURE_ATTRIBUTES.items():
+                if hasattr(node, attribute):
+                    setattr(node, attribute, edit(node, quantity, getattr(node, attribute)))
+        caches = self.caches()
+        for quantity in self.FEATURE_QUANTITIES:
+            caches.transform(quantity, lambda node, value: edit(node, quantity, value))
+
     def add_output_feature(self, feature_values, feature_name=None):
 
-        self.reset_cache()
+        if feature_name is None:
+            feature_name = str(len(self.output_features))
+
+        self.add_output_features(np.array([feature_values, ]).T, [feature_name, ])
+
+    def add_output_features(self, feature_values, feature_names=None):
+
+        """
+        Appends columns (feature_values is samples x features) to the output. Statistics nodes
+        already hold are extended with those of the new columns, computed for all nodes at once
+        (see registry.ColumnStatistics), rather than thrown away.
+        """
+
+        feature_values = np.asarray(feature_values)
+        if feature_values.ndim < 2:
+            feature_values = feature_values.reshape((-1, 1))
 
         if not hasattr(self, 'core_output_features'):
             self.core_output_features = len(self.output_features)
 
-        if feature_name is None:
-            feature_name = str(len(self.output_features))
+        if feature_names is None:
+            feature_names = [str(len(self.output_features) + i)
+                             for i in range(feature_values.shape[1])]
 
-        if feature_name in self.truth_dictionary.feature_dictionary.keys():
+        feature_names = list(feature_names)
+        if len(feature_names) != feature_values.shape[1]:
+            raise Exception("Feature names don't match feature values")
+        if len(set(feature_names)) < len(feature_names):
             raise Exception("REPEAT FEATURE")
+        for feature_name in feature_names:
+            if feature_name in self.truth_dictionary.feature_dictionary.keys():
+                raise Exception("REPEAT FEATURE")
+
+        statistics = self.registry().column_statistics(feature_values)
+
+        def edit(node, quantity, value):
+            if quantity == 'weights':
+                added = np.ones(feature_values.shape[1])
+            else:
+                added = statistics.get(quantity)[node.index]
+            return np.concatenate([value, added])
+
+        self.edit_feature_statistics(edit)
 
         feature_index = len(self.output_features)
 
         self.output_features = np.concatenate(
-            [self.output_features, np.array([feature_name, ])])
+            [self.output_features, np.array(feature_names)])
         self.output = np.concatenate(
-            [self.output, np.array([feature_values, ]).T], axis=1)
-        self.truth_dictionary.feature_dictionary[feature_name] = feature_index
-
-        for node in self.nodes():
-            node.weights = np.append(node.weights, 1.)
+            [self.output, feature_values], axis=1)
+        for i, feature_name in enumerate(feature_names):
+            self.truth_dictionary.feature_dictionary[feature_name] = feature_index + i
 
     def remove_output_feature(self, feature):
+        self.remove_output_features([feature, ])
 
-        if feature not in self.truth_dictionary.feature_dictionary.keys():
-            raise Exception("Feature not found")
+    def remove_output_features(self, features):
 
-        self.reset_cache()
+        """
+        Drops output features, and their columns from the statistics nodes hold. The statistics of
+        the remaining features are kept as they are.
+        """
 
-        feature_index = self.truth_dictionary.feature_dictionary[feature]
+        for feature in features:
+            if feature not in self.truth_dictionary.feature_dictionary.keys():
+                raise Exception("Feature not found")
 
-        self.output_features = np.delete(self.output_features, feature_index)
-        self.output = np.delete(self.output, feature_index, 1)
-        for node in self.nodes():
-            node.weights = np.delete(node.weights, feature_index)
+        if len(features) < 1:
+            return
+
+        feature_indices = [self.truth_dictionary.feature_dictionary[f] for f in features]
+
+        self.edit_feature_statistics(
+            lambda node, quantity, value: np.delete(value, feature_indices))
+
+        self.output_features = np.delete(self.output_features, feature_indices)
+        self.output = np.delete(self.output, feature_indices, 1)
 
         new_feature_dictionary = {f: i for i,
                                   f in enumerate(self.output_features)}
@@ -633,13 +1112,80 @@ class Forest:
             if self.core_output_features < len(self.output_features):
                 removed_features = self.output_features[self.core_output_features:]
                 print(f"Removing:{removed_features}")
-                for feature in removed_features:
-                    self.remove_output_feature(feature)
+                self.remove_output_features(list(removed_features))
 
     def predict(self, matrix):
         prediction = Prediction(self, matrix)
         return prediction
 
+    def oob_prediction(self):
+        """
+        Out-of-bag prediction of the output of every sample: the mean over trees that didn't use
+        the sample of the in-bag samples that share its leaf. Needs trees grown with oob=True.
+
+        Returns the predictions and a mask of the samples that were out of bag for at least one tree.
+        """
+
+        predictions = np.zeros(self.output.shape)
+        counts = np.zeros(self.output.shape[0])
+
+        for tree in self.trees:
+            if tree.oob is None:
+                continue
+            out_of_bag = np.zeros(self.output.shape[0], dtype=bool)
+            out_of_bag[tree.oob] = True
+            for leaf in tree.leaves():
+                samples = np.array(leaf.samples(), dtype=int)
+                held_out = samples[out_of_bag[samples]]
+                in_bag = samples[~out_of_bag[samples]]
+                if len(held_out) > 0 and len(in_bag) > 0:
+                    predictions[held_out] += np.mean(self.output[in_bag], axis=0)
+                    counts[held_out] += 1
+
+        if not np.any(counts):
+            raise Exception("No out-of-bag samples, fit with oob=True")
+
+        predicted = counts > 0
+        predictions[predicted] /= counts[predicted][:, None]
+
+        return predictions, predicted
+
+    def oob_score(self):
+        """
+        Coefficient of determination of the out-of-bag prediction, over all output features and
+        every sample that was out of bag for at least one tree.
+        """
+
+        predictions, predicted = self.oob_prediction()
+        truth = self.output[predicted]
+        residuals = np.sum(np.power(truth - predictions[predicted], 2))
+        total = np.sum(np.power(truth - np.mean(truth, axis=0), 2))
+        return 1 - (residuals / total)
+
+    def feature_importances(self):
+        """
+        Importance of each input feature: the dispersion gain of every split, weighted by the
+        fraction of its tree's samples that reached it and credited to the features of its filter
+        in proportion to their weights, averaged over trees. This is the measure rf_5 writes to
+        its .importances file, read back from the gains stored in each node.
+        """
+
+        importances = np.zeros(len(self.input_features))
+
+        for tree in self.trees:
+            total = max(tree.root.pop(), 1)
+            for node in tree.nodes():
+                if node.gain is None or len(node.children) < 1:
+                    continue
+                reduction = node.children[0].filter.reduction
+                scores = np.abs(np.array(reduction.scores))
+                if np.sum(scores) <= 0:
+                    continue
+                np.add.at(importances, reduction.features,
+                          node.gain * (node.pop() / total) * scores / np.sum(scores))
+
+        return importances / max(len(self.trees), 1)
+
     def split_labels(self, depth=3):
 
         nodes = self.nodes(depth=depth)
@@ -899,10 +1445,21 @@ class Forest:
 
         self.split_clusters = [NodeCluster(self, roots, 0), ]
 
+    def add_sample_cluster_features(self):
+
+        """
+        Adds an indicator output feature per sample cluster, sample_cluster_{i}, so that node
+        statistics cover cluster membership. reset_sample_clusters removes them again.
+        """
+
+        self.add_output_features(self.sample_cluster_encoding.T.astype(float),
+                                 [f'sample_cluster_{i}' for i in range(len(self.sample_clusters))])
+
     def reset_sample_clusters(self):
         try:
-            for i in range(len(self.sample_clusters)):
-                self.remove_output_feature(f'sample_cluster_{i}')
+            indicators = [f'sample_cluster_{i}' for i in range(len(self.sample_clusters))]
+            self.remove_output_features(
+                [f for f in indicators if f in self.truth_dictionary.feature_dictionary])
             del self.sample_clusters
             del self.sample_cluster_encoding
             del self.sample_labels
@@ -1720,6 +2277,17 @@ class Forest:
 
         return correlations
 
+def tree_file_order(tree_file):
+
+    # Sorts tree files by tree index rather than lexically, so tree_10 follows tree_9
+    # and the shards of a forest interleave into the order a single run would give
+
+    index = re.search(r"tree_(\d+)\.compact$", tree_file)
+    if index is None:
+        return (-1, tree_file)
+    return (int(index.group(1)), tree_file)
+
+
 class TruthDictionary:
 
     def __init__(self, counts, header, samples=None):
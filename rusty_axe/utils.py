@@ -1,4 +1,7 @@
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from scipy.spatial.distance import pdist, cdist, squareform
 
@@ -175,7 +178,113 @@ def js_wrap(name, content):
     return f"<script> let {name} = {content};</script>"
 
 
-def fast_knn(elements, k, neighborhood_fraction=.01, metric='euclidean'):
+# Metrics ball and KD trees handle, for which NearestNeighbors is used as long as there are few
+# enough dimensions for the trees to prune well. Anything else is searched by brute force in
+# blocks of rows, no bigger than BLOCK_ELEMENTS distances each.
+
+TREE_METRICS = ['euclidean', 'l2', 'minkowski', 'manhattan', 'cityblock', 'l1', 'chebyshev']
+TREE_DIMENSIONS = 20
+BLOCK_ELEMENTS = 2**22
+
+
+def distance_function(elements, metric):
+
+    """
+    A function giving the distances from some rows of elements to all of them. Cosine,
+    correlation and euclidean distances are matrix products, other metrics go through cdist.
+    Only the order of the distances matters, so euclidean distances are left squared.
+    """
+
+    elements = np.asarray(elements, dtype=float)
+
+    if metric in ('cosine', 'correlation'):
+        if metric == 'correlation':
+            elements = elements - np.mean(elements, axis=1, keepdims=True)
+        norms = np.linalg.norm(elements, axis=1, keepdims=True)
+        normalized = np.divide(elements, norms, out=np.zeros(elements.shape), where=norms > 0)
+        return lambda rows: 1. - np.dot(normalized[rows], normalized.T)
+    elif metric in ('euclidean', 'sqeuclidean', 'l2'):
+        squares = np.sum(np.power(elements, 2), axis=1)
+        return lambda rows: squares[rows][:, None] + squares[None, :] - 2 * np.dot(elements[rows], elements.T)
+    elif metric == 'sister':
+        return lambda rows: sister_distance(elements[rows], elements)
+    else:
+        return lambda rows: cdist(elements[rows], elements, metric=metric)
+
+
+def blocked_knn(distances, n, k, n_jobs=-1):
+
+    """
+    k nearest neighbors of each of n elements given distances(rows), the distances from rows to
+    every element (see distance_function). Blocks of rows are worked on in parallel threads,
+    since matrix products and cdist don't hold the interpreter lock.
+    """
+
+    block = max(1, min(1024, BLOCK_ELEMENTS // max(n, 1)))
+
+    def neighbors(start):
+        rows = np.arange(start, min(start + block, n))
+        block_distances = distances(rows)
+        block_distances[np.arange(len(rows)), rows] = np.inf
+        nearest = np.argpartition(block_distances, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(block_distances, nearest, axis=1), axis=1)
+        return np.take_along_axis(nearest, order, axis=1)
+
+    workers = os.cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        blocks = list(executor.map(neighbors, range(0, n, block)))
+
+    return np.concatenate(blocks + [np.zeros((0, k), dtype=int)]).astype(int)
+
+
+def knn(elements, k, metric='euclidean', n_jobs=-1):
+
+    """
+    Exact k nearest neighbors of each element (rows of elements) among the others, nearest
+    first, as an N x k array of indices. Elements are never their own neighbors.
+
+    Uses a ball or KD tree (NearestNeighbors) for metrics they support in few dimensions, and
+    blocked brute force otherwise (see blocked_knn). n_jobs is the number of cores, -1 for all.
+    """
+
+    elements = np.asarray(elements)
+
+    if k >= elements.shape[0]:
+        raise Exception(f"Can't find {k} neighbors among {elements.shape[0]} elements")
+
+    if metric in TREE_METRICS and elements.shape[1] <= TREE_DIMENSIONS:
+        index = NearestNeighbors(n_neighbors=k, metric=metric, n_jobs=n_jobs).fit(elements)
+        return index.kneighbors(return_distance=False).astype(int)
+
+    return blocked_knn(distance_function(elements, metric), elements.shape[0], k, n_jobs=n_jobs)
+
+
+def double_knn(elements1, elements2, k, metric='cosine', n_jobs=-1):
+
+    """
+    As knn, with the distance between two elements being the mean of their distances in
+    elements1 and in elements2 (see double_fast_knn)
+    """
+
+    if elements1.shape != elements2.shape:
+        raise Exception("Average metric knn inputs must be same size")
+    if k >= elements1.shape[0]:
+        raise Exception(f"Can't find {k} neighbors among {elements1.shape[0]} elements")
+
+    # Squared euclidean distances can't be averaged in place of euclidean ones
+
+    if metric in ('euclidean', 'l2'):
+        distances1 = lambda rows: cdist(elements1[rows], elements1)
+        distances2 = lambda rows: cdist(elements2[rows], elements2)
+    else:
+        distances1 = distance_function(elements1, metric)
+        distances2 = distance_function(elements2, metric)
+
+    return blocked_knn(lambda rows: (distances1(rows) + distances2(rows)) / 2,
+                       elements1.shape[0], k, n_jobs=n_jobs)
+
+
+def fast_knn(elements, k, neighborhood_fraction=.01, metric='euclidean', backend='index', n_jobs=-1):
 
 
     """
@@ -192,8 +301,17 @@ def fast_knn(elements, k, neighborhood_fraction=.01, metric='euclidean'):
 
     (but realistically it works sort of ok even if that's not true)
 
+    The anchor search above is backend='anchor'. By default (backend='index') neighbors are found
+    exactly with knn instead, which uses a ball/KD tree or blocked matrix products across n_jobs
+    cores and is much faster on large inputs.
+
     """
 
+    if backend == 'index':
+        return knn(elements, k, metric=metric, n_jobs=n_jobs)
+    elif backend != 'anchor':
+        raise Exception(f"Backend not recognized:{backend}")
+
     nearest_neighbors = np.zeros((elements.shape[0], k), dtype=int)
     complete = np.zeros(elements.shape[0], dtype=bool)
 
@@ -270,7 +388,7 @@ def fast_knn(elements, k, neighborhood_fraction=.01, metric='euclidean'):
     return nearest_neighbors
 
 
-def double_fast_knn(elements1, elements2, k, neighborhood_fraction=.01, metric='cosine'):
+def double_fast_knn(elements1, elements2, k, neighborhood_fraction=.01, metric='cosine', backend='index', n_jobs=-1):
 
     """
     See also fast_knn
@@ -278,11 +396,19 @@ def double_fast_knn(elements1, elements2, k, neighborhood_fraction=.01, metric='
     This is fast_knn where we have two sets of elements. The elements are matched (for nodes each element in set 2 is a sister of the node in set 1). We use it when we wish to find a KNN where the average of the two sets of distances is used. This is useful for incorporating the relatives of nodes when computing a KNNfor node clustering. Why not simply find the average of the two matrices?
 
     Same rationale as fast_knn: We don't have to compute the whole distance matrix, only small chunks of it.
+
+    As with fast_knn, backend='index' (the default) finds neighbors exactly with double_knn, and
+    backend='anchor' uses the anchor search.
     """
 
     if elements1.shape != elements2.shape:
         raise Exception("Average metric knn inputs must be same size")
 
+    if backend == 'index':
+        return double_knn(elements1, elements2, k, metric=metric, n_jobs=n_jobs)
+    elif backend != 'anchor':
+        raise Exception(f"Backend not recognized:{backend}")
+
     nearest_neighbors = np.zeros((elements1.shape[0], k), dtype=int)
     complete = np.zeros(elements1.shape[0], dtype=bool)
 
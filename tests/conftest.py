@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benches.python.synthetic import write_synthetic_forest
+from rusty_axe.tree_reader import Forest
+
+# Tests run on the synthetic fits the benchmarks use, so they don't need rf_5
+
+LAYOUT = dict(prefix="tmp", ifh="tmp.ifh", ofh="tmp.ofh")
+
+
+@pytest.fixture(scope="session")
+def fit_location(tmp_path_factory):
+    location = str(tmp_path_factory.mktemp("fit")) + os.sep
+    write_synthetic_forest(location, trees=6, depth=5, samples=300, features=6)
+    return location
+
+
+@pytest.fixture
+def forest(fit_location):
+    return Forest.load_from_rust(fit_location, **LAYOUT)
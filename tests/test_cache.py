@@ -0,0 +1,109 @@
+import os
+import pickle
+
+import numpy as np
+
+from rusty_axe.cache import CacheManager
+
+
+def spill_files(directory):
+    return [name for _, _, names in os.walk(directory) for name in names]
+
+
+def test_lru_across_quantities():
+    cache = CacheManager(budget=240)
+    cache.put('a', 0, np.zeros(10))
+    cache.put('b', 0, np.zeros(10))
+    cache.put('a', 1, np.zeros(10))
+    cache.get('a', 0, lambda: None)
+    cache.put('b', 1, np.zeros(10))
+
+    # b 0 was used least recently
+    assert list(cache.stores['a']) == [1, 0]
+    assert list(cache.stores['b']) == [1]
+    assert cache.total() == 240
+    assert cache.stats()['b']['evictions'] == 1
+    assert cache.stats()['a'] == {'hits': 1, 'misses': 0, 'spill_hits': 0, 'evictions': 0,
+                                  'spills': 0, 'entries': 2, 'bytes': 160}
+
+    assert cache.get('b', 0, lambda: np.ones(10))[0] == 1
+    assert cache.stats()['b']['misses'] == 1
+
+
+def test_quantity_budgets():
+    cache = CacheManager(budget=None, budgets={'a': 160})
+    for key in range(4):
+        cache.put('a', key, np.zeros(10))
+        cache.put('b', key, np.zeros(10))
+    assert list(cache.stores['a']) == [2, 3]
+    assert len(cache.stores['b']) == 4
+    assert cache.stats()['a']['evictions'] == 2
+    assert 'b' not in cache.stats()
+
+
+def test_spill(tmp_path):
+    cache = CacheManager(budget=160, spill=str(tmp_path))
+    for key in range(5):
+        cache.put('a', key, np.full(10, key, dtype=float))
+    assert len(spill_files(tmp_path)) == 3
+    assert cache.stats()['a']['spills'] == 3
+
+    for key in range(5):
+        assert cache.get('a', key, lambda: None)[0] == key
+    statistics = cache.stats()['a']
+    assert statistics['spill_hits'] == 5 and statistics['misses'] == 0
+
+    # Reading a value back removes its file, and evicting it again writes a new one
+    assert len(spill_files(tmp_path)) == 3
+    cache.clear('a')
+    assert spill_files(tmp_path) == []
+
+
+def test_temporary_spill():
+    cache = CacheManager(budget=80, spill=True)
+    cache.put('a', 0, np.zeros(10))
+    cache.put('a', 1, np.zeros(10))
+    directory = cache.spill_directory.name
+    assert len(spill_files(directory)) == 1
+    cache.discard(0)
+    assert spill_files(directory) == []
+    cache.clear()
+    assert not os.path.exists(directory)
+
+
+def test_transform_spilled(tmp_path):
+    cache = CacheManager(budget=160, spill=str(tmp_path))
+    for key in range(4):
+        cache.put('a', key, np.full(2, key, dtype=float))
+    cache.put('b', 0, np.zeros(20))
+    assert len(cache.spilled['a']) == 4
+
+    cache.transform('a', lambda key, value: np.concatenate([value, [key]]))
+    for key in range(4):
+        assert list(cache.get('a', key, lambda: None)) == [key, key, key]
+    assert cache.stats()['a']['misses'] == 0
+
+    cache.clear()
+    assert spill_files(tmp_path) == []
+
+
+def test_pickle(tmp_path):
+    cache = CacheManager(budget=160, budgets={'a': 80}, spill=str(tmp_path))
+    for key in range(4):
+        cache.put('a', key, np.zeros(10))
+    restored = pickle.loads(pickle.dumps(cache))
+
+    # Only the configuration comes along
+    assert (restored.budget, restored.budgets, restored.spill) == (160, {'a': 80}, str(tmp_path))
+    assert restored.total() == 0 and restored.stats() == {}
+
+    for key in range(4):
+        restored.put('a', key, np.ones(10))
+
+    # Both spill to the same directory without mixing up their values
+    assert len(spill_files(tmp_path)) == 6
+    assert cache.get('a', 0, lambda: None)[0] == 0
+    assert restored.get('a', 0, lambda: None)[0] == 1
+    cache.clear()
+    restored.clear()
+    assert spill_files(tmp_path) == []
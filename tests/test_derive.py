@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+
+def leaf_samples(description):
+    if description[3] is not None:
+        return description[3]
+    return [s for child in description[4] for s in leaf_samples(child)]
+
+
+def reference(node, kept):
+    # Node.derive_samples as it used to be written, recursively: leaves keep the samples in
+    # the subset, and a split left without samples on either side becomes a leaf
+    children = tuple(reference(child, kept) for child in node.children)
+    if len(children) < 1 or any(len(leaf_samples(child)) < 1 for child in children):
+        return (node.level, node.filter.split, getattr(node, 'split_cluster', None),
+                [s for s in node.samples() if s in kept], ())
+    return (node.level, node.filter.split, getattr(node, 'split_cluster', None), None, children)
+
+
+def describe(node, renumbered=None):
+    samples = None
+    if len(node.children) < 1:
+        samples = [int(s) for s in node.samples()]
+        if renumbered is not None:
+            samples = [renumbered[s] for s in samples]
+    return (node.level, node.filter.split, getattr(node, 'split_cluster', None), samples,
+            tuple(describe(child, renumbered) for child in node.children))
+
+
+def renumber(description, positions):
+    level, split, cluster, samples, children = description
+    if samples is not None:
+        samples = [positions[s] for s in samples]
+    return (level, split, cluster, samples, tuple(renumber(child, positions) for child in children))
+
+
+def count(description):
+    return 1 + sum(count(child) for child in description[4])
+
+
+@pytest.fixture
+def labeled(forest):
+    nodes = forest.nodes()
+    forest.external_split_labels(nodes, [node.level for node in nodes], roots=True)
+    forest.trees[0].oob = list(range(0, len(forest.samples), 5))
+    return forest
+
+
+@pytest.mark.parametrize("size", [300, 120, 12])
+def test_node_and_tree(labeled, size):
+    samples = np.random.default_rng(size).choice(len(labeled.samples), size, replace=False)
+    kept = set(samples.tolist())
+
+    collapsed = 0
+    for tree in labeled.trees:
+        for node in [tree.root] + tree.root.children:
+            expected = reference(node, kept)
+            # Samples keep their indices
+            assert describe(node.derive_samples(samples)) == expected
+            collapsed += count(describe(node)) - count(expected)
+
+        derived = tree.derive_samples(samples)
+        assert describe(derived.root) == reference(tree.root, kept)
+        assert all(node.tree is derived for node in derived.nodes())
+
+    # Every sample keeps every split, a handful of them collapses some
+    if size == 300:
+        assert collapsed == 0
+    if size == 12:
+        assert collapsed > 0
+
+    derived = labeled.trees[0].derive_samples(samples)
+    assert derived.oob == [s for s in labeled.trees[0].oob if s in kept]
+
+
+@pytest.mark.parametrize("size", [300, 120, 12])
+def test_forest(labeled, size):
+    samples = np.random.default_rng(size).choice(len(labeled.samples), size, replace=False)
+    kept = set(samples.tolist())
+    positions = {s: i for i, s in enumerate(samples.tolist())}
+
+    derived = labeled.derive_samples(samples)
+    assert np.array_equal(derived.output, labeled.output[samples])
+
+    # Samples become 0..len(samples) in the order given, and split labels carry over
+    for tree, original in zip(derived.trees, labeled.trees):
+        assert describe(tree.root) == renumber(reference(original.root, kept), positions)
+    assert [node.index for node in derived.nodes()] == list(range(len(derived.nodes())))
+
+    oob = derived.trees[0].oob
+    assert sorted(oob) == sorted(positions[s] for s in labeled.trees[0].oob if s in kept)
@@ -0,0 +1,28 @@
+import os
+import stat
+import tempfile
+
+import numpy as np
+import pytest
+
+import rusty_axe.lumberjack as lj
+
+
+@pytest.fixture
+def failing_rf_5(tmp_path, monkeypatch):
+    binary = tmp_path / "rf_5"
+    binary.write_text('#!/bin/sh\necho \'{"event":"start"}\'\necho boom >&2\nexit 3\n')
+    binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setattr(lj, "RUST_PATH", str(binary))
+
+    scratch = tmp_path / "scratch"
+    scratch.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(scratch))
+    return scratch
+
+
+@pytest.mark.parametrize("pipeline", [True, False])
+def test_failed_fit_raises(failing_rf_5, pipeline):
+    with pytest.raises(Exception, match="status 3"):
+        lj.fit(np.random.default_rng(0).random((20, 3)), trees=2, pipeline=pipeline)
+    assert os.listdir(failing_rf_5) == []
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from rusty_axe.tree_reader import Forest
+
+
+def test_merge_same_forest(forest):
+    nodes = forest.nodes()
+    before = [(node.index, node.forest, node.tree) for node in nodes]
+
+    merged = Forest.merge([forest, forest])
+
+    # The input keeps its nodes, the merged forest holds copies of them
+    assert [(node.index, node.forest, node.tree) for node in forest.nodes()] == before
+    assert all(node.forest is forest for node in forest.nodes())
+    assert len(forest.trees) * 2 == len(merged.trees)
+
+    merged_nodes = merged.nodes()
+    assert [node.index for node in merged_nodes] == list(range(2 * len(nodes)))
+    assert all(node.forest is merged for node in merged_nodes)
+    assert not any(merged_node is node for merged_node, node in zip(merged_nodes, nodes))
+    for node, merged_node in zip(nodes + nodes, merged_nodes):
+        assert list(node.samples()) == list(merged_node.samples())
+        assert np.allclose(node.means(), merged_node.means())
+
+
+def test_merge_mismatched_features(forest, fit_location):
+    other = Forest.load_from_rust(fit_location, prefix="tmp", ifh="tmp.ifh", ofh="tmp.ofh")
+    other.input_features = np.array([f"x{i}" for i in range(len(other.input_features))])
+    with pytest.raises(Exception):
+        Forest.merge([forest, other])
@@ -0,0 +1,75 @@
+import numpy as np
+
+from rusty_axe.tree_reader import Forest
+
+
+def labeled(forest):
+    nodes = [node for node in forest.nodes() if node.level > 0]
+    labels = np.random.default_rng(0).integers(0, 4, len(nodes))
+    forest.external_split_labels(nodes, labels)
+    forest.set_sample_labels(np.arange(len(forest.samples)) % 3)
+    return forest
+
+
+def assert_same_nodes(forest, opened):
+    assert len(forest.nodes()) == len(opened.nodes())
+    for node, other in zip(forest.nodes(), opened.nodes()):
+        assert node.index == other.index
+        assert node.level == other.level
+        assert list(node.samples()) == list(other.samples())
+        assert node.filter.reduction.features == other.filter.reduction.features
+        assert node.filter.split == other.filter.split
+        assert np.allclose(node.means(), other.means())
+
+
+def test_round_trip(forest, tmp_path):
+    forest = labeled(forest)
+    path = str(tmp_path / "store")
+    forest.save(path)
+    opened = Forest.open(path)
+
+    assert_same_nodes(forest, opened)
+    for node, other in zip(forest.nodes(), opened.nodes()):
+        assert np.array_equal(node.encoding(), other.encoding())
+        assert getattr(node, 'split_cluster', None) == getattr(other, 'split_cluster', None)
+        assert node.child_clusters == other.child_clusters
+
+    nodes = forest.nodes()[:10]
+    assert np.allclose(forest.mean_matrix(nodes), opened.mean_matrix(opened.nodes()[:10]))
+
+    assert [c.id for c in forest.split_clusters] == [c.id for c in opened.split_clusters]
+    assert [[n.index for n in c.nodes] for c in forest.split_clusters] == \
+        [[n.index for n in c.nodes] for c in opened.split_clusters]
+    assert np.array_equal(forest.sample_labels, opened.sample_labels)
+    assert np.array_equal(forest.output, opened.output)
+
+
+def test_lazy(forest, tmp_path):
+    forest = labeled(forest)
+    path = str(tmp_path / "store")
+    forest.save(path)
+    opened = Forest.open(path, lazy=True)
+
+    assert len(opened.trees.built) == 0
+    assert_same_nodes(forest, opened)
+
+    # Split clusters aren't restored lazily, but saving again keeps their labels
+    assert not hasattr(opened, 'split_clusters')
+    assert opened.save(path) == []
+    assert [c.id for c in Forest.open(path).split_clusters] == [c.id for c in forest.split_clusters]
+
+
+def test_resave_unchanged(forest, tmp_path):
+    path = str(tmp_path / "store")
+    forest.save(path)
+    assert Forest.open(path).save(path) == []
+
+
+def test_resave_relabeled(forest, tmp_path):
+    forest = labeled(forest)
+    path = str(tmp_path / "store")
+    forest.save(path)
+    opened = Forest.open(path)
+    opened.set_sample_labels(np.arange(len(opened.samples)) % 4)
+    assert sorted(opened.save(path)) == ['sample_labels']
+    assert np.array_equal(Forest.open(path).sample_labels, np.arange(len(forest.samples)) % 4)